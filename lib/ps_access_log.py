@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import math
+import time
+import logging
+import traceback
+from gi.repository import GLib
+from ps_util import Histogram
+from ps_util import DynObject
+
+
+class PsAccessLogAnalyzer:
+
+    """
+    Follow the access log of main server and keep aggregates for each virtual host.
+    Lines must begin with "%v %>s %B %D %{X-Cache}o", new lines are read and parsed in bulk periodically.
+    Memory is fixed: aggregates are kept for at most maxVhostCount virtual hosts, the others are aggregated as "other".
+    The log file is read from its end at start, rotation and truncation are followed.
+
+    Exampe:
+        obj = PsAccessLogAnalyzer("/var/log/pservers/httpd-access.log")
+        ...
+        for vhost, stat in obj.vhostDict.items():
+            ...
+        obj.dispose()
+    """
+
+    latencyBucketList = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]      # in seconds
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.checkInterval = 2
+        self.rateWindow = 60                # in seconds, request rate is a moving average in this window
+        self.maxReadSize = 4 * 1024 * 1024      # maximum bytes read in one check, the rest is read in next check, so mainloop is not blocked for long
+        self.maxVhostCount = 1024
+
+        self.vhostDict = dict()             # <vhost,stat>
+        self._statDict = dict()             # <vhost-in-bytes,stat>, so that vhost is not decoded for every line
+        self.lineCount = 0
+        self.badLineCount = 0
+
+        self._f = None
+        self._ino = None
+        self._remain = b''                  # incomplete last line
+        self._lastCheckTime = time.monotonic()
+        self._open(True)
+        self._timer = GLib.timeout_add_seconds(self.checkInterval, self._onCheck)
+
+    def dispose(self):
+        GLib.source_remove(self._timer)
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _open(self, bSeekEnd):
+        try:
+            self._f = open(self.filename, "rb")
+        except FileNotFoundError:
+            return
+        self._ino = os.fstat(self._f.fileno()).st_ino
+        if bSeekEnd:
+            self._f.seek(0, os.SEEK_END)
+        self._remain = b''
+
+    def _onCheck(self):
+        # event callback, no exception is allowed
+        try:
+            if self._f is None:
+                self._open(False)
+            if self._f is not None:
+                try:
+                    st = os.stat(self.filename)
+                except FileNotFoundError:
+                    st = None
+                if st is not None and st.st_size < self._f.tell() and st.st_ino == self._ino:
+                    # truncated
+                    self._f.seek(0)
+                    self._remain = b''
+                self._parse(self._f.read(self.maxReadSize))
+                if st is None or st.st_ino != self._ino:
+                    # rotated, the rest of the old file is read before switching
+                    self._parse(self._f.read())
+                    self._f.close()
+                    self._f = None
+                    self._open(False)
+
+            now = time.monotonic()
+            elapsed = now - self._lastCheckTime
+            self._lastCheckTime = now
+            if elapsed > 0:
+                alpha = 1 - math.exp(-elapsed / self.rateWindow)
+                for stat in self.vhostDict.values():
+                    stat.rate += alpha * (stat.checkCount / elapsed - stat.rate)
+                    stat.checkCount = 0
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    def _parse(self, buf):
+        if buf == b'':
+            return
+        lineList = (self._remain + buf).split(b'\n')
+        self._remain = lineList.pop()
+
+        statDict = self._statDict
+        for line in lineList:
+            try:
+                vhost, status, size, duration, rest = line.split(b' ', 4)
+                stat = statDict.get(vhost)
+                if stat is None:
+                    stat = self._getStat(vhost)
+                stat.statusClassCountList[_statusClassIndexDict[status[0]]] += 1
+                stat.byteCount += int(size)
+                stat.latencyHistogram.observe(int(duration) / 1000000)
+                i = _cacheIndexDict.get(rest[:1])
+                if i is not None:
+                    stat.cacheCountList[i] += 1
+                stat.requestCount += 1
+                stat.checkCount += 1
+            except (ValueError, IndexError, KeyError):
+                self.badLineCount += 1
+
+        self.lineCount += len(lineList)
+        if len(self._remain) > self.maxReadSize:
+            logging.error("Access log line is too long, discarded.")
+            self._remain = b''
+
+    def _getStat(self, vhost):
+        name = vhost.decode("utf-8", "replace")
+        if name not in self.vhostDict and len(self.vhostDict) >= self.maxVhostCount:
+            name = "other"
+        if name not in self.vhostDict:
+            self.vhostDict[name] = _newStat()
+        if len(self._statDict) < self.maxVhostCount * 2:
+            self._statDict[vhost] = self.vhostDict[name]
+        return self.vhostDict[name]
+
+
+_statusClassIndexDict = {ord(str(x + 1)): x for x in range(0, 5)}       # <first-byte-of-status,index-in-statusClassCountList>
+
+_cacheIndexDict = {b'H': 0, b'R': 1, b'M': 2}                           # <first-byte-of-x-cache,index-in-cacheCountList>, "-" is not cached
+
+
+def _newStat():
+    stat = DynObject()
+    stat.requestCount = 0
+    stat.statusClassCountList = [0] * 5         # 1xx, 2xx, 3xx, 4xx, 5xx
+    stat.byteCount = 0
+    stat.cacheCountList = [0] * 3               # hit, revalidate, miss
+    stat.rate = 0.0                             # requests per second
+    stat.checkCount = 0                         # requests parsed in the current check
+    stat.latencyHistogram = Histogram(PsAccessLogAnalyzer.latencyBucketList)
+    return stat
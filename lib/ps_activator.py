@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import asyncio
+import logging
+import traceback
+from gi.repository import GLib
+from ps_util import PsUtil
+from ps_util import DynObject
+from ps_param import PsConst
+
+
+class PsServerActivator:
+
+    """
+    Servers in lazy mode are routed to this object by a placeholder config in main server.
+    The first request starts the server and is held until the real config is applied, then it is redirected to the same url.
+    A server is stopped and routed back to the placeholder after being idle for server.idleTimeout seconds,
+    idle-ness is detected by a per-server activity log written by main server, which is truncated by every check.
+    A server failing to start is not started again in failureCooldown seconds, requests get 503 meanwhile.
+    """
+
+    def __init__(self, param):
+        self.param = param
+        self.idleCheckInterval = 10
+        self.requestTimeout = 30
+        self.reloadWaitTime = 1
+        self.failureCooldown = 30
+
+        self._activeDict = dict()           # <server-id,activity-info>
+        self._startingDict = dict()         # <server-id,task>
+        self._stoppingDict = dict()         # <server-id,task>, servers being hibernated
+        self._failDict = dict()             # <server-id,time-of-last-start-failure>
+
+        self._loop = asyncio.get_event_loop()
+        coro = asyncio.start_unix_server(self._onClientConnected, path=PsConst.activatorFile)
+        self._server = self._loop.run_until_complete(coro)
+        self._idleCheckTimer = GLib.timeout_add_seconds(self.idleCheckInterval, self._onIdleCheck)
+
+    def dispose(self):
+        GLib.source_remove(self._idleCheckTimer)
+        self._server.close()
+        self._activeDict.clear()            # servers are stopped by server manager
+
+    def removeServer(self, serverId):
+        # called before the server is stopped and removed, an activation in progress is cancelled
+        self._failDict.pop(serverId, None)
+        task = self._startingDict.get(serverId)
+        if task is not None:
+            task.cancel()
+        info = self._activeDict.pop(serverId, None)
+        if info is not None:
+            PsUtil.forceDelete(info.activityLogFile)
+
+    async def activate(self, serverId):
+        if serverId in self._activeDict:
+            # previous activation is not applied by main server yet
+            await asyncio.sleep(self.reloadWaitTime)
+            return
+        if time.monotonic() - self._failDict.get(serverId, -self.failureCooldown) < self.failureCooldown:
+            raise Exception("server %s failed to start recently" % (serverId))
+        if self.param.serverManager.isServerBusy(serverId):
+            raise Exception("server %s is being changed" % (serverId))
+        if serverId in self._stoppingDict:
+            await asyncio.shield(self._stoppingDict[serverId])
+        if serverId not in self._startingDict:
+            task = self._loop.create_task(self._startServer(serverId))
+            task.add_done_callback(lambda t: self._startingDict.pop(serverId))
+            self._startingDict[serverId] = task
+        await asyncio.shield(self._startingDict[serverId])
+
+    async def _startServer(self, serverId):
+        serverObj = self.param.serverDict[serverId]
+        cfg = await self.param.serverManager.startServer(serverObj)
+        if cfg is None:
+            self._failDict[serverId] = time.monotonic()
+            raise Exception("server %s failed to start" % (serverId))
+        self._failDict.pop(serverId, None)
+
+        info = DynObject()
+        info.activityLogFile = os.path.join(PsConst.tmpDir, "%s.activity" % (serverId))
+        info.lastActiveTime = time.monotonic()
+        self._activeDict[serverId] = info
+
+        cfg = dict(cfg)
+        cfg["activity-log-file"] = info.activityLogFile
+        self.param.mainServer.updateConfig(serverId, cfg)
+        self.param.mainServer.flushReload()
+        logging.info("Server %s activated." % (serverId))
+
+    def _hibernate(self, serverId):
+        serverObj = self.param.serverDict[serverId]
+        info = self._activeDict.pop(serverId)
+        self.param.mainServer.updateConfig(serverId, serverObj.getPlaceholderMainHttpServerConfig())
+        self.param.mainServer.flushReload()
+        PsUtil.forceDelete(info.activityLogFile)
+        task = self._loop.create_task(self.param.serverManager.stopServer(serverObj))
+        task.add_done_callback(lambda t: self._stoppingDict.pop(serverId))
+        self._stoppingDict[serverId] = task
+        logging.info("Server %s hibernated after being idle for %d seconds." % (serverId, serverObj.idleTimeout))
+
+    def _onIdleCheck(self):
+        # event callback, no exception is allowed
+        try:
+            now = time.monotonic()
+            for serverId, info in list(self._activeDict.items()):
+                if _truncateActivityLog(info.activityLogFile):
+                    info.lastActiveTime = now
+                elif now - info.lastActiveTime >= self.param.serverDict[serverId].idleTimeout:
+                    self._hibernate(serverId)
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    async def _onClientConnected(self, reader, writer):
+        try:
+            try:
+                buf = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.requestTimeout)
+                path, serverId = _parseRequest(buf)
+            except Exception:
+                writer.write(_response("400 Bad Request"))
+                return
+
+            serverObj = self.param.serverDict.get(serverId)
+            if serverObj is None or not serverObj.bLazy:
+                writer.write(_response("404 Not Found"))
+                return
+
+            try:
+                await self.activate(serverId)
+            except (Exception, asyncio.CancelledError):
+                writer.write(_response("503 Service Unavailable"))
+                return
+
+            writer.write(_response("307 Temporary Redirect", path))
+        finally:
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
+
+
+def _truncateActivityLog(filename):
+    # returns True if there's activity since last truncation, main server appends to the file
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return False
+    os.truncate(filename, 0)
+    return True
+
+
+def _parseRequest(buf):
+    # returns (path, host-name-without-port)
+    lineList = buf.decode("iso8859-1").split("\r\n")
+    path = lineList[0].split(" ")[1]
+    for line in lineList[1:]:
+        if line == "":
+            break
+        k, v = line.split(":", 1)
+        if k.strip().lower() == "host":
+            return (path, v.strip().split(":")[0])
+    raise Exception("no host header")
+
+
+def _response(status, location=None):
+    buf = "HTTP/1.1 %s\r\n" % (status)
+    if location is not None:
+        buf += "Location: %s\r\n" % (location)
+    buf += "Content-Length: 0\r\n"
+    buf += "Connection: close\r\n"
+    buf += "\r\n"
+    return buf.encode("iso8859-1")
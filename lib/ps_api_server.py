@@ -2,84 +2,394 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import logging
+from ps_util import PsUtil
+from ps_util import DynObject
+from ps_util import TokenBucket
+from ps_util import ClientRejectedError
 from ps_util import UnixDomainSocketApiServer
 from ps_param import PsConst
+from ps_main_httpd import PsMainHttpServer
 
 
-# FIXME
-# 1. no error report to client
-# 2. should use bidirectional json-rpc
 class PsApiServer(UnixDomainSocketApiServer):
 
+    """
+    Two protocols are supported on the api socket, they're distinguished by each message:
+      1. legacy notification: a json object without "jsonrpc" member, no response,
+         each client has one registration, which is replaced by every notification.
+      2. json-rpc 2.0: requests, notifications and batches, responses are sent in request order,
+         each client can have multiple registrations, one for each domain name.
+
+    Clients are admitted by peer credentials: connections and registrations are capped for each uid,
+    messages are rate limited for each uid and each pid. Rejected messages get no effect.
+    """
+
+    apiVersion = 1
+
     def __init__(self, param):
         self.param = param
-        self._clientDict = dict()
-        super().__init__(PsConst.apiServerFile, self._clientAppearFunc, self._clientDisappearFunc, self._clientNotifyFunc)
+        self._clientDict = dict()       # <sock,client>, client.regDict is <domain-name,data>
+        self._domainDict = dict()       # <domain-name,sock>
+        self._uidDict = dict()          # <uid,peer>
+        self._pidDict = dict()          # <pid,peer>
+        self.notifyCount = 0
+        self.rejectCountDict = {
+            "connection": 0,
+            "notification": 0,
+            "registration": 0,
+        }
+        self._rpcMethodDict = {
+            "get-version": self._rpcGetVersion,
+            "register": self._rpcRegister,
+            "unregister": self._rpcUnregister,
+        }
+        super().__init__(PsConst.apiServerFile, self._clientAppearFunc, self._clientDisappearFunc, self._clientNotifyFunc,
+                         self._clientErrorFunc)
+
+    @staticmethod
+    def checkBackendPool(pool):
+        # backend connection pool parameters, names are the same as ProxyPass
+        if not isinstance(pool, dict):
+            raise Exception("backend pool must be a json object")
+        for k, v in pool.items():
+            if not _checkBackendPoolParam(k, v):
+                raise Exception("invalid backend pool parameter \"%s\"" % (k))
 
     def dispose(self):
-        self.param.mainServer.batchRemoveConfig(self._clientDict.keys())
+        self.param.mainServer.batchRemoveConfig([_cfgId(x) for x in self._domainDict])
         super().dispose()
 
+    @property
+    def clientCount(self):
+        return len(self._clientDict)
+
+    @property
+    def registrationCount(self):
+        return len(self._domainDict)
+
+    def hasDomainName(self, domainName):
+        return domainName in self._domainDict
+
     def _clientAppearFunc(self, sock):
         assert sock not in self._clientDict
-        self._clientDict[sock] = None
+
+        pid, uid, gid = PsUtil.getUnixDomainSocketPeerInfo(sock)
+        uidObj = self._getPeer(self._uidDict, uid)
+        if uidObj.connCount >= self.param.apiMaxConnectionsPerUid:
+            self._reject(uidObj, "connection", "API client of uid %d rejected, too many connections." % (uid))
+            raise ClientRejectedError("too many connections for uid %d" % (uid))
+        pidObj = self._getPeer(self._pidDict, pid)
+        uidObj.connCount += 1
+        pidObj.connCount += 1
+
+        client = DynObject()
+        client.pid = pid
+        client.uid = uid
+        client.regDict = dict()
+        self._clientDict[sock] = client
         return sock
 
     def _clientDisappearFunc(self, sock):
         assert sock in self._clientDict
-        if self._clientDict[sock] is not None:
-            self.param.mainServer.removeConfig(sock.fileno())
-            logging.info("%s disappeared." % (self._toDebugStr(self._clientDict[sock])))
+        client = self._clientDict[sock]
+        for domainName in list(client.regDict):
+            data = client.regDict[domainName]
+            self._unregister(sock, domainName)
+            logging.info("%s disappeared." % (self._toDebugStr(data)))
+        self._uidDict[client.uid].connCount -= 1
+        self._pidDict[client.pid].connCount -= 1
+        if self._pidDict[client.pid].connCount == 0:
+            del self._pidDict[client.pid]                 # pid may be reused, uid peer is kept to keep its token bucket
         del self._clientDict[sock]
 
     def _clientNotifyFunc(self, sock, data):
-        # check
-        if "domain-name" not in data:
+        self.notifyCount += 1
+        client = self._clientDict[sock]
+        uidObj = self._uidDict[client.uid]
+        if not self._pidDict[client.pid].bucket.consume() or not uidObj.bucket.consume():
+            self._reject(uidObj, "notification", "API client of uid %d pid %d is rate limited." % (client.uid, client.pid))
+            e = _RpcError(-32001, "rate limited")
+            if isinstance(data, list):
+                ret = [_rpcErrorResponse(x["id"], e) for x in data if isinstance(x, dict) and "id" in x]
+                return ret if len(ret) > 0 else None
+            if isinstance(data, dict) and "jsonrpc" in data:
+                return _rpcErrorResponse(data["id"], e) if "id" in data else None
+            return None                                     # legacy notification is dropped silently
+        uidObj.bLimited = False
+
+        if isinstance(data, list):
+            if len(data) == 0:
+                return _rpcErrorResponse(None, _RpcError(-32600, "invalid request"))
+            ret = [self._handleRpcRequest(sock, x) for x in data]
+            ret = [x for x in ret if x is not None]
+            return ret if len(ret) > 0 else None
+
+        if isinstance(data, dict) and "jsonrpc" in data:
+            return self._handleRpcRequest(sock, data)
+
+        # legacy notification, exception is absorbed by upper layer
+        # the old registration is replaced only after the new one succeeds
+        self._checkData(data)
+        data = self._normalizeData(data)
+        oldList = [x for x in self._clientDict[sock].regDict if x != data["domain-name"]]
+        self._register(sock, data, len(oldList))
+        for domainName in oldList:
+            self._unregister(sock, domainName)
+        return None
+
+    def _clientErrorFunc(self, sock, data, e):
+        # json-rpc clients wait for the response of every request, legacy notification has no response
+        if data is None:
+            return _rpcErrorResponse(None, _RpcError(-32700, "parse error"))
+        e = _RpcError(-32603, str(e))
+        if isinstance(data, list):
+            ret = [_rpcErrorResponse(x["id"], e) for x in data if isinstance(x, dict) and "id" in x]
+            return ret if len(ret) > 0 else None
+        if isinstance(data, dict) and "jsonrpc" in data and "id" in data:
+            return _rpcErrorResponse(data["id"], e)
+        return None
+
+    def _handleRpcRequest(self, sock, req):
+        # returns None for json-rpc notification
+        reqId = req.get("id") if isinstance(req, dict) else None
+        try:
+            if not isinstance(req, dict) or req.get("jsonrpc") != "2.0" or not isinstance(req.get("method"), str):
+                raise _RpcError(-32600, "invalid request")
+            if req["method"] not in self._rpcMethodDict:
+                raise _RpcError(-32601, "method not found")
+            params = req.get("params", dict())
+            if not isinstance(params, dict):
+                raise _RpcError(-32602, "invalid params")
+            ret = _rpcResultResponse(reqId, self._rpcMethodDict[req["method"]](sock, params))
+        except _RpcError as e:
+            ret = _rpcErrorResponse(reqId, e)
+        except Exception as e:
+            logging.error("API request failed.", exc_info=True)
+            ret = _rpcErrorResponse(reqId, _RpcError(-32603, str(e)))
+
+        if isinstance(req, dict) and "id" not in req:
+            return None
+        return ret
+
+    def _rpcGetVersion(self, sock, params):
+        return {
+            "api-version": self.apiVersion,
+        }
+
+    def _rpcRegister(self, sock, params):
+        try:
+            self._checkData(params)
+        except Exception as e:
+            raise _RpcError(-32602, str(e))
+        data = self._normalizeData(params)
+        self._register(sock, data)
+        return True
+
+    def _rpcUnregister(self, sock, params):
+        if not isinstance(params.get("domain-name"), str):
+            raise _RpcError(-32602, "\"domain-name\" field is invalid")
+        domainName = self._normalizeData(params)["domain-name"]
+        if domainName not in self._clientDict[sock].regDict:
+            raise _RpcError(-32000, "domain name %s is not registered by this client" % (domainName))
+        data = self._clientDict[sock].regDict[domainName]
+        self._unregister(sock, domainName)
+        logging.info("%s unregistered." % (self._toDebugStr(data)))
+        return True
+
+    def _checkData(self, data):
+        if not isinstance(data, dict):
+            raise Exception("notification must be a json object")
+        if not isinstance(data.get("domain-name"), str):
             raise Exception("\"domain-name\" field does not exist in notification")
-        if not data["domain-name"].endswith(".private"):
+        if not data["domain-name"].lower().endswith(".private") or not PsUtil.isValidDomainName(data["domain-name"]):
             raise Exception("\"domain-name\" field is invalid")
         if "http-port" not in data and "https-port" not in data:
             raise Exception("\"http-port\" or \"https-port\" must exist in notification")
+        for key in ["http-port", "https-port"]:
+            if key in data and not (isinstance(data[key], int) and 0 < data[key] < 65536):
+                raise Exception("\"%s\" field is invalid" % (key))
+        if "capabilities" in data:
+            if not isinstance(data["capabilities"], list) or not all([x in ["websocket", "http2"] for x in data["capabilities"]]):
+                raise Exception("\"capabilities\" field is invalid")
+        if "backend-pool" in data:
+            try:
+                PsApiServer.checkBackendPool(data["backend-pool"])
+            except Exception as e:
+                raise Exception("\"backend-pool\" field is invalid, %s" % (e))
+        if "cache" in data:
+            try:
+                PsMainHttpServer.checkCachePolicy(data["cache"])
+            except Exception as e:
+                raise Exception("\"cache\" field is invalid, %s" % (e))
 
+    def _normalizeData(self, data):
         # FIXME
-        data["domain-name"] = data["domain-name"].replace(".private", ".local")
+        # domain names are case insensitive, they are compared in lower case everywhere
+        data = dict(data)
+        data["domain-name"] = data["domain-name"].lower().replace(".private", ".local")
+        return data
+
+    def _getPeer(self, peerDict, key):
+        if key not in peerDict:
+            peer = DynObject()
+            peer.connCount = 0
+            peer.regCount = 0
+            peer.rejectCount = 0
+            peer.bLimited = False
+            peer.bucket = TokenBucket(self.param.apiNotifyRate, self.param.apiNotifyBurst)
+            peerDict[key] = peer
+        return peerDict[key]
+
+    def _reject(self, uidObj, reason, msg):
+        self.rejectCountDict[reason] += 1
+        uidObj.rejectCount += 1
+        if not uidObj.bLimited:
+            logging.warning(msg)                        # log only once until the peer is admitted again
+            uidObj.bLimited = True
+
+    def _register(self, sock, data, releaseCount=0):
+        # releaseCount is the number of registrations of this client that are removed after this one succeeds
+        client = self._clientDict[sock]
+        domainName = data["domain-name"]
+        if self._domainDict.get(domainName, sock) != sock:
+            raise _RpcError(-32000, "domain name %s is registered by another client" % (domainName))
+        if any([x.domainName == domainName for x in self.param.serverDict.values()]):
+            raise _RpcError(-32000, "domain name %s is used by server" % (domainName))
 
         # do work and save log
-        cfgId = "proxy-%d" % (sock.fileno())
-        if self._clientDict[sock] is None:
-            self.param.mainServer.addConfig(cfgId, self._toApacheConfig(data))
+        if domainName not in client.regDict:
+            uidObj = self._uidDict[client.uid]
+            if uidObj.regCount - releaseCount >= self.param.apiMaxRegistrationsPerUid:
+                self._reject(uidObj, "registration", "API client of uid %d rejected, too many registrations." % (client.uid))
+                raise _RpcError(-32001, "too many registrations for uid %d" % (client.uid))
+            uidObj.regCount += 1
+            self.param.mainServer.addConfig(_cfgId(domainName), self._toApacheConfig(data))
+            self.param.avahiObj.add_domain_name(domainName)
         else:
-            self.param.mainServer.updateConfig(cfgId, self._toApacheConfig(data))
-            if data["domain-name"] != self._clientDict[sock]["domain-name"]:
-                self.param.avahiObj.remove_domain_name(self._clientDict[sock]["domain-name"])
-                self.param.avahiObj.add_domain_name(data["domain-name"])
+            self.param.mainServer.updateConfig(_cfgId(domainName), self._toApacheConfig(data))
         logging.info("%s registered." % (self._toDebugStr(data)))
 
         # record data
-        self._clientDict[sock] = data
-        logging.info("URL \"http://%s\" is available for access." % (self._clientDict[sock]["domain-name"]))
+        client.regDict[domainName] = data
+        self._domainDict[domainName] = sock
+        logging.info("URL \"http://%s\" is available for access." % (domainName))
+
+    def _unregister(self, sock, domainName):
+        self.param.mainServer.removeConfig(_cfgId(domainName))
+        self.param.avahiObj.remove_domain_name(domainName)
+        self._uidDict[self._clientDict[sock].uid].regCount -= 1
+        del self._clientDict[sock].regDict[domainName]
+        del self._domainDict[domainName]
 
     def _toDebugStr(self, data):
         tlist = []
         if "http-port" in data:
             tlist.append("http:%d" % (data["http-port"]))
         if "https-port" in data:
-            tlist.append("https:%d" % (data["http-port"]))
+            tlist.append("https:%d" % (data["https-port"]))
+        tlist += data.get("capabilities", [])
+        if "cache" in data:
+            tlist.append("cache")
         return "pserver \"%s,%s\"" % (data["domain-name"], ",".join(tlist))
 
     def _toApacheConfig(self, data):
-        # FIXME: not implemented: https, http2, websocket, multiple-proxypass-directive ordering
-        assert "http-port" in data and "https-port" not in data
+        # FIXME: not implemented: multiple-proxypass-directive ordering
+        # backend is accessed by http if "http-port" exists, since it's on localhost
+        capabilities = data.get("capabilities", [])
+        bTls = "http-port" not in data
+        if not bTls:
+            backend = "127.0.0.1:%d" % (data["http-port"])
+        else:
+            backend = "127.0.0.1:%d" % (data["https-port"])
 
+        pool = dict(self.param.backendPoolDict)
+        pool.update(data.get("backend-pool", dict()))
+        paramStr = "".join([" %s=%s" % (k, _backendPoolParamValue(v)) for k, v in sorted(pool.items())])
+
+        moduleList = ["mod_proxy.so", "mod_proxy_http.so"]
         buf = ''
         buf += 'ServerName %s\n' % (data["domain-name"])
-        buf += 'ProxyPass / "http://127.0.0.1:%d"\n' % (data["http-port"])
-        buf += 'ProxyPassReverse / "http://127.0.0.1:%d"\n' % (data["http-port"])
+        if bTls:
+            # backend certificate is not verified, it's on localhost
+            moduleList.append("mod_ssl.so")
+            buf += 'SSLProxyEngine On\n'
+            buf += 'SSLProxyVerify none\n'
+            buf += 'SSLProxyCheckPeerCN Off\n'
+            buf += 'SSLProxyCheckPeerName Off\n'
+            buf += 'SSLProxyCheckPeerExpire Off\n'
+        if "websocket" in capabilities:
+            # upgrade requests are routed before ProxyPass
+            moduleList += ["mod_rewrite.so", "mod_proxy_wstunnel.so"]
+            buf += 'RewriteEngine On\n'
+            buf += 'RewriteCond %{HTTP:Upgrade} =websocket [NC]\n'
+            buf += 'RewriteRule ^/?(.*) "%s://%s/$1" [P,L]\n' % ("wss" if bTls else "ws", backend)
+        if "http2" in capabilities:
+            moduleList += ["mod_http2.so", "mod_proxy_http2.so"]
+            buf += 'ProxyPass / "%s://%s"%s\n' % ("h2" if bTls else "h2c", backend, paramStr)
+        else:
+            buf += 'ProxyPass / "%s://%s"%s\n' % ("https" if bTls else "http", backend, paramStr)
+        buf += 'ProxyPassReverse / "%s://%s"\n' % ("https" if bTls else "http", backend)
 
-        return {
-            "module-dependencies": [
-                "mod_proxy.so",
-                "mod_proxy_http.so",
-            ],
+        ret = {
+            "module-dependencies": moduleList,
             "config-segment": buf,
+            "domain-name": data["domain-name"],
+            "backend": {
+                "address": "127.0.0.1",
+                "port": data["http-port"] if not bTls else data["https-port"],
+                "tls": bTls,
+                "host": backend,
+                "pool": data.get("backend-pool", dict()),
+            },
         }
+        if "cache" in data:
+            ret["cache"] = data["cache"]
+        return ret
+
+
+class _RpcError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _cfgId(domainName):
+    return "proxy-%s" % (domainName)
+
+
+def _checkBackendPoolParam(key, value):
+    # parameter names are the same as ProxyPass
+    if key == "keepalive":
+        return isinstance(value, bool)
+    if key in ["max", "ttl", "connectiontimeout"]:
+        return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 65536
+    if key == "flushpackets":
+        return value in ["on", "off", "auto"]
+    return False
+
+
+def _backendPoolParamValue(value):
+    if isinstance(value, bool):
+        return "On" if value else "Off"
+    return value
+
+
+def _rpcResultResponse(reqId, result):
+    return {
+        "jsonrpc": "2.0",
+        "result": result,
+        "id": reqId,
+    }
+
+
+def _rpcErrorResponse(reqId, e):
+    return {
+        "jsonrpc": "2.0",
+        "error": {
+            "code": e.code,
+            "message": e.message,
+        },
+        "id": reqId,
+    }
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import logging
+import traceback
+from gi.repository import GLib
+
+
+class PsCacheCleaner:
+
+    """
+    Keep the disk cache of main server (mod_cache_disk) in a global size budget.
+    When the cache is bigger than sizeLimit, entries are removed in the order of the access time of their header file,
+    which is read for every hit, until it's below lowWaterMark of the limit ("oldest-atime" eviction).
+    It's LRU only if the file system is mounted with "strictatime". With the default "relatime" the access time is
+    updated at most once per 24 hours after the first read, so hot entries may be evicted before cold ones, and with
+    "noatime" it's never updated, and the order is the order of insertion. A warning is logged if the cache directory
+    is not mounted with "strictatime".
+    The cache directory is checked periodically in an executor thread, a failed check is logged and retried next time.
+
+    Exampe:
+        obj = PsCacheCleaner(param, "/var/lib/pservers/.cache", 1024 * 1024 * 1024)
+        ...
+        obj.dispose()
+    """
+
+    def __init__(self, param, cacheDir, sizeLimit):
+        self.param = param
+        self.cacheDir = cacheDir
+        self.sizeLimit = sizeLimit
+        self.lowWaterMark = 0.9
+        self.checkInterval = 60
+        self.tmpFileTimeout = 3600          # in seconds, temporary files of unfinished writes are removed after this time
+
+        self.cacheSize = 0                  # in bytes, updated by every check
+        self.entryCount = 0
+        self.evictCount = 0
+        self.failCount = 0
+
+        mountOptionList = _getMountOptionList(self.cacheDir)
+        if "relatime" in mountOptionList or "noatime" in mountOptionList:
+            logging.warning("File system of %s is not mounted with strictatime, disk cache eviction is approximate." % (self.cacheDir))
+
+        self._bStop = False
+        self._checkTask = None
+        self._checkTimer = GLib.timeout_add_seconds(self.checkInterval, self._onCheck)
+
+    def dispose(self):
+        self._bStop = True
+        GLib.source_remove(self._checkTimer)
+        if self._checkTask is not None:
+            self._checkTask.cancel()
+            self._checkTask = None
+
+    def _onCheck(self):
+        # event callback, no exception is allowed
+        try:
+            if self._checkTask is None:
+                self._checkTask = self.param.mainloop.create_task(self._check())
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    async def _check(self):
+        try:
+            await self.param.mainloop.run_in_executor(None, self._clean)
+        except Exception:
+            self.failCount += 1
+            logging.error("Failed to clean cache directory %s." % (self.cacheDir), exc_info=True)
+        finally:
+            self._checkTask = None
+
+    def _clean(self):
+        # runs in executor thread
+        entryList = []          # (atime, size, header-file, data-file)
+        totalSize = 0
+        now = time.time()
+        for root, dirs, files in os.walk(self.cacheDir):
+            for fn in files:
+                fullfn = os.path.join(root, fn)
+                if not fn.endswith(".header"):
+                    if not fn.endswith(".data"):
+                        _removeStaleFile(fullfn, now - self.tmpFileTimeout)
+                    continue
+                dataFn = fullfn[:-len(".header")] + ".data"
+                st = _stat(fullfn)
+                if st is None:
+                    continue
+                size = st.st_size
+                dataSt = _stat(dataFn)
+                if dataSt is not None:
+                    size += dataSt.st_size
+                entryList.append((max(st.st_atime, st.st_mtime), size, fullfn, dataFn))
+                totalSize += size
+
+        self.entryCount = len(entryList)
+        self.cacheSize = totalSize
+        if totalSize <= self.sizeLimit:
+            return
+
+        entryList.sort()
+        target = self.sizeLimit * self.lowWaterMark
+        count = 0
+        for atime, size, headerFn, dataFn in entryList:
+            if totalSize <= target or self._bStop:
+                break
+            # header file is removed first, so that the entry becomes a cache miss
+            _removeFile(headerFn)
+            _removeFile(dataFn)
+            totalSize -= size
+            count += 1
+
+        self.entryCount -= count
+        self.cacheSize = totalSize
+        self.evictCount += count
+        logging.info("Disk cache cleaned, %d entries evicted, %d MiB left." % (count, totalSize // (1024 * 1024)))
+
+
+def _getMountOptionList(path):
+    # returns options of the mount point containing path, empty list if not found
+    path = os.path.realpath(path)
+    ret = []
+    mountPoint = None
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            tlist = line.split()
+            mp = tlist[1].replace("\\040", " ")
+            if path == mp or path.startswith(mp.rstrip("/") + "/"):
+                if mountPoint is None or len(mp) >= len(mountPoint):
+                    mountPoint = mp
+                    ret = tlist[3].split(",")
+    return ret
+
+
+def _stat(filename):
+    try:
+        return os.stat(filename)
+    except FileNotFoundError:
+        return None
+
+
+def _removeFile(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _removeStaleFile(filename, deadline):
+    st = _stat(filename)
+    if st is not None and st.st_mtime < deadline:
+        _removeFile(filename)
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import queue
+import socket
+import logging
+import datetime
+import threading
+import traceback
+from OpenSSL import crypto
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.x509.oid import ExtendedKeyUsageOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import rsa
+from ps_util import PsUtil
+from ps_util import Histogram
+from ps_param import PsConst
+
+
+class PsCertManager:
+
+    """
+    A local certificate authority which issues certificates for the domain names served by main server.
+    The CA and the issued certificates are kept in PsConst.tlsDir and re-used across restarts.
+    The CA is name constrained to ".local", trusting it does not affect other domains.
+    Private keys are pre-generated by a background thread, so issuing a certificate only costs a signature.
+    Certificates needed when mainloop is running are issued in executor threads by getReadyCertAndKeyFile().
+
+    Exampe:
+        obj = PsCertManager(param)
+        certFile, keyFile = obj.getCertAndKeyFile("foobar.local")
+        ret = obj.getReadyCertAndKeyFile("foobar2.local", readyFunc)       # readyFunc(domainName) is called if ret is None
+        ...
+        obj.dispose()
+    """
+
+    caValidDays = 3650
+    certValidDays = 397         # longer validity is rejected by browsers
+    renewDays = 30              # certificate expiring in this period is re-issued
+
+    def __init__(self, param):
+        if param.tlsKeyType not in ["rsa", "ecdsa"]:
+            raise Exception("invalid tls key type %s" % (param.tlsKeyType))
+
+        self.param = param
+        self.issueCount = 0
+        self.keyPoolMissCount = 0       # certificates issued with a key generated in place
+        self.issueDurationHistogram = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1])
+
+        self._certDir = os.path.join(PsConst.tlsDir, "certs")
+        PsUtil.ensureDir(self._certDir)
+        self._caCert, self._caKey = self._loadOrCreateCa()
+        self._caKeyId = self._caCert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value.digest
+        self._fileDict = dict()         # <domain-name,(cert-file,key-file)>, certificates checked in this run
+        self._pendingDict = dict()      # <domain-name,[ready-function]>, certificates being checked in executor threads
+
+        self._keyQueue = queue.Queue(self.param.tlsKeyPoolSize)
+        self._bStop = False
+        self._keyThread = threading.Thread(target=self._generateKeys, daemon=True)
+        self._keyThread.start()
+
+    @property
+    def caCertFile(self):
+        return PsConst.caCertFile
+
+    @property
+    def keyPoolSize(self):
+        return self._keyQueue.qsize()
+
+    def dispose(self):
+        self._bStop = True
+        while not self._keyQueue.empty():
+            self._keyQueue.get_nowait()         # wakes up the key pool thread
+        self._keyThread.join()
+
+    def getDefaultCertAndKeyFile(self):
+        # for clients not sending SNI or sending an unknown name
+        return self.getCertAndKeyFile("%s.local" % (socket.gethostname()))
+
+    def getReadyCertAndKeyFile(self, domainName, readyFunc):
+        # returns None if the certificate is not checked yet, it's checked or issued in an executor thread,
+        # then readyFunc(domainName) is called in mainloop, nothing is called if it fails
+        if domainName in self._fileDict:
+            return self._fileDict[domainName]
+        if domainName not in self._pendingDict:
+            self._pendingDict[domainName] = []
+            future = self.param.mainloop.run_in_executor(None, self.getCertAndKeyFile, domainName)
+            future.add_done_callback(lambda f: self._onCertReady(domainName, f))
+        self._pendingDict[domainName].append(readyFunc)
+        return None
+
+    def getCertAndKeyFile(self, domainName):
+        # may be called in executor threads
+        if domainName not in self._fileDict:
+            certFile = os.path.join(self._certDir, "%s.crt" % (domainName))
+            keyFile = os.path.join(self._certDir, "%s.key" % (domainName))
+            if not self._isCertUsable(certFile, keyFile):
+                self._issue(domainName, certFile, keyFile)
+            self._fileDict[domainName] = (certFile, keyFile)
+        return self._fileDict[domainName]
+
+    def _onCertReady(self, domainName, future):
+        funcList = self._pendingDict.pop(domainName)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.error("Failed to issue certificate for %s, %s." % (domainName, future.exception()))
+            return
+        for func in funcList:
+            try:
+                func(domainName)
+            except Exception:
+                # absorb exception raised by upper layer function
+                traceback.print_exc()
+
+    def _loadOrCreateCa(self):
+        if os.path.exists(PsConst.caCertFile) and os.path.exists(PsConst.caKeyFile):
+            cert, key = _loadCertAndKey(PsConst.caCertFile, PsConst.caKeyFile)
+            if _notValidAfter(cert) > _utcNow() + datetime.timedelta(days=self.renewDays):
+                return (cert, key)
+            logging.warning("Local CA is expiring, re-created.")
+
+        key = _generateKey(self.param.tlsKeyType)
+        name = x509.Name([
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "pservers"),
+            x509.NameAttribute(NameOID.COMMON_NAME, "pservers local CA on %s" % (socket.gethostname())),
+        ])
+        builder = _certBuilder(name, key.public_key(), self.caValidDays)
+        builder = builder.issuer_name(name)
+        builder = builder.add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        builder = builder.add_extension(x509.KeyUsage(digital_signature=False, content_commitment=False, key_encipherment=False,
+                                                      data_encipherment=False, key_agreement=False, key_cert_sign=True,
+                                                      crl_sign=True, encipher_only=False, decipher_only=False), critical=True)
+        builder = builder.add_extension(x509.NameConstraints(permitted_subtrees=[x509.DNSName("local")], excluded_subtrees=None), critical=True)
+        cert = builder.sign(key, hashes.SHA256(), default_backend())
+
+        _dumpCertAndKey(cert, key, PsConst.caCertFile, PsConst.caKeyFile)
+        logging.info("Local CA created, import %s to trust the https URLs." % (PsConst.caCertFile))
+        return (cert, key)
+
+    def _isCertUsable(self, certFile, keyFile):
+        # certificate must be issued by the current CA, not expiring, and of the configured key type
+        try:
+            cert, key = _loadCertAndKey(certFile, keyFile)
+        except (OSError, ValueError, crypto.Error):
+            return False
+        try:
+            keyId = cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier
+        except x509.ExtensionNotFound:
+            return False
+        if keyId != self._caKeyId:
+            return False
+        if _notValidAfter(cert) <= _utcNow() + datetime.timedelta(days=self.renewDays):
+            return False
+        if isinstance(key, ec.EllipticCurvePrivateKey) != (self.param.tlsKeyType == "ecdsa"):
+            return False
+        if _publicKeyBytes(cert.public_key()) != _publicKeyBytes(key.public_key()):
+            return False
+        return True
+
+    def _issue(self, domainName, certFile, keyFile):
+        startTime = time.monotonic()
+        try:
+            key = self._keyQueue.get_nowait()
+        except queue.Empty:
+            key = _generateKey(self.param.tlsKeyType)
+            self.keyPoolMissCount += 1
+
+        builder = _certBuilder(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domainName)]), key.public_key(), self.certValidDays)
+        builder = builder.issuer_name(self._caCert.subject)
+        builder = builder.add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        builder = builder.add_extension(x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=isinstance(key, rsa.RSAPrivateKey),
+                                                      data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                                                      crl_sign=False, encipher_only=False, decipher_only=False), critical=True)
+        builder = builder.add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(domainName)]), critical=False)
+        builder = builder.add_extension(x509.AuthorityKeyIdentifier(self._caKeyId, None, None), critical=False)
+        cert = builder.sign(self._caKey, hashes.SHA256(), default_backend())
+        _dumpCertAndKey(cert, key, certFile, keyFile)
+
+        self.issueCount += 1
+        self.issueDurationHistogram.observe(time.monotonic() - startTime)
+        logging.info("Certificate for %s issued." % (domainName))
+
+    def _generateKeys(self):
+        # key pool thread, key generation in openssl does not hold the GIL
+        while not self._bStop:
+            key = _generateKey(self.param.tlsKeyType)
+            while not self._bStop:
+                try:
+                    self._keyQueue.put(key, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+
+def _generateKey(keyType):
+    if keyType == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    else:
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def _certBuilder(subjectName, publicKey, validDays):
+    # not-before is back-dated for clients with clock skew
+    now = _utcNow()
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(subjectName)
+    builder = builder.public_key(publicKey)
+    builder = builder.serial_number(x509.random_serial_number())
+    builder = builder.not_valid_before(now - datetime.timedelta(days=1))
+    builder = builder.not_valid_after(now + datetime.timedelta(days=validDays))
+    builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(publicKey), critical=False)
+    return builder
+
+
+def _loadCertAndKey(certFile, keyFile):
+    # PsUtil works with pyOpenSSL objects, they're converted to cryptography objects
+    cert, key = PsUtil.loadCertAndKey(certFile, keyFile)
+    return (cert.to_cryptography(), key.to_cryptography_key())
+
+
+def _dumpCertAndKey(cert, key, certFile, keyFile):
+    # a certificate not matching its key after an interrupted write is re-issued
+    PsUtil.dumpCertAndKey(crypto.X509.from_cryptography(cert), crypto.PKey.from_cryptography_key(key), certFile, keyFile)
+
+
+def _publicKeyBytes(publicKey):
+    return publicKey.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def _notValidAfter(cert):
+    # not_valid_after is deprecated by newer cryptography
+    if hasattr(cert, "not_valid_after_utc"):
+        return cert.not_valid_after_utc.replace(tzinfo=None)
+    return cert.not_valid_after
+
+
+def _utcNow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
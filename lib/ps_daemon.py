@@ -10,15 +10,20 @@ import shutil
 import logging
 import asyncio
 import asyncio_glib
+from gi.repository import GLib
 from ps_util import PsUtil
 from ps_util import DropPriviledge
-from ps_util import StdoutRedirector
 from ps_util import AvahiDomainNameRegister
+from ps_log import RotatingLogFile
 from ps_param import PsConst
+from ps_cert import PsCertManager
 from ps_plugin import PsPluginManager
 from ps_server import PsServerManager
 from ps_main_httpd import PsMainHttpServer
+from ps_native_httpd import PsNativeHttpServer
+from ps_activator import PsServerActivator
 from ps_api_server import PsApiServer
+from ps_metrics import PsMetricsServer
 
 
 class PsDaemon:
@@ -31,6 +36,8 @@ class PsDaemon:
         try:
             # create directories
             PsUtil.preparePersistDir(PsConst.varDir, PsConst.uid, PsConst.gid, 0o755)
+            PsUtil.preparePersistDir(PsConst.tlsDir, PsConst.uid, PsConst.gid, 0o700)
+            PsUtil.preparePersistDir(PsConst.cacheDir, PsConst.uid, PsConst.gid, 0o700)
             PsUtil.preparePersistDir(PsConst.logDir, PsConst.uid, PsConst.gid, 0o755)
             PsUtil.prepareTransientDir(PsConst.runDir, PsConst.uid, PsConst.gid, 0o755)
             PsUtil.prepareTransientDir(PsConst.tmpDir, PsConst.uid, PsConst.gid, 0o755)
@@ -38,8 +45,10 @@ class PsDaemon:
             with DropPriviledge(PsConst.uid, PsConst.gid, caps=[prctl.CAP_NET_BIND_SERVICE]):
                 try:
                     # initialize logging
-                    sys.stdout = StdoutRedirector(os.path.join(PsConst.logDir, "pservers.out"))
+                    sys.stdout = RotatingLogFile(os.path.join(PsConst.logDir, "pservers.out"), PsConst.updaterLogFileSize, PsConst.updaterLogFileCount,
+                                                 terminal=sys.stdout)
                     sys.stderr = sys.stdout
+                    logFlushTimer = GLib.timeout_add_seconds(sys.stdout.flushInterval, self._onLogFlush)
 
                     logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
                     logging.getLogger().setLevel(logging.INFO)
@@ -52,25 +61,41 @@ class PsDaemon:
                     # write pid file
                     PsUtil.writePidFile(PsConst.pidFile)
 
+                    # every api client holds a file descriptor
+                    PsUtil.raiseNoFileLimit()
+
                     # plugin manager
                     self.param.pluginManager = PsPluginManager(self.param)
 
                     # load servers
-                    self.serverManager = PsServerManager(self.param)
-                    self.serverManager.loadServers()
+                    self.param.serverManager = PsServerManager(self.param)
+                    self.param.serverManager.loadServers()
                     if len(self.param.serverDict) == 0:
                         raise Exception("no server loaded")
                     logging.info("Servers loaded: %s" % (",".join(sorted(self.param.serverDict.keys()))))
 
+                    # local CA
+                    if self.param.httpsEnabled:
+                        self.param.certManager = PsCertManager(self.param)
+
                     # main server
-                    self.param.mainServer = PsMainHttpServer(self.param)
-                    for serverId, serverObj in self.param.serverDict.items():
+                    if self.param.httpEngine == "apache":
+                        self.param.mainServer = PsMainHttpServer(self.param)
+                    elif self.param.httpEngine == "native":
+                        self.param.mainServer = PsNativeHttpServer(self.param)
+                    else:
+                        raise Exception("invalid http engine %s" % (self.param.httpEngine))
+                    for serverId in self.param.serverDict:
                         if serverId.startswith("proxy-"):
                             raise Exception("invalid server %s" % (serverId))       # "proxy-" prefix is reserved for external servers
-                        cfg = serverObj.startAndGetMainHttpServerConfig()
+                    for serverId, cfg in self.param.serverManager.startServers().items():
                         self.param.mainServer.addConfig(serverId, cfg)
+                    self.param.activator = PsServerActivator(self.param)
                     self.param.mainServer.start()
-                    logging.info("Main server started, listening on port %d." % (PsConst.httpPort))
+                    if self.param.certManager is not None:
+                        logging.info("Main server started, listening on port %d and %d." % (PsConst.httpPort, PsConst.httpsPort))
+                    else:
+                        logging.info("Main server started, listening on port %d." % (PsConst.httpPort))
 
                     # register domain names
                     self.param.avahiObj = AvahiDomainNameRegister()
@@ -84,6 +109,13 @@ class PsDaemon:
                     self.param.apiServer = PsApiServer(self.param)
                     logging.info("API server started, socket file %s." % (PsConst.apiServerFile))
 
+                    # start metrics server
+                    self.param.metricsServer = PsMetricsServer(self.param)
+                    logging.info("Metrics server started, socket file %s." % (PsConst.metricsFile))
+
+                    # watch server files
+                    self.param.serverManager.startWatch()
+
                     # start main loop
                     logging.info("Mainloop begins.")
                     self.param.mainloop.add_signal_handler(signal.SIGINT, self._sigHandlerINT)
@@ -91,13 +123,30 @@ class PsDaemon:
                     self.param.mainloop.run_forever()
                     logging.info("Mainloop exits.")
                 finally:
+                    if self.param.metricsServer is not None:
+                        self.param.metricsServer.dispose()
+                    if self.param.serverManager is not None:
+                        self.param.serverManager.stopWatch()
                     if self.param.apiServer is not None:
                         self.param.apiServer.dispose()
                     if self.param.avahiObj is not None:
                         self.param.avahiObj.stop()
+                    if self.param.activator is not None:
+                        self.param.activator.dispose()
                     if self.param.mainServer is not None:
                         self.param.mainServer.stop()
+                    if self.param.serverManager is not None:
+                        self.param.serverManager.stopServers()
+                    if self.param.certManager is not None:
+                        self.param.certManager.dispose()
+                    if self.param.pluginManager is not None:
+                        self.param.pluginManager.dispose()
                     logging.shutdown()
+                    if isinstance(sys.stdout, RotatingLogFile):
+                        GLib.source_remove(logFlushTimer)
+                        sys.stdout.close()
+                        sys.stdout = sys.stdout.terminal
+                        sys.stderr = sys.__stderr__
         finally:
             shutil.rmtree(PsConst.tmpDir)
             shutil.rmtree(PsConst.runDir)
@@ -113,6 +162,81 @@ class PsDaemon:
         dataObj = json.loads(buf)
         if "listenIp" in dataObj:
             self.param.listenIp = dataObj["listenIp"]
+        if "httpEngine" in dataObj:
+            self.param.httpEngine = dataObj["httpEngine"]
+        if "httpsEnabled" in dataObj:
+            self.param.httpsEnabled = dataObj["httpsEnabled"]
+        if "tlsKeyType" in dataObj:
+            self.param.tlsKeyType = dataObj["tlsKeyType"]
+        if "tlsKeyPoolSize" in dataObj:
+            self.param.tlsKeyPoolSize = dataObj["tlsKeyPoolSize"]
+        if "tlsSessionCacheSize" in dataObj:
+            self.param.tlsSessionCacheSize = dataObj["tlsSessionCacheSize"]
+        if "http2Enabled" in dataObj:
+            self.param.http2Enabled = dataObj["http2Enabled"]
+        if "staticMaxAge" in dataObj:
+            self.param.staticMaxAge = dataObj["staticMaxAge"]
+        if "cacheSizeLimit" in dataObj:
+            self.param.cacheSizeLimit = dataObj["cacheSizeLimit"]
+        if "httpdTuning" in dataObj:
+            try:
+                PsMainHttpServer.checkTuning(dataObj["httpdTuning"])
+            except Exception as e:
+                raise Exception("invalid httpdTuning in %s, %s" % (PsConst.mainCfgFile, e))
+            self.param.httpdTuningDict = dataObj["httpdTuning"]
+        if "reloadBatchWindow" in dataObj:
+            self.param.reloadBatchWindow = dataObj["reloadBatchWindow"]
+        if "reloadMaxLatency" in dataObj:
+            self.param.reloadMaxLatency = dataObj["reloadMaxLatency"]
+        for key in ["reloadBatchWindow", "reloadMaxLatency"]:
+            value = getattr(self.param, key)
+            if not (isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0):
+                raise Exception("invalid %s %s in %s" % (key, value, PsConst.mainCfgFile))
+        if self.param.reloadBatchWindow > self.param.reloadMaxLatency:
+            raise Exception("reloadBatchWindow must not be greater than reloadMaxLatency in %s" % (PsConst.mainCfgFile))
+        if "serverStartWorkers" in dataObj:
+            self.param.serverStartWorkers = dataObj["serverStartWorkers"]
+        if "serverStartTimeout" in dataObj:
+            self.param.serverStartTimeout = dataObj["serverStartTimeout"]
+        if "serverStopTimeout" in dataObj:
+            self.param.serverStopTimeout = dataObj["serverStopTimeout"]
+        if "pluginWorkerRlimits" in dataObj:
+            self.param.pluginWorkerRlimitDict = dataObj["pluginWorkerRlimits"]
+        if "backendPool" in dataObj:
+            try:
+                PsApiServer.checkBackendPool(dataObj["backendPool"])
+            except Exception as e:
+                raise Exception("invalid backendPool in %s, %s" % (PsConst.mainCfgFile, e))
+            self.param.backendPoolDict.update(dataObj["backendPool"])
+        if "apiNotifyRate" in dataObj:
+            self.param.apiNotifyRate = dataObj["apiNotifyRate"]
+        if "apiNotifyBurst" in dataObj:
+            self.param.apiNotifyBurst = dataObj["apiNotifyBurst"]
+        if "apiMaxConnectionsPerUid" in dataObj:
+            self.param.apiMaxConnectionsPerUid = dataObj["apiMaxConnectionsPerUid"]
+        if "apiMaxRegistrationsPerUid" in dataObj:
+            self.param.apiMaxRegistrationsPerUid = dataObj["apiMaxRegistrationsPerUid"]
+
+        # booleans
+        for key in ["httpsEnabled", "http2Enabled"]:
+            value = getattr(self.param, key)
+            if not isinstance(value, bool):
+                raise Exception("invalid %s %s in %s" % (key, value, PsConst.mainCfgFile))
+        # integers with minimum value
+        for key, minValue in [("tlsKeyPoolSize", 1), ("tlsSessionCacheSize", 1), ("staticMaxAge", 0), ("cacheSizeLimit", 1),
+                              ("serverStartWorkers", 1), ("apiNotifyBurst", 1), ("apiMaxConnectionsPerUid", 1), ("apiMaxRegistrationsPerUid", 1)]:
+            value = getattr(self.param, key)
+            if not (isinstance(value, int) and not isinstance(value, bool) and value >= minValue):
+                raise Exception("invalid %s %s in %s" % (key, value, PsConst.mainCfgFile))
+        # positive numbers
+        for key in ["serverStartTimeout", "serverStopTimeout", "apiNotifyRate"]:
+            value = getattr(self.param, key)
+            if not (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+                raise Exception("invalid %s %s in %s" % (key, value, PsConst.mainCfgFile))
+
+    def _onLogFlush(self):
+        sys.stdout.flushBuffer()
+        return True
 
     def _sigHandlerINT(self):
         logging.info("SIGINT received.")
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# This module is also used as a piped log program of the main http server:
+#   ps_log.py <filename> <max-size> <count>
+# Data read from stdin is written to the log file.
+# It has no dependency other than python standard library, so that it's started fast.
+
+import os
+import sys
+import time
+import signal
+import select
+import threading
+
+
+class RotatingLogFile:
+
+    """
+    Log file with buffered writes and size based rotation.
+    Buffered data is written when the buffer is full or has been kept for flushInterval seconds, there's no fsync.
+    flush() doesn't write the buffer, since logging.StreamHandler calls it for every record, flushBuffer() does.
+    When the file would exceed maxSize, <filename> is renamed to <filename>.1, <filename>.1 to <filename>.2, ...,
+    at most <count> old files are kept.
+    Data written as str is also copied to terminal if it's specified, so the object can be used as sys.stdout.
+
+    Exampe:
+        obj = RotatingLogFile("/var/log/foobar.log", 10 * 1024 * 1024, 2)
+        obj.write("message\n")
+        ...
+        obj.flushBuffer()           # should be called periodically, data buffered is not written in idle time
+        obj.close()
+    """
+
+    def __init__(self, filename, maxSize, count, flushInterval=1, bufferSize=65536, terminal=None):
+        self.filename = filename
+        self.maxSize = maxSize
+        self.count = count
+        self.flushInterval = flushInterval
+        self.bufferSize = bufferSize
+        self.terminal = terminal
+
+        self._lock = threading.Lock()       # it's written by executor threads when used as sys.stdout
+        self._buf = bytearray()
+        self._bufTime = None                # when the buffer becomes non-empty
+        self._f = open(self.filename, "ab")
+        self._size = self._f.tell()
+
+    def write(self, data):
+        if isinstance(data, str):
+            if self.terminal is not None:
+                self.terminal.write(data)
+            data = data.encode("utf-8", "replace")
+        with self._lock:
+            if len(self._buf) == 0:
+                self._bufTime = time.monotonic()
+            self._buf += data
+            if len(self._buf) >= self.bufferSize or time.monotonic() - self._bufTime >= self.flushInterval:
+                self._flush()
+        return len(data)
+
+    def flush(self):
+        if self.terminal is not None:
+            self.terminal.flush()
+
+    def flushBuffer(self):
+        if self.terminal is not None:
+            self.terminal.flush()
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._flush()
+                self._f.close()
+                self._f = None
+
+    def _flush(self):
+        if len(self._buf) == 0 or self._f is None:
+            return
+        if self._size > 0 and self._size + len(self._buf) > self.maxSize:
+            self._rotate()
+        self._f.write(self._buf)
+        self._f.flush()
+        self._size += len(self._buf)
+        self._buf.clear()
+
+    def _rotate(self):
+        self._f.close()
+        if self.count > 0:
+            for i in range(self.count - 1, 0, -1):
+                fn = "%s.%d" % (self.filename, i)
+                if os.path.exists(fn):
+                    os.rename(fn, "%s.%d" % (self.filename, i + 1))
+            os.rename(self.filename, self.filename + ".1")
+            self._f = open(self.filename, "ab")
+        else:
+            self._f = open(self.filename, "wb")
+        self._size = 0
+
+
+def main():
+    logFile = RotatingLogFile(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        fd = sys.stdin.fileno()
+        while True:
+            if select.select([fd], [], [], logFile.flushInterval)[0] == []:
+                logFile.flushBuffer()
+                continue
+            buf = os.read(fd, logFile.bufferSize)
+            if buf == b'':
+                break
+            logFile.write(buf)
+    finally:
+        logFile.close()
+
+
+if __name__ == "__main__":
+    main()
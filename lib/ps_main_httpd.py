@@ -3,10 +3,20 @@
 
 import os
 import re
+import math
+import sys
+import time
 import signal
+import hashlib
+import logging
 import subprocess
 from ps_util import PsUtil
+from ps_util import Histogram
+from ps_util import BatchScheduler
 from ps_param import PsConst
+from ps_access_log import PsAccessLogAnalyzer
+from ps_static import PsStaticCompressor
+from ps_cache import PsCacheCleaner
 
 
 class PsMainHttpServer:
@@ -15,48 +25,136 @@ class PsMainHttpServer:
         self.param = param
         self._rootDir = os.path.join(PsConst.tmpDir, "httpd.root")
         self._cfgFn = os.path.join(PsConst.tmpDir, "httpd.conf")
+        self._cfgFragmentDir = os.path.join(PsConst.tmpDir, "httpd.conf.d")
         self._pidFile = os.path.join(PsConst.tmpDir, "httpd.pid")
+        self._sessionCacheFile = os.path.join(PsConst.tmpDir, "httpd.ssl_scache")
+        self._cacheLockDir = os.path.join(PsConst.tmpDir, "httpd.cache-lock")
         self._errorLogFile = os.path.join(PsConst.logDir, "httpd-error.log")
         self._accessLogFile = os.path.join(PsConst.logDir, "httpd-access.log")
 
         self._cfgDict = dict()      # <cfg-id,cfg>
         self._proc = None
+        self.tuningDict = _calcTuning(os.cpu_count(), os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"), _getSomaxconn(), self.param.httpdTuningDict)
+        self.accessLogAnalyzer = None
+        self.staticCompressor = None
+        self.cacheCleaner = None
+
+        # every cfg-id is rendered to its own fragment file, only changed fragments are re-written
+        self._cfgHash = None
+        self._fragmentHashDict = dict()     # <cfg-id,hash>, hash of the live fragment file
+        self._dirtyFragmentDict = dict()    # <cfg-id,fragment>, fragment is None when the file should be removed
+
+        # apache reload is batched, every reload restarts all the workers
+        self._reloadScheduler = BatchScheduler(self.param.reloadBatchWindow, self.param.reloadMaxLatency, self._reload)
+        self.reloadCount = 0
+        self.reloadChangeCountList = []     # number of changes absorbed by each reload, only the latest ones are kept
+        self.reloadDelayHistogram = Histogram([0.1, 0.5, 1, 2, 3, 5, 10])                  # seconds from the first change to reload
+        self.reloadDurationHistogram = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1])   # seconds used to write config and signal apache
+
+    @staticmethod
+    def checkCachePolicy(policy):
+        # cache policy of a virtual host, parameters not specified have default values in _cachePolicyDefaultDict
+        if not isinstance(policy, dict):
+            raise Exception("cache policy must be a json object")
+        for k, v in policy.items():
+            if k not in _cachePolicyDefaultDict:
+                raise Exception("invalid cache policy parameter \"%s\"" % (k))
+            if not isinstance(v, int) or isinstance(v, bool) or v <= 0:
+                raise Exception("invalid value of cache policy parameter \"%s\"" % (k))
+
+    @staticmethod
+    def checkTuning(tuningDict):
+        # tuning directives overriding auto-sized values, see _calcTuning()
+        if not isinstance(tuningDict, dict):
+            raise Exception("httpd tuning must be a json object")
+        for k, v in tuningDict.items():
+            if k not in _tuningGlobalDirectiveList + _tuningMpmDirectiveList:
+                raise Exception("invalid httpd tuning directive %s" % (k))
+            if k == "KeepAlive":
+                if v not in ["On", "Off"]:
+                    raise Exception("invalid value of httpd tuning directive %s" % (k))
+            elif k == "MaxConnectionsPerChild":
+                if not isinstance(v, int) or isinstance(v, bool) or v < 0:          # 0 means unlimited
+                    raise Exception("invalid value of httpd tuning directive %s" % (k))
+            else:
+                if not isinstance(v, int) or isinstance(v, bool) or v <= 0:
+                    raise Exception("invalid value of httpd tuning directive %s" % (k))
+
+    def isConfigSupported(self, cfg):
+        return True
+
+    @property
+    def configCount(self):
+        return len(self._cfgDict)
 
     def addConfig(self, cfgId, cfg):
         assert cfgId not in self._cfgDict
         self._cfgDict[cfgId] = cfg
-        self._refresh()
+        self._refresh([cfgId])
 
     def updateConfig(self, cfgId, cfg):
         self._cfgDict[cfgId] = cfg
-        self._refresh()
+        self._refresh([cfgId])
 
     def removeConfig(self, cfgId):
         del self._cfgDict[cfgId]
-        self._refresh()
+        self._refresh([cfgId])
 
     def batchRemoveConfig(self, cfgIdList):
+        cfgIdList = list(cfgIdList)
         for cfgId in cfgIdList:
             del self._cfgDict[cfgId]
-        self._refresh()
+        self._refresh(cfgIdList)
+
+    def getStaticDirList(self):
+        ret = []
+        for cfg in self._cfgDict.values():
+            ret += cfg.get("static-directories", dict()).values()
+        return ret
+
+    def flushReload(self):
+        # apply pending changes immediately
+        self._reloadScheduler.flush()
 
     def start(self):
         assert self._proc is None
+        if self.param.certManager is not None:
+            # mainloop is not serving yet, certificates are prepared here so that apache starts with all of them
+            for cfg in self._cfgDict.values():
+                if "domain-name" in cfg:
+                    self.param.certManager.getCertAndKeyFile(cfg["domain-name"])
+        self._cfgHash = None
+        self._fragmentHashDict = dict()
+        self._dirtyFragmentDict = {k: self._renderFragment(v) for k, v in self._cfgDict.items()}
+        PsUtil.mkDirAndClear(self._cfgFragmentDir)
         self._generateCfgFn()
         PsUtil.ensureDir(self._rootDir)
+        logging.info("Main server tuning: %s." % (", ".join(["%s=%s" % (k, v) for k, v in self.tuningDict.items()])))
         self._proc = subprocess.Popen(["/usr/sbin/apache2", "-f", self._cfgFn, "-DFOREGROUND"])
-        PsUtil.waitSocketPortForProc("tcp", self.param.listenIp, PsConst.httpPort, self._proc)
+        self.param.mainloop.run_until_complete(PsUtil.waitSocketPortForProcAsync("tcp", self.param.listenIp, PsConst.httpPort, self._proc))
+        self.accessLogAnalyzer = PsAccessLogAnalyzer(self._accessLogFile)
+        self.staticCompressor = PsStaticCompressor(self.param, self.getStaticDirList)
+        self.cacheCleaner = PsCacheCleaner(self.param, PsConst.cacheDir, self.param.cacheSizeLimit)
 
     def stop(self):
+        self._reloadScheduler.cancel()
+        if self.cacheCleaner is not None:
+            self.cacheCleaner.dispose()
+            self.cacheCleaner = None
+        if self.staticCompressor is not None:
+            self.staticCompressor.dispose()
+            self.staticCompressor = None
+        if self.accessLogAnalyzer is not None:
+            self.accessLogAnalyzer.dispose()
+            self.accessLogAnalyzer = None
         if self._proc is not None:
             self._proc.terminate()
             self._proc.wait()
             self._proc = None
+        PsUtil.forceDelete(self._cfgFragmentDir)
         PsUtil.forceDelete(self._rootDir)
 
-    def _generateCfgFn(self):
-        modulesDir = "/usr/lib64/apache2/modules"
-
+    def _getModuleDict(self):
         moduleDict = {
             "log_config_module": "mod_log_config.so",
             "unixd_module": "mod_unixd.so",
@@ -64,6 +162,18 @@ class PsMainHttpServer:
             "authz_core_module": "mod_authz_core.so",       # it's strange why we need this module and Require directive since we have no auth at all
             "autoindex_module": "mod_autoindex.so",
         }
+        if self.param.certManager is not None:
+            moduleDict["ssl_module"] = "mod_ssl.so"
+            moduleDict["socache_shmcb_module"] = "mod_socache_shmcb.so"
+            if self.param.http2Enabled:
+                moduleDict["http2_module"] = "mod_http2.so"
+        if any(["static-directories" in x for x in self._cfgDict.values()]):
+            moduleDict["mime_module"] = "mod_mime.so"
+            moduleDict["rewrite_module"] = "mod_rewrite.so"
+            moduleDict["headers_module"] = "mod_headers.so"
+        if self._isCacheUsed():
+            moduleDict["cache_module"] = "mod_cache.so"
+            moduleDict["cache_disk_module"] = "mod_cache_disk.so"
         for cfg in self._cfgDict.values():
             for md in cfg["module-dependencies"]:
                 m = re.fullmatch("mod_(.*)\\.so", md)
@@ -72,17 +182,45 @@ class PsMainHttpServer:
                     moduleDict[k] = md
                 else:
                     assert moduleDict[k] == md
+        return moduleDict
+
+    def _renderCfg(self):
+        modulesDir = "/usr/lib64/apache2/modules"
 
         buf = ""
-        for k, v in moduleDict.items():
+        for k, v in self._getModuleDict().items():
             buf += "LoadModule %s %s\n" % (k, os.path.join(modulesDir, v))
         buf += "\n"
         buf += 'PidFile "%s"\n' % (self._pidFile)
-        buf += 'ErrorLog "%s"\n' % (self._errorLogFile)
-        buf += r'LogFormat "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"" common' + "\n"
-        buf += 'CustomLog "%s" common\n' % (self._accessLogFile)
+        buf += 'ErrorLog "%s"\n' % (_pipedLogProgram(self._errorLogFile))
+        # fields used by access log analyzer come first, X-Cache header is added by mod_cache in virtual hosts with cache policy
+        # GlobalLog is not disabled by CustomLog in virtual host
+        buf += r'LogFormat "%v %>s %B %D %{X-Cache}o %h %l %u %t \"%r\" \"%{Referer}i\" \"%{User-Agent}i\"" pservers' + "\n"
+        buf += 'GlobalLog "%s" pservers\n' % (_pipedLogProgram(self._accessLogFile))
         buf += "\n"
         buf += "Listen %d http\n" % (PsConst.httpPort)
+        if self.param.certManager is not None:
+            buf += "Listen %d https\n" % (PsConst.httpsPort)
+        buf += "\n"
+        for k in _tuningGlobalDirectiveList:
+            buf += "%s %s\n" % (k, self.tuningDict[k])
+        buf += "<IfModule mpm_event_module>\n"
+        for k in _tuningMpmDirectiveList:
+            buf += "    %s %s\n" % (k, self.tuningDict[k])
+        buf += "</IfModule>\n"
+        buf += "\n"
+        if self._isCacheUsed():
+            # one cache directory for all the virtual hosts, so that its size is bounded globally by PsCacheCleaner
+            # concurrent misses of the same url are sent to backend only once
+            buf += 'CacheRoot "%s"\n' % (PsConst.cacheDir)
+            buf += 'CacheDirLevels 2\n'
+            buf += 'CacheDirLength 1\n'
+            buf += 'CacheLock On\n'
+            buf += 'CacheLockPath "%s"\n' % (self._cacheLockDir)
+            buf += "\n"
+        buf += "<IfModule mime_module>\n"
+        buf += '    TypesConfig "/etc/mime.types"\n'
+        buf += "</IfModule>\n"
         buf += "\n"
         buf += "ServerName none\n"                          # dummy value
         buf += 'DocumentRoot "%s"\n' % (self._rootDir)
@@ -91,21 +229,214 @@ class PsMainHttpServer:
         buf += '    Require all granted\n'
         buf += '</Directory>\n'
         buf += "\n"
-        for cfg in self._cfgDict.values():
-            buf += '<VirtualHost *>\n'
-            for line in cfg["config-segment"].split("\n"):
-                if line == "":
-                    continue
-                buf += '    %s\n' % (line)
+        if self.param.certManager is not None:
+            # one session cache in shared memory for all the virtual hosts and worker processes, so that handshakes are resumed
+            # http/2 is negotiated by ALPN, so it's only used on https port
+            buf += 'SSLSessionCache "shmcb:%s(%d)"\n' % (self._sessionCacheFile, self.param.tlsSessionCacheSize)
+            buf += 'SSLSessionCacheTimeout 300\n'
+            buf += 'SSLUseStapling Off\n'
+            if self.param.http2Enabled:
+                buf += 'Protocols h2 http/1.1\n'
+            buf += "\n"
+            # the first virtual host on https port serves clients without SNI or with an unknown name
+            certFile, keyFile = self.param.certManager.getDefaultCertAndKeyFile()
+            buf += '<VirtualHost *:%d>\n' % (PsConst.httpsPort)
+            buf += '    SSLEngine on\n'
+            buf += '    SSLCertificateFile "%s"\n' % (certFile)
+            buf += '    SSLCertificateKeyFile "%s"\n' % (keyFile)
             buf += '</VirtualHost>\n'
             buf += "\n"
-        with open(self._cfgFn, "w") as f:
-            f.write(buf)
+        buf += 'IncludeOptional "%s"\n' % (os.path.join(self._cfgFragmentDir, "*.conf"))
+        return buf
 
-    def _refresh(self):
-        if self._proc is not None:
-            self._generateCfgFn()
-            os.kill(self._proc.pid, signal.SIGUSR1)
+    def _renderFragment(self, cfg):
+        # the same config is served on https port if the domain name is known, certificate is selected by SNI
+        # the https virtual host is added when the certificate is ready, it's not issued in mainloop
+        buf = self._renderVirtualHost(PsConst.httpPort, [], cfg)
+        ret = None
+        if self.param.certManager is not None and "domain-name" in cfg:
+            ret = self.param.certManager.getReadyCertAndKeyFile(cfg["domain-name"], self._onCertReady)
+        if ret is not None:
+            certFile, keyFile = ret
+            tlsLineList = [
+                'SSLEngine on',
+                'SSLCertificateFile "%s"' % (certFile),
+                'SSLCertificateKeyFile "%s"' % (keyFile),
+            ]
+            buf += self._renderVirtualHost(PsConst.httpsPort, tlsLineList, cfg)
+        return buf
+
+    def _onCertReady(self, domainName):
+        self._refresh([k for k, v in self._cfgDict.items() if v.get("domain-name") == domainName])
+
+    def _renderVirtualHost(self, port, lineList, cfg):
+        buf = '<VirtualHost *:%d>\n' % (port)
+        for line in lineList:
+            buf += '    %s\n' % (line)
+        if "activity-log-file" in cfg:
+            buf += '    CustomLog "%s" "%%t"\n' % (cfg["activity-log-file"])
+        for line in cfg["config-segment"].split("\n"):
+            if line == "":
+                continue
+            buf += '    %s\n' % (line)
+        if "cache" in cfg:
+            policy = dict(_cachePolicyDefaultDict)
+            policy.update(cfg["cache"])
+            buf += '    CacheEnable disk /\n'
+            buf += '    CacheHeader On\n'
+            buf += '    CacheDefaultExpire %d\n' % (policy["default-expire"])
+            buf += '    CacheMaxExpire %d\n' % (policy["max-expire"])
+            buf += '    CacheMaxFileSize %d\n' % (policy["max-file-size"])
+        for urlPath, dirPath in sorted(cfg.get("static-directories", dict()).items(), reverse=True):       # Alias matches the longer url path first
+            for line in self._renderStaticDirectory(urlPath, dirPath):
+                buf += '    %s\n' % (line)
+        buf += '</VirtualHost>\n'
+        return buf
+
+    def _renderStaticDirectory(self, urlPath, dirPath):
+        # files are sent by sendfile with validators, pre-compressed siblings written by PsStaticCompressor are sent if client accepts
+        # mod_mime takes "foo.css.gz" as text/css with gzip encoding
+        urlPath = urlPath.rstrip("/") + "/"
+        dirPath = dirPath.rstrip("/") + "/"
+        return [
+            'Alias "%s" "%s"' % (urlPath, dirPath),
+            '<Directory "%s">' % (dirPath),
+            '    Require all granted',
+            '    EnableSendfile On',
+            '    EnableMMAP On',
+            '    FileETag MTime Size',
+            '    Header set Cache-Control "public, max-age=%d"' % (self.param.staticMaxAge),
+            '    Header merge Vary Accept-Encoding',
+            '    AddEncoding gzip .gz',
+            '    AddEncoding br .br',
+            '    RewriteEngine On',
+            '    RewriteBase "%s"' % (urlPath),
+            '    RewriteCond "%{HTTP:Accept-Encoding}" "\\bbr\\b"',
+            '    RewriteCond "%{REQUEST_FILENAME}.br" -s',
+            '    RewriteRule "^(.+)$" "$1.br" [END]',
+            '    RewriteCond "%{HTTP:Accept-Encoding}" "\\bgzip\\b"',
+            '    RewriteCond "%{REQUEST_FILENAME}.gz" -s',
+            '    RewriteRule "^(.+)$" "$1.gz" [END]',
+            '</Directory>',
+        ]
+
+    def _isCacheUsed(self):
+        return any(["cache" in x for x in self._cfgDict.values()])
+
+    def _generateCfgFn(self):
+        # returns True if any file is changed
+        bChanged = False
+
+        for cfgId, buf in self._dirtyFragmentDict.items():
+            fn = os.path.join(self._cfgFragmentDir, "%s.conf" % (cfgId))
+            if buf is None:
+                PsUtil.forceDelete(fn)
+                del self._fragmentHashDict[cfgId]
+            else:
+                PsUtil.atomicWriteFile(fn, buf)
+                self._fragmentHashDict[cfgId] = _hash(buf)
+            bChanged = True
+        self._dirtyFragmentDict.clear()
+
+        buf = self._renderCfg()
+        if _hash(buf) != self._cfgHash:
+            PsUtil.atomicWriteFile(self._cfgFn, buf)
+            self._cfgHash = _hash(buf)
+            bChanged = True
+
+        return bChanged
+
+    def _refresh(self, cfgIdList):
+        for cfgId in cfgIdList:
+            if cfgId in self._cfgDict:
+                buf = self._renderFragment(self._cfgDict[cfgId])
+                if _hash(buf) != self._fragmentHashDict.get(cfgId):
+                    self._dirtyFragmentDict[cfgId] = buf
+                else:
+                    self._dirtyFragmentDict.pop(cfgId, None)          # rendered content is the same as the live one
+            else:
+                if cfgId in self._fragmentHashDict:
+                    self._dirtyFragmentDict[cfgId] = None
+                else:
+                    self._dirtyFragmentDict.pop(cfgId, None)          # added and removed before being written
+
+        if self._proc is not None and len(self._dirtyFragmentDict) > 0:
+            self._reloadScheduler.schedule()
+
+    def _reload(self, changeCount):
+        if self._proc is None:
+            return
+        startTime = time.monotonic()
+        if not self._generateCfgFn():
+            logging.info("Main server reload skipped, %d change(s) absorbed but nothing changed." % (changeCount))
+            return
+        os.kill(self._proc.pid, signal.SIGUSR1)
+
+        self.reloadCount += 1
+        self.reloadDelayHistogram.observe(self._reloadScheduler.lastDelay)
+        self.reloadDurationHistogram.observe(time.monotonic() - startTime)
+        self.reloadChangeCountList.append(changeCount)
+        del self.reloadChangeCountList[:-100]
+        logging.info("Main server reloaded, %d change(s) absorbed." % (changeCount))
+
+
+_cachePolicyDefaultDict = {
+    "default-expire": 3600,             # in seconds, for responses without expiry time
+    "max-expire": 86400,                # in seconds
+    "max-file-size": 1000000,           # in bytes, bigger responses are not cached
+}
+
+_tuningGlobalDirectiveList = ["Timeout", "KeepAlive", "KeepAliveTimeout", "MaxKeepAliveRequests", "ListenBacklog"]
+
+_tuningMpmDirectiveList = ["StartServers", "ServerLimit", "ThreadLimit", "ThreadsPerChild", "MaxRequestWorkers",
+                           "MinSpareThreads", "MaxSpareThreads", "AsyncRequestWorkerFactor", "MaxConnectionsPerChild"]
+
+
+def _calcTuning(cpuCount, memSize, somaxconn, overrideDict):
+    # returns <directive,value>, values not overridden are sized from cpu count and memory size
+    # every request worker is a thread, it costs about 2MiB memory when proxying, a quarter of memory is used at most
+    # overrideDict is checked by PsMainHttpServer.checkTuning()
+    ret = dict()
+
+    def _set(k, v):
+        ret[k] = overrideDict.get(k, v)
+
+    _set("Timeout", 60)
+    _set("KeepAlive", "On")
+    _set("KeepAliveTimeout", 5)
+    _set("MaxKeepAliveRequests", 1000)
+    _set("ListenBacklog", min(somaxconn, 4096))
+
+    _set("ThreadsPerChild", 25 if cpuCount <= 8 else 64)       # fewer processes on big machines
+    tpc = ret["ThreadsPerChild"]
+    memLimit = memSize // 4 // (2 * 1024 * 1024)
+    _set("MaxRequestWorkers", max(tpc, min(cpuCount * 150, memLimit) // tpc * tpc))
+    _set("ServerLimit", math.ceil(ret["MaxRequestWorkers"] / tpc))
+    _set("ThreadLimit", tpc)
+    _set("StartServers", min(ret["ServerLimit"], 2))
+    _set("MinSpareThreads", min(ret["MaxRequestWorkers"], tpc))
+    _set("MaxSpareThreads", min(ret["MaxRequestWorkers"], ret["MinSpareThreads"] + tpc * max(2, cpuCount)))
+    _set("AsyncRequestWorkerFactor", 2)
+    _set("MaxConnectionsPerChild", 0)
+
+    return {k: ret[k] for k in _tuningGlobalDirectiveList + _tuningMpmDirectiveList}
+
+
+def _getSomaxconn():
+    try:
+        return int(PsUtil.readFile("/proc/sys/net/core/somaxconn"))
+    except (OSError, ValueError):
+        return 128
+
+
+def _hash(buf):
+    return hashlib.sha1(buf.encode("utf-8")).hexdigest()
+
+
+def _pipedLogProgram(filename):
+    # log files are written by our own program, which does buffering and rotation
+    program = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ps_log.py")
+    return "||%s %s %s %d %d" % (sys.executable, program, filename, PsConst.updaterLogFileSize, PsConst.updaterLogFileCount)
 
 
 def _checkNameAndRealPath(dictObj, name, realPath):
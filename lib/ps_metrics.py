@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import asyncio
+import logging
+from gi.repository import GLib
+from ps_util import Histogram
+from ps_param import PsConst
+from ps_native_httpd import PsNativeHttpServer
+
+
+class PsMetricsServer:
+
+    """
+    Metrics of the daemon in prometheus text format, served by http on a unix domain socket.
+    Every object keeps its own counters and histograms, they are only collected and rendered when scraped.
+
+    Exampe:
+        curl --unix-socket /run/pservers/metrics.socket http://localhost/metrics
+    """
+
+    def __init__(self, param):
+        self.param = param
+        self.requestTimeout = 10
+        self.lagCheckInterval = 1
+
+        # mainloop lag is how late a periodic timer is dispatched
+        self.mainloopLag = 0
+        self.mainloopLagHistogram = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
+        self._lagCheckTime = time.monotonic() + self.lagCheckInterval
+        self._lagCheckTimer = GLib.timeout_add(int(self.lagCheckInterval * 1000), self._onLagCheck)
+
+        self._loop = asyncio.get_event_loop()
+        coro = asyncio.start_unix_server(self._onClientConnected, path=PsConst.metricsFile)
+        self._server = self._loop.run_until_complete(coro)
+
+    def dispose(self):
+        self._server.close()
+        GLib.source_remove(self._lagCheckTimer)
+
+    def render(self):
+        w = _Writer()
+
+        w.header("pservers_mainloop_lag_seconds", "histogram", "Delay of mainloop timer dispatching.")
+        w.histogram("pservers_mainloop_lag_seconds", self.mainloopLagHistogram)
+        w.header("pservers_mainloop_last_lag_seconds", "gauge", "Delay of the last mainloop timer dispatching.")
+        w.sample("pservers_mainloop_last_lag_seconds", self.mainloopLag)
+
+        obj = self.param.mainServer
+        if obj is not None:
+            w.header("pservers_vhosts", "gauge", "Virtual hosts of the main http server.")
+            w.sample("pservers_vhosts", obj.configCount)
+            if isinstance(obj, PsNativeHttpServer):
+                w.header("pservers_route_updates_total", "counter", "Routing table updates of the native main server.")
+                w.sample("pservers_route_updates_total", obj.routeUpdateCount)
+                w.header("pservers_native_requests_total", "counter", "Requests received by the native main server.")
+                w.sample("pservers_native_requests_total", obj.requestCount)
+                w.header("pservers_native_client_connections", "gauge", "Client connections of the native main server.")
+                w.sample("pservers_native_client_connections", obj.clientConnectionCount)
+                w.header("pservers_native_backend_idle_connections", "gauge", "Pooled idle backend connections of the native main server.")
+                w.sample("pservers_native_backend_idle_connections", obj.idleBackendConnectionCount)
+                w.header("pservers_native_backend_connects_total", "counter", "Backend connections opened by the native main server.")
+                w.sample("pservers_native_backend_connects_total", obj.backendConnectCount)
+                w.header("pservers_native_backend_errors_total", "counter", "Failed backend accesses of the native main server.")
+                w.sample("pservers_native_backend_errors_total", obj.backendErrorCount)
+            else:
+                w.header("pservers_reloads_total", "counter", "Main http server reloads.")
+                w.sample("pservers_reloads_total", obj.reloadCount)
+                w.header("pservers_reload_delay_seconds", "histogram", "Time from the first absorbed change to the reload.")
+                w.histogram("pservers_reload_delay_seconds", obj.reloadDelayHistogram)
+                w.header("pservers_reload_duration_seconds", "histogram", "Time used to write config and signal the main http server.")
+                w.histogram("pservers_reload_duration_seconds", obj.reloadDurationHistogram)
+
+        obj = self.param.mainServer.accessLogAnalyzer if self.param.mainServer is not None else None
+        if obj is not None:
+            vhostList = sorted(obj.vhostDict.items())
+            w.header("pservers_access_log_lines_total", "counter", "Access log lines parsed.")
+            w.sample("pservers_access_log_lines_total", obj.lineCount)
+            w.header("pservers_access_log_bad_lines_total", "counter", "Access log lines can't be parsed.")
+            w.sample("pservers_access_log_bad_lines_total", obj.badLineCount)
+            w.header("pservers_vhost_requests_total", "counter", "Requests of the virtual host.")
+            for vhost, stat in vhostList:
+                w.sample("pservers_vhost_requests_total", stat.requestCount, vhost=vhost)
+            w.header("pservers_vhost_responses_total", "counter", "Responses of the virtual host by status class.")
+            for vhost, stat in vhostList:
+                for i, count in enumerate(stat.statusClassCountList):
+                    w.sample("pservers_vhost_responses_total", count, vhost=vhost, code="%dxx" % (i + 1))
+            w.header("pservers_vhost_response_bytes_total", "counter", "Response body bytes of the virtual host.")
+            for vhost, stat in vhostList:
+                w.sample("pservers_vhost_response_bytes_total", stat.byteCount, vhost=vhost)
+            w.header("pservers_vhost_cache_responses_total", "counter", "Responses of the virtual host by disk cache result.")
+            for vhost, stat in vhostList:
+                if any(stat.cacheCountList):
+                    for result, count in zip(["hit", "revalidate", "miss"], stat.cacheCountList):
+                        w.sample("pservers_vhost_cache_responses_total", count, vhost=vhost, result=result)
+            w.header("pservers_vhost_request_rate", "gauge", "Requests per second of the virtual host, moving average.")
+            for vhost, stat in vhostList:
+                w.sample("pservers_vhost_request_rate", stat.rate, vhost=vhost)
+            w.header("pservers_vhost_request_seconds", "histogram", "Time used to serve requests of the virtual host.")
+            for vhost, stat in vhostList:
+                w.histogram("pservers_vhost_request_seconds", stat.latencyHistogram, vhost=vhost)
+            w.header("pservers_vhost_request_seconds_quantile", "gauge", "Estimated percentiles of the time used to serve requests.")
+            for vhost, stat in vhostList:
+                for q in [0.5, 0.9, 0.99]:
+                    value = stat.latencyHistogram.getQuantile(q)
+                    if value is not None:
+                        w.sample("pservers_vhost_request_seconds_quantile", value, vhost=vhost, quantile=q)
+
+        obj = self.param.mainServer.staticCompressor if self.param.mainServer is not None else None
+        if obj is not None:
+            w.header("pservers_static_compressions_total", "counter", "Pre-compressed static files written.")
+            w.sample("pservers_static_compressions_total", obj.compressCount)
+            w.header("pservers_static_saved_bytes", "gauge", "Bytes saved by the live pre-compressed static files.")
+            w.sample("pservers_static_saved_bytes", obj.savedBytes)
+
+        obj = self.param.mainServer.cacheCleaner if self.param.mainServer is not None else None
+        if obj is not None:
+            w.header("pservers_cache_size_bytes", "gauge", "Size of the disk cache, as of the last check.")
+            w.sample("pservers_cache_size_bytes", obj.cacheSize)
+            w.header("pservers_cache_entries", "gauge", "Entries in the disk cache, as of the last check.")
+            w.sample("pservers_cache_entries", obj.entryCount)
+            w.header("pservers_cache_evictions_total", "counter", "Disk cache entries evicted by the size limit.")
+            w.sample("pservers_cache_evictions_total", obj.evictCount)
+            w.header("pservers_cache_clean_failures_total", "counter", "Failed checks of the disk cache.")
+            w.sample("pservers_cache_clean_failures_total", obj.failCount)
+
+        obj = self.param.certManager
+        if obj is not None:
+            w.header("pservers_tls_certificates_issued_total", "counter", "Certificates issued by the local CA.")
+            w.sample("pservers_tls_certificates_issued_total", obj.issueCount)
+            w.header("pservers_tls_certificate_issue_seconds", "histogram", "Time used to issue a certificate.")
+            w.histogram("pservers_tls_certificate_issue_seconds", obj.issueDurationHistogram)
+            w.header("pservers_tls_key_pool_keys", "gauge", "Pre-generated private keys available.")
+            w.sample("pservers_tls_key_pool_keys", obj.keyPoolSize)
+            w.header("pservers_tls_key_pool_misses_total", "counter", "Certificates issued when the key pool is empty.")
+            w.sample("pservers_tls_key_pool_misses_total", obj.keyPoolMissCount)
+
+        obj = self.param.apiServer
+        if obj is not None:
+            w.header("pservers_api_clients", "gauge", "Connected API clients.")
+            w.sample("pservers_api_clients", obj.clientCount)
+            w.header("pservers_api_registrations", "gauge", "Domain names registered by API clients.")
+            w.sample("pservers_api_registrations", obj.registrationCount)
+            w.header("pservers_api_notifications_total", "counter", "Messages received from API clients.")
+            w.sample("pservers_api_notifications_total", obj.notifyCount)
+            w.header("pservers_api_rejects_total", "counter", "API connections and messages rejected by admission control.")
+            for reason, count in sorted(obj.rejectCountDict.items()):
+                w.sample("pservers_api_rejects_total", count, reason=reason)
+
+        obj = self.param.avahiObj
+        if obj is not None:
+            w.header("pservers_avahi_records", "gauge", "Records committed to avahi-daemon.")
+            w.sample("pservers_avahi_records", obj.recordCount)
+            w.header("pservers_avahi_dbus_call_seconds", "histogram", "Latency of D-Bus calls to avahi-daemon.")
+            w.histogram("pservers_avahi_dbus_call_seconds", obj.callLatencyHistogram)
+            w.header("pservers_avahi_dbus_call_errors_total", "counter", "Failed D-Bus calls to avahi-daemon.")
+            w.sample("pservers_avahi_dbus_call_errors_total", obj.callErrorCount)
+
+        obj = self.param.serverManager
+        if obj is not None:
+            serverList = sorted(self.param.serverDict.values(), key=lambda x: x.id)
+            w.header("pservers_server_start_seconds", "histogram", "Time used by successful server starts.")
+            w.histogram("pservers_server_start_seconds", obj.startDurationHistogram)
+            w.header("pservers_server_running", "gauge", "Whether the embedded server is running.")
+            for serverObj in serverList:
+                w.sample("pservers_server_running", int(serverObj.pluginRuntimeData is not None), server=serverObj.id)
+            w.header("pservers_server_last_start_seconds", "gauge", "Time used by the last start of the embedded server.")
+            for serverObj in serverList:
+                if serverObj.startDuration is not None:
+                    w.sample("pservers_server_last_start_seconds", serverObj.startDuration, server=serverObj.id)
+            w.header("pservers_server_last_stop_seconds", "gauge", "Time used by the last stop of the embedded server.")
+            for serverObj in serverList:
+                if serverObj.stopDuration is not None:
+                    w.sample("pservers_server_last_stop_seconds", serverObj.stopDuration, server=serverObj.id)
+
+        obj = self.param.pluginManager
+        if obj is not None:
+            workerList = sorted(obj.getWorkerList(), key=lambda x: x.serverId)
+            w.header("pservers_plugin_worker_crashes_total", "counter", "Plugin workers exited unexpectedly.")
+            w.sample("pservers_plugin_worker_crashes_total", obj.crashCount)
+            w.header("pservers_plugin_worker_rss_bytes", "gauge", "Resident memory of the plugin worker process.")
+            for worker in workerList:
+                rss = worker.getRss()
+                if rss is not None:
+                    w.sample("pservers_plugin_worker_rss_bytes", rss, server=worker.serverId)
+            w.header("pservers_plugin_worker_healthy", "gauge", "Result of the last health check of the embedded server.")
+            for worker in workerList:
+                w.sample("pservers_plugin_worker_healthy", int(worker.bHealthy), server=worker.serverId)
+            w.header("pservers_plugin_worker_health_check_seconds", "gauge", "Time used by the last health check of the embedded server.")
+            for worker in workerList:
+                if worker.healthLatency is not None:
+                    w.sample("pservers_plugin_worker_health_check_seconds", worker.healthLatency, server=worker.serverId)
+            w.header("pservers_plugin_metric", "gauge", "Metrics reported by plugins.")
+            for worker in workerList:
+                for name, value in sorted(worker.metricDict.items()):
+                    if isinstance(value, (int, float)):
+                        w.sample("pservers_plugin_metric", value, server=worker.serverId, name=name)
+
+        return w.getvalue()
+
+    def _onLagCheck(self):
+        now = time.monotonic()
+        self.mainloopLag = max(0, now - self._lagCheckTime)
+        self.mainloopLagHistogram.observe(self.mainloopLag)
+        self._lagCheckTime = now + self.lagCheckInterval
+        return True
+
+    async def _onClientConnected(self, reader, writer):
+        try:
+            try:
+                buf = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.requestTimeout)
+                method, path = buf.decode("iso8859-1").split(" ")[:2]
+            except Exception:
+                writer.write(_response("400 Bad Request"))
+                return
+
+            if method != "GET":
+                writer.write(_response("405 Method Not Allowed"))
+            elif path != "/metrics":
+                writer.write(_response("404 Not Found"))
+            else:
+                try:
+                    body = self.render().encode("utf-8")
+                except Exception:
+                    logging.error("Failed to render metrics.", exc_info=True)
+                    writer.write(_response("500 Internal Server Error"))
+                    return
+                writer.write(_response("200 OK", body))
+        finally:
+            try:
+                await writer.drain()
+            except Exception:
+                pass
+            writer.close()
+
+
+class _Writer:
+
+    def __init__(self):
+        self._lineList = []
+
+    def header(self, name, metricType, helpStr):
+        self._lineList.append("# HELP %s %s" % (name, helpStr))
+        self._lineList.append("# TYPE %s %s" % (name, metricType))
+
+    def sample(self, metricName, value, **labels):
+        self._lineList.append("%s%s %s" % (metricName, _labels(labels), _number(value)))
+
+    def histogram(self, metricName, obj, **labels):
+        for le, count in obj.getCumulativeCountList():
+            self._lineList.append("%s_bucket%s %d" % (metricName, _labels(dict(labels, le=_number(le))), count))
+        self._lineList.append("%s_sum%s %s" % (metricName, _labels(labels), _number(obj.sum)))
+        self._lineList.append("%s_count%s %d" % (metricName, _labels(labels), obj.count))
+
+    def getvalue(self):
+        return "\n".join(self._lineList) + "\n"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _labels(labelDict):
+    if len(labelDict) == 0:
+        return ""
+    return "{%s}" % (",".join(['%s="%s"' % (k, _escape(str(v))) for k, v in sorted(labelDict.items())]))
+
+
+def _escape(s):
+    return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _response(status, body=b''):
+    buf = "HTTP/1.1 %s\r\n" % (status)
+    if body != b'':
+        buf += "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+    buf += "Content-Length: %d\r\n" % (len(body))
+    buf += "Connection: close\r\n"
+    buf += "\r\n"
+    return buf.encode("iso8859-1") + body
@@ -0,0 +1,585 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import re
+import ssl
+import time
+import asyncio
+import logging
+import collections
+from gi.repository import GLib
+from ps_util import DynObject
+from ps_log import RotatingLogFile
+from ps_param import PsConst
+from ps_access_log import PsAccessLogAnalyzer
+
+
+class PsNativeHttpServer:
+
+    """
+    Main server implemented by asyncio in the daemon process, an alternative to PsMainHttpServer, selected by "httpEngine" in main.conf.
+    Routing is an in-memory table of <host,backend>, config changes take effect immediately, there's no reload.
+    Only configs having "backend" are served, they are made by api server, server placeholder and plugins supporting it,
+    servers of other plugins fail to start, see isConfigSupported().
+    Apache only features ("config-segment", "static-directories", "cache", "flushpackets" of backend pool) are ignored,
+    a warning is logged for every config using "static-directories", "cache" or "flushpackets".
+    Requests and responses are streamed without buffering the body, backend connections are kept in pools.
+    Access log is written in the format of PsMainHttpServer, so it's analyzed by PsAccessLogAnalyzer the same way.
+
+    Exampe:
+        obj = PsNativeHttpServer(param)
+        obj.addConfig("proxy-foobar.local", cfg)
+        obj.start()
+        ...
+        obj.stop()
+    """
+
+    def __init__(self, param):
+        self.param = param
+        self.headerTimeout = 60             # in seconds, same as Timeout of PsMainHttpServer
+        self.keepAliveTimeout = 5           # in seconds
+        self.ioTimeout = 60                 # in seconds, for every read of request, response and body
+        self.maxHeaderSize = 64 * 1024
+        self.copyBufferSize = 64 * 1024
+        self.maxIdleConnections = 64        # of each backend, if "max" is not specified in pool parameters
+
+        self._accessLogFile = os.path.join(PsConst.logDir, "httpd-access.log")
+
+        self._cfgDict = dict()              # <cfg-id,cfg>
+        self._routeDict = dict()            # <host,route>
+        self._poolDict = dict()             # <backend-key,deque-of-idle-connections>
+        self._sslContextDict = dict()       # <host,ssl-context>
+        self._serverList = []
+        self._clientWriterSet = set()
+        self._accessLog = None
+        self._logFlushTimer = None
+        self.accessLogAnalyzer = None
+        self.staticCompressor = None
+        self.cacheCleaner = None
+
+        self.routeUpdateCount = 0
+        self.requestCount = 0
+        self.backendConnectCount = 0
+        self.backendErrorCount = 0
+
+    @property
+    def configCount(self):
+        return len(self._cfgDict)
+
+    @property
+    def clientConnectionCount(self):
+        return len(self._clientWriterSet)
+
+    @property
+    def idleBackendConnectionCount(self):
+        return sum([len(x) for x in self._poolDict.values()])
+
+    def isConfigSupported(self, cfg):
+        return "backend" in cfg
+
+    def addConfig(self, cfgId, cfg):
+        assert cfgId not in self._cfgDict
+        self._cfgDict[cfgId] = cfg
+        self._updateRoute(None, cfg)
+
+    def updateConfig(self, cfgId, cfg):
+        oldCfg = self._cfgDict.get(cfgId)
+        self._cfgDict[cfgId] = cfg
+        self._updateRoute(oldCfg, cfg)
+
+    def removeConfig(self, cfgId):
+        self._updateRoute(self._cfgDict.pop(cfgId), None)
+
+    def batchRemoveConfig(self, cfgIdList):
+        for cfgId in list(cfgIdList):
+            self.removeConfig(cfgId)
+
+    def flushReload(self):
+        # changes are always applied immediately
+        pass
+
+    def start(self):
+        assert len(self._serverList) == 0
+        self._accessLog = RotatingLogFile(self._accessLogFile, PsConst.updaterLogFileSize, PsConst.updaterLogFileCount)
+        self._logFlushTimer = GLib.timeout_add_seconds(self._accessLog.flushInterval, self._onLogFlush)
+
+        loop = self.param.mainloop
+        coro = asyncio.start_server(self._onClientConnected, host=self.param.listenIp, port=PsConst.httpPort,
+                                    limit=self.maxHeaderSize, reuse_address=True)
+        self._serverList.append(loop.run_until_complete(coro))
+        if "flushpackets" in self.param.backendPoolDict:
+            logging.warning("Backend pool parameter \"flushpackets\" in main.conf is ignored by native main server.")
+        if self.param.certManager is not None:
+            # mainloop is not serving yet, certificates are prepared here
+            for domainName in self._routeDict:
+                self._sslContextDict[domainName] = _newSslContext(*self.param.certManager.getCertAndKeyFile(domainName))
+            certFile, keyFile = self.param.certManager.getDefaultCertAndKeyFile()
+            sslContext = _newSslContext(certFile, keyFile)
+            sslContext.set_servername_callback(self._onServerName)
+            coro = asyncio.start_server(self._onTlsClientConnected, host=self.param.listenIp, port=PsConst.httpsPort,
+                                        limit=self.maxHeaderSize, reuse_address=True, ssl=sslContext)
+            self._serverList.append(loop.run_until_complete(coro))
+
+        self.accessLogAnalyzer = PsAccessLogAnalyzer(self._accessLogFile)
+
+    def stop(self):
+        if self.accessLogAnalyzer is not None:
+            self.accessLogAnalyzer.dispose()
+            self.accessLogAnalyzer = None
+        for server in self._serverList:
+            server.close()
+        self._serverList = []
+        for writer in list(self._clientWriterSet):
+            writer.close()
+        for pool in self._poolDict.values():
+            for conn in pool:
+                conn.writer.close()
+        self._poolDict.clear()
+        for route in self._routeDict.values():
+            if route.activityLog is not None:
+                route.activityLog.close()
+                route.activityLog = None
+        if self._logFlushTimer is not None:
+            GLib.source_remove(self._logFlushTimer)
+            self._logFlushTimer = None
+        if self._accessLog is not None:
+            self._accessLog.close()
+            self._accessLog = None
+
+    def _updateRoute(self, oldCfg, cfg):
+        if cfg is not None and "domain-name" in cfg and "backend" not in cfg:
+            # refused by server manager, it should never happen, the old route is kept
+            logging.error("Config of %s has no backend, it is not supported by native main server." % (cfg["domain-name"]))
+            return
+
+        if oldCfg is not None and "domain-name" in oldCfg:
+            route = self._routeDict.pop(oldCfg["domain-name"], None)
+            if route is not None and route.activityLog is not None:
+                route.activityLog.close()
+            self._sslContextDict.pop(oldCfg["domain-name"], None)
+
+        if cfg is not None and "domain-name" in cfg:
+            ignoredList = [x for x in ["static-directories", "cache"] if x in cfg]
+            if "flushpackets" in cfg["backend"].get("pool", dict()):
+                ignoredList.append("flushpackets")
+            if len(ignoredList) > 0:
+                logging.warning("Config of %s uses %s, not supported by native main server, ignored." % (cfg["domain-name"], ", ".join(ignoredList)))
+
+            route = DynObject()
+            route.domainName = cfg["domain-name"]
+            route.backend = cfg["backend"]
+            route.key = (route.backend.get("address"), route.backend.get("port"), route.backend.get("unix"), route.backend.get("tls", False))
+            route.pool = dict(self.param.backendPoolDict)
+            route.pool.update(route.backend.get("pool", dict()))
+            route.activityLog = open(cfg["activity-log-file"], "ab", buffering=0) if "activity-log-file" in cfg else None
+            self._routeDict[route.domainName] = route
+            if self._serverList != [] and self.param.certManager is not None:
+                ret = self.param.certManager.getReadyCertAndKeyFile(route.domainName, self._onCertReady)
+                if ret is not None:
+                    self._sslContextDict[route.domainName] = _newSslContext(*ret)
+
+        self.routeUpdateCount += 1
+
+    def _onCertReady(self, domainName):
+        if domainName in self._routeDict and domainName not in self._sslContextDict:
+            self._sslContextDict[domainName] = _newSslContext(*self.param.certManager.getCertAndKeyFile(domainName))
+
+    def _onServerName(self, sslObj, serverName, sslContext):
+        # ssl callback, certificate is selected by SNI, default certificate is used for unknown names
+        # and names whose certificate is not ready yet
+        try:
+            if serverName is None or serverName not in self._sslContextDict:
+                return None
+            sslObj.context = self._sslContextDict[serverName]
+        except Exception:
+            logging.error("Failed to select certificate for %s." % (serverName), exc_info=True)
+        return None
+
+    def _onLogFlush(self):
+        self._accessLog.flushBuffer()
+        return True
+
+    async def _onTlsClientConnected(self, reader, writer):
+        await self._serveClient(reader, writer, "https")
+
+    async def _onClientConnected(self, reader, writer):
+        await self._serveClient(reader, writer, "http")
+
+    async def _serveClient(self, reader, writer, scheme):
+        self._clientWriterSet.add(writer)
+        try:
+            peer = writer.get_extra_info("peername")
+            clientIp = peer[0] if peer else "-"
+            timeout = self.headerTimeout
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                except asyncio.LimitOverrunError:
+                    writer.write(_response("431 Request Header Fields Too Large"))
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if not await self._serveRequest(reader, writer, head, clientIp, scheme):
+                    break
+                timeout = self.keepAliveTimeout
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except _BadChunkError as e:
+            # request body is handled in _serveRequest(), it's the response body
+            self.backendErrorCount += 1
+            logging.warning("Native main server got invalid response body from backend, %s." % (e))
+        except Exception:
+            logging.error("Native main server failed to serve client %s." % (clientIp), exc_info=True)
+        finally:
+            self._clientWriterSet.discard(writer)
+            writer.close()
+
+    async def _serveRequest(self, reader, writer, head, clientIp, scheme):
+        # returns True if the client connection can be used for the next request
+        startTime = time.monotonic()
+        self.requestCount += 1
+
+        req = _parseHead(head)
+        if req is None or len(req.startLine.split(" ")) != 3:
+            writer.write(_response("400 Bad Request"))
+            return False
+        method, target, version = req.startLine.split(" ")
+        host = _stripPort(req.headerDict.get("host", "")).lower()
+        connTokenList = _tokens(req.headerDict.get("connection", ""))
+        bKeepAlive = (version == "HTTP/1.1" and "close" not in connTokenList)
+        bUpgrade = ("upgrade" in connTokenList and "upgrade" in req.headerDict)
+        bChunked = False
+        contentLength = 0
+        if "transfer-encoding" in req.headerDict:
+            if _tokens(req.headerDict["transfer-encoding"]) != ["chunked"]:
+                writer.write(_response("501 Not Implemented"))
+                return False
+            bChunked = True
+        elif "content-length" in req.headerDict:
+            contentLength = int(req.headerDict["content-length"])          # validated by _parseHead()
+        bHasBody = bChunked or contentLength > 0
+
+        route = self._routeDict.get(host)
+        if route is None:
+            writer.write(_response("404 Not Found"))
+            self._log("none", 404, 0, startTime, clientIp, req.startLine)
+            return False
+        if route.activityLog is not None:
+            route.activityLog.write(b'.')
+
+        # request head for backend, hop-by-hop and framing headers are re-generated
+        # "100 Continue" is sent by ourselves, since the body is sent before the response is read
+        if req.headerDict.get("expect", "").lower() == "100-continue" and bHasBody:
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        hopSet = _replacedHeaderSet | set(connTokenList)
+        buf = "%s %s HTTP/1.1\r\n" % (method, target)
+        for k, v in req.headerList:
+            lk = k.lower()
+            if lk in hopSet or lk in ["host", "expect", "content-length"] or lk.startswith("x-forwarded-"):
+                continue
+            buf += "%s: %s\r\n" % (k, v)
+        buf += "Host: %s\r\n" % (route.backend.get("host", req.headerDict.get("host", "")))
+        xff = req.headerDict.get("x-forwarded-for")
+        buf += "X-Forwarded-For: %s\r\n" % (clientIp if xff is None else "%s, %s" % (xff, clientIp))
+        buf += "X-Forwarded-Host: %s\r\n" % (req.headerDict.get("host", ""))
+        buf += "X-Forwarded-Proto: %s\r\n" % (scheme)
+        if bChunked:
+            buf += "Transfer-Encoding: chunked\r\n"
+        elif contentLength > 0:
+            buf += "Content-Length: %d\r\n" % (contentLength)
+        if bUpgrade:
+            buf += "Upgrade: %s\r\nConnection: Upgrade\r\n" % (req.headerDict["upgrade"])
+        buf += "\r\n"
+        reqHead = buf.encode("iso8859-1")
+
+        # send request, a stale pooled connection is retried with a new one if there's no body sent
+        conn = None
+        for i in range(0, 2):
+            try:
+                conn, bReused = await self._acquireConnection(route)
+            except Exception as e:
+                return self._backendError(writer, route, "502 Bad Gateway", e, startTime, clientIp, req.startLine)
+            try:
+                conn.writer.write(reqHead)
+                if bChunked:
+                    await self._copyChunked(reader, conn.writer)
+                elif contentLength > 0:
+                    await self._copyLength(reader, conn.writer, contentLength)
+                else:
+                    await conn.writer.drain()
+                resp = await self._readResponseHead(conn.reader)
+                break
+            except asyncio.TimeoutError as e:
+                conn.writer.close()
+                return self._backendError(writer, route, "504 Gateway Timeout", e, startTime, clientIp, req.startLine)
+            except _BadChunkError:
+                # request body is not forwarded any further, the client connection can't be used any more
+                conn.writer.close()
+                writer.write(_response("400 Bad Request"))
+                self._log(route.domainName, 400, 0, startTime, clientIp, req.startLine)
+                return False
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                conn.writer.close()
+                if bReused and not bHasBody and i == 0:
+                    continue
+                return self._backendError(writer, route, "502 Bad Gateway", e, startTime, clientIp, req.startLine)
+
+        try:
+            return await self._forwardResponse(reader, writer, route, conn, resp, method, bKeepAlive, startTime, clientIp, req.startLine)
+        except BaseException:
+            conn.writer.close()
+            raise
+
+    async def _forwardResponse(self, reader, writer, route, conn, resp, method, bKeepAlive, startTime, clientIp, requestLine):
+        # interim responses are forwarded as is, except "101 Switching Protocols"
+        while 100 <= resp.status < 200 and resp.status != 101:
+            writer.write(resp.head)
+            resp = await self._readResponseHead(conn.reader)
+
+        if resp.status == 101:
+            writer.write(resp.head)
+            self._log(route.domainName, 101, 0, startTime, clientIp, requestLine)
+            await self._tunnel(reader, writer, conn.reader, conn.writer)
+            return False
+
+        respConnTokenList = _tokens(resp.headerDict.get("connection", ""))
+        bBackendKeepAlive = (resp.version == "HTTP/1.1" and "close" not in respConnTokenList)
+        bRespChunked = False
+        respLength = None
+        if method == "HEAD" or resp.status in [204, 304]:
+            respLength = 0
+        elif _tokens(resp.headerDict.get("transfer-encoding", "")) == ["chunked"]:
+            bRespChunked = True
+        elif "transfer-encoding" not in resp.headerDict and "content-length" in resp.headerDict:
+            respLength = int(resp.headerDict["content-length"])           # validated by _parseHead()
+        else:
+            # body ends with the backend connection
+            bKeepAlive = False
+            bBackendKeepAlive = False
+
+        hopSet = _replacedHeaderSet | set(respConnTokenList)
+        buf = resp.startLine + "\r\n"
+        for k, v in resp.headerList:
+            if k.lower() in hopSet or (k.lower() == "content-length" and respLength is None):
+                continue
+            buf += "%s: %s\r\n" % (k, v)
+        if bRespChunked:
+            buf += "Transfer-Encoding: chunked\r\n"
+        buf += "Connection: %s\r\n" % ("keep-alive" if bKeepAlive else "close")
+        buf += "\r\n"
+        writer.write(buf.encode("iso8859-1"))
+
+        if bRespChunked:
+            size = await self._copyChunked(conn.reader, writer)
+        elif respLength is not None:
+            size = await self._copyLength(conn.reader, writer, respLength)
+        else:
+            size = await self._copyUntilEof(conn.reader, writer)
+
+        self._log(route.domainName, resp.status, size, startTime, clientIp, requestLine)
+        if bBackendKeepAlive and route.pool.get("keepalive", True):
+            self._releaseConnection(route, conn)
+        else:
+            conn.writer.close()
+        return bKeepAlive
+
+    async def _acquireConnection(self, route):
+        # returns (connection, reused)
+        pool = self._poolDict.get(route.key)
+        now = time.monotonic()
+        while pool:
+            conn = pool.pop()
+            if now - conn.idleTime < route.pool.get("ttl", 4) and not conn.reader.at_eof():
+                return (conn, True)
+            conn.writer.close()
+
+        backend = route.backend
+        if "unix" in backend:
+            coro = asyncio.open_unix_connection(backend["unix"], limit=self.maxHeaderSize)
+        else:
+            sslContext = None
+            if backend.get("tls", False):
+                # backend is on localhost, its certificate is not verified
+                sslContext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                sslContext.check_hostname = False
+                sslContext.verify_mode = ssl.CERT_NONE
+            coro = asyncio.open_connection(backend["address"], backend["port"], ssl=sslContext, limit=self.maxHeaderSize)
+        conn = DynObject()
+        conn.reader, conn.writer = await asyncio.wait_for(coro, route.pool.get("connectiontimeout", 5))
+        conn.idleTime = None
+        self.backendConnectCount += 1
+        return (conn, False)
+
+    def _releaseConnection(self, route, conn):
+        pool = self._poolDict.setdefault(route.key, collections.deque())
+        if self._routeDict.get(route.domainName) is not route or len(pool) >= route.pool.get("max", self.maxIdleConnections):
+            conn.writer.close()
+            return
+        conn.idleTime = time.monotonic()
+        pool.append(conn)
+
+    def _backendError(self, writer, route, status, e, startTime, clientIp, requestLine):
+        self.backendErrorCount += 1
+        logging.warning("Native main server failed to access backend of %s, %s." % (route.domainName, e))
+        writer.write(_response(status))
+        self._log(route.domainName, int(status.split(" ")[0]), 0, startTime, clientIp, requestLine)
+        return False
+
+    async def _readResponseHead(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.ioTimeout)
+        resp = _parseHead(head)
+        if resp is None:
+            raise ValueError("invalid response")
+        resp.head = head
+        resp.version, status = resp.startLine.split(" ", 2)[:2]
+        resp.status = int(status)
+        return resp
+
+    async def _copyLength(self, reader, writer, length):
+        # returns bytes copied
+        remain = length
+        while remain > 0:
+            buf = await asyncio.wait_for(reader.read(min(remain, self.copyBufferSize)), self.ioTimeout)
+            if buf == b'':
+                raise ConnectionError("unexpected end of stream")
+            writer.write(buf)
+            await writer.drain()
+            remain -= len(buf)
+        return length
+
+    async def _copyChunked(self, reader, writer):
+        # chunks are copied as is, returns bytes of chunk data
+        # raises _BadChunkError if the framing is invalid, nothing invalid is forwarded
+        total = 0
+        while True:
+            line = await self._readChunkLine(reader)
+            m = _chunkSizePattern.fullmatch(line.split(b';')[0].strip())
+            if m is None:
+                raise _BadChunkError("invalid chunk size")
+            writer.write(line)
+            size = int(m.group(0), 16)
+            if size == 0:
+                while line != b'\r\n':
+                    line = await self._readChunkLine(reader)                                        # trailers
+                    writer.write(line)
+                await writer.drain()
+                return total
+            await self._copyLength(reader, writer, size)
+            if await asyncio.wait_for(reader.readexactly(2), self.ioTimeout) != b'\r\n':
+                raise _BadChunkError("invalid chunk data")
+            writer.write(b'\r\n')
+            total += size
+
+    async def _readChunkLine(self, reader):
+        try:
+            line = await asyncio.wait_for(reader.readuntil(b'\r\n'), self.ioTimeout)
+        except asyncio.LimitOverrunError:
+            raise _BadChunkError("chunk line too long")
+        if b'\r' in line[:-2] or b'\n' in line[:-2]:
+            raise _BadChunkError("invalid chunk line")
+        return line
+
+    async def _copyUntilEof(self, reader, writer):
+        total = 0
+        while True:
+            buf = await asyncio.wait_for(reader.read(self.copyBufferSize), self.ioTimeout)
+            if buf == b'':
+                return total
+            writer.write(buf)
+            await writer.drain()
+            total += len(buf)
+
+    async def _tunnel(self, reader1, writer1, reader2, writer2):
+        async def _pipe(reader, writer):
+            try:
+                while True:
+                    buf = await reader.read(self.copyBufferSize)
+                    if buf == b'':
+                        break
+                    writer.write(buf)
+                    await writer.drain()
+            finally:
+                writer.close()
+
+        await asyncio.gather(_pipe(reader1, writer2), _pipe(reader2, writer1), return_exceptions=True)
+
+    def _log(self, vhost, status, size, startTime, clientIp, requestLine):
+        # same fields as the LogFormat of PsMainHttpServer
+        duration = int((time.monotonic() - startTime) * 1000000)
+        timeStr = time.strftime("%d/%b/%Y:%H:%M:%S %z")
+        self._accessLog.write("%s %d %d %d - %s - - [%s] \"%s\" \"-\" \"-\"\n" % (vhost, status, size, duration, clientIp, timeStr, requestLine))
+
+
+# hop-by-hop headers, they're re-generated for the other side
+_replacedHeaderSet = set(["connection", "keep-alive", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade"])
+
+# headers which must not have different values, the peers may pick different ones
+_singleValueHeaderSet = set(["content-length", "host"])
+
+_chunkSizePattern = re.compile(b'[0-9A-Fa-f]{1,16}')
+
+
+class _BadChunkError(Exception):
+    pass
+
+
+def _parseHead(head):
+    # head ends with an empty line, returns None if it's invalid, since anything ambiguous can be used to smuggle requests:
+    #   lone CR or LF, line without colon, folded line, whitespace in header name,
+    #   content-length not being a number, different values of a single value header
+    try:
+        lineList = head.decode("iso8859-1")[:-len("\r\n\r\n")].split("\r\n")
+        ret = DynObject()
+        ret.startLine = lineList[0]
+        ret.headerList = []
+        ret.headerDict = dict()         # <lower-case-name,value>
+        for line in lineList:
+            if "\r" in line or "\n" in line:
+                return None
+        for line in lineList[1:]:
+            k, v = line.split(":", 1)
+            if k == "" or k != k.strip() or " " in k or "\t" in k:
+                return None
+            v = v.strip()
+            lk = k.lower()
+            if lk in _singleValueHeaderSet and ret.headerDict.get(lk, v) != v:
+                return None
+            if lk == "content-length" and not _isDigits(v):
+                return None
+            ret.headerList.append((k, v))
+            ret.headerDict[lk] = v
+        return ret
+    except ValueError:
+        return None
+
+
+def _isDigits(value):
+    # str.isdigit() accepts non-ascii digits
+    return value != "" and all([c in "0123456789" for c in value])
+
+
+def _tokens(value):
+    return [x.strip().lower() for x in value.split(",") if x.strip() != ""]
+
+
+def _stripPort(host):
+    if host.startswith("["):
+        return host.split("]")[0] + "]"
+    return host.split(":")[0]
+
+
+def _newSslContext(certFile, keyFile):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certFile, keyFile)
+    ctx.set_alpn_protocols(["http/1.1"])
+    return ctx
+
+
+def _response(status):
+    buf = "HTTP/1.1 %s\r\n" % (status)
+    buf += "Content-Length: 0\r\n"
+    buf += "Connection: close\r\n"
+    buf += "\r\n"
+    return buf.encode("iso8859-1")
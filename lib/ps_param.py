@@ -29,9 +29,16 @@ class PsConst:
     httpPort = 80
     httpsPort = 443
 
+    tlsDir = os.path.join(varDir, ".tls")               # hidden, so that it never collides with server data directories
+    caCertFile = os.path.join(tlsDir, "ca.crt")
+    caKeyFile = os.path.join(tlsDir, "ca.key")
+    cacheDir = os.path.join(varDir, ".cache")           # disk cache of main server
+
     mainCfgFile = os.path.join(etcDir, "main.conf")
     pidFile = os.path.join(runDir, "pservers.pid")
     apiServerFile = os.path.join(runDir, "api.socket")
+    activatorFile = os.path.join(runDir, "activator.socket")
+    metricsFile = os.path.join(runDir, "metrics.socket")
 
 
 class PsParam:
@@ -41,9 +48,59 @@ class PsParam:
 
         self.listenIp = "0.0.0.0"
 
+        # "apache": main server is an apache process configured by generated config files
+        # "native": main server runs in daemon (PsNativeHttpServer), only proxies to backends, routing changes need no reload
+        self.httpEngine = "apache"
+
+        self.reloadBatchWindow = 0.5            # in seconds
+        self.reloadMaxLatency = 3               # in seconds
+
+        # https of main server, certificates are issued by a local CA, opted in by "httpsEnabled" in main.conf
+        # it needs mod_ssl and mod_socache_shmcb with apache engine, and mod_http2 if http2 is also enabled
+        self.httpsEnabled = False
+        self.tlsKeyType = "rsa"                 # "rsa" or "ecdsa"
+        self.tlsKeyPoolSize = 4                 # number of pre-generated private keys
+        self.tlsSessionCacheSize = 512 * 1024   # in bytes, shared by all the virtual hosts
+        self.http2Enabled = False               # opted in by "http2Enabled" in main.conf, only used when https is enabled
+
+        # Cache-Control max-age of static directories opted in by plugins, in seconds
+        self.staticMaxAge = 300
+
+        # disk cache of main server, shared by the virtual hosts which have a cache policy
+        # entries with the oldest access time are evicted, it's LRU only if varDir is mounted with strictatime
+        self.cacheSizeLimit = 1024 * 1024 * 1024        # in bytes
+
+        # main http server tuning directives, overriding auto-sized values, for example {"MaxRequestWorkers": 400}
+        self.httpdTuningDict = dict()
+
+        self.serverStartWorkers = 8
+        self.serverStartTimeout = 60            # in seconds
+        self.serverStopTimeout = 30             # in seconds
+
+        # resource limits for every plugin worker process, <resource-name,limit>, for example {"RLIMIT_AS": 1073741824}
+        self.pluginWorkerRlimitDict = dict()
+
+        # default backend connection pool parameters of proxied servers, overridden by "backend-pool" in registration
+        # ttl should be lower than the keep-alive timeout of backends, which is 5 seconds for node.js and apache
+        self.backendPoolDict = {
+            "keepalive": True,
+            "ttl": 4,
+            "connectiontimeout": 5,
+        }
+
+        # admission control for api clients, by peer credentials
+        self.apiNotifyRate = 20                 # messages per second, for each uid and each pid
+        self.apiNotifyBurst = 200
+        self.apiMaxConnectionsPerUid = 64
+        self.apiMaxRegistrationsPerUid = 1024
+
         # objects
         self.mainloop = None
         self.pluginManager = None
+        self.certManager = None
+        self.serverManager = None
+        self.activator = None
         self.mainServer = None
         self.avahiObj = None
         self.apiServer = None
+        self.metricsServer = None
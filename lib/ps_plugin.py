@@ -2,16 +2,52 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
-import lxml.etree
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+import traceback
+import subprocess
+from gi.repository import GLib
 from ps_util import PsUtil
+from ps_util import LineFramer
 from ps_param import PsConst
 
 
 class PsPluginManager:
 
+    """
+    Plugin modules are never imported by daemon, every running server is hosted by its own PsPluginWorker.
+    Workers are supervised, a crashed worker is restarted by server manager,
+    with exponential backoff for workers crashing again in restartMaxDelay seconds after being started.
+    Workers are polled for health and metrics periodically, a worker not responding in time is killed and so restarted.
+    """
+
     def __init__(self, param):
         self.param = param
         self.pluginDict = dict()
+        self.superviseInterval = 5
+        self.healthCheckInterval = 30
+        self.healthCheckTimeout = 10
+        self.restartMinDelay = 1
+        self.restartMaxDelay = 300
+        self.crashCount = 0
+
+        self._workerDict = dict()       # <server-id,worker>, workers of running servers
+        self._crashDict = dict()        # <server-id,count>, consecutive crashes
+        self._superviseTimer = GLib.timeout_add_seconds(self.superviseInterval, self._onSupervise)
+        self._healthCheckTimer = GLib.timeout_add_seconds(self.healthCheckInterval, self._onHealthCheck)
+        self._healthCheckTask = None
+
+    def dispose(self):
+        GLib.source_remove(self._healthCheckTimer)
+        GLib.source_remove(self._superviseTimer)
+        if self._healthCheckTask is not None:
+            self._healthCheckTask.cancel()
+            self._healthCheckTask = None
 
     def getPluginNameList(self):
         ret = os.listdir(PsConst.pluginsDir)
@@ -20,29 +56,92 @@ class PsPluginManager:
 
     def getPlugin(self, pluginName):
         if pluginName not in self.pluginDict:
-            mod = __import__("plugins.%s" % (pluginName))
-            mod = getattr(mod, pluginName)
-            self.pluginDict[pluginName] = PsPlugin(self.param, pluginName, os.path.join(PsConst.pluginsDir, pluginName), mod)
+            self.pluginDict[pluginName] = PsPlugin(self.param, pluginName, os.path.join(PsConst.pluginsDir, pluginName))
         return self.pluginDict[pluginName]
 
+    def getWorkerList(self):
+        return list(self._workerDict.values())
+
+    def addWorker(self, worker):
+        # may be called in executor threads
+        self._workerDict[worker.serverId] = worker
+
+    def removeWorker(self, worker):
+        if self._workerDict.get(worker.serverId) is worker:
+            del self._workerDict[worker.serverId]
+
+    def _onSupervise(self):
+        # event callback, no exception is allowed
+        try:
+            for worker in list(self._workerDict.values()):
+                if worker.isAlive():
+                    continue
+                count = self._crashDict.get(worker.serverId, 0)
+                if time.monotonic() - worker.startTime >= self.restartMaxDelay:
+                    count = 0                                       # worker has been stable
+                delay = min(self.restartMinDelay * 2 ** count, self.restartMaxDelay)
+                self._crashDict[worker.serverId] = count + 1
+                logging.error("Plugin worker of server %s exited unexpectedly with code %d, restart in %d seconds." % (worker.serverId, worker.returncode, delay))
+                self.crashCount += 1
+                self.removeWorker(worker)
+                self.param.mainloop.create_task(self.param.serverManager.restartServer(worker.serverId, delay))
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    def _onHealthCheck(self):
+        # event callback, no exception is allowed
+        try:
+            if self._healthCheckTask is None:
+                self._healthCheckTask = self.param.mainloop.create_task(self._checkHealth())
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    async def _checkHealth(self):
+        try:
+            await asyncio.gather(*[self._checkWorker(x) for x in self.getWorkerList()])
+        finally:
+            self._healthCheckTask = None
+
+    async def _checkWorker(self, worker):
+        # worker calls block, they are done in executor threads
+        startTime = time.monotonic()
+        try:
+            bHealthy = await self.param.mainloop.run_in_executor(None, worker.call, "health", None, self.healthCheckTimeout)
+        except Exception as e:
+            logging.error("Health check of server %s failed, %s." % (worker.serverId, e))
+            bHealthy = False
+        worker.healthLatency = time.monotonic() - startTime
+
+        if bHealthy != worker.bHealthy:
+            worker.bHealthy = bHealthy
+            if bHealthy:
+                logging.info("Server %s becomes healthy." % (worker.serverId))
+            else:
+                logging.warning("Server %s becomes unhealthy." % (worker.serverId))
+
+        if bHealthy:
+            try:
+                worker.metricDict = await self.param.mainloop.run_in_executor(None, worker.call, "metrics", None, self.healthCheckTimeout)
+            except Exception as e:
+                logging.error("Failed to get metrics of server %s, %s." % (worker.serverId, e))
+
 
 class PsPlugin:
 
-    def __init__(self, param, pluginName, pluginDir, mod):
-        self._mod = mod
+    def __init__(self, param, pluginName, pluginDir):
+        self.param = param
+        self._name = pluginName
 
     def start(self, serverId, serverDomainName, serverDataDir):
+        # may be called in executor threads
         tmpDir = os.path.join(PsConst.tmpDir, serverId)
         PsUtil.ensureDir(tmpDir)
 
         tmpWebRootDir = os.path.join(PsConst.tmpWebRootDir, serverId)
         PsUtil.ensureDir(tmpWebRootDir)
 
-        pluginRuntimeData = {
-            "server-id": serverId,
-            "module-data": None,
-        }
-
         argument = {
             "server-id": serverId,
             "domain-name": serverDomainName,
@@ -50,14 +149,155 @@ class PsPlugin:
             "temp-directory": tmpDir,
             "webroot-directory": tmpWebRootDir,
         }
-        apacheCfg, pluginRuntimeData["module-data"] = self._mod.start(argument)
+        worker = PsPluginWorker(self.param, self._name, serverId)
+        try:
+            apacheCfg = worker.call("start", argument, self.param.serverStartTimeout)
+            _checkStaticDirectories(apacheCfg, tmpWebRootDir)
+        except Exception:
+            worker.dispose()
+            raise
+        self.param.pluginManager.addWorker(worker)
+
+        pluginRuntimeData = {
+            "server-id": serverId,
+            "worker": worker,
+        }
         return (apacheCfg, pluginRuntimeData)
 
     def stop(self, pluginRuntimeData):
-        self._mod.stop(pluginRuntimeData["module-data"])
+        worker = pluginRuntimeData["worker"]
+        self.param.pluginManager.removeWorker(worker)
+        try:
+            if worker.isAlive():
+                worker.call("stop", None, self.param.serverStopTimeout)
+        except Exception:
+            logging.error("Failed to stop server %s in plugin worker." % (worker.serverId), exc_info=True)
+        finally:
+            worker.dispose()
 
         tmpWebRootDir = os.path.join(PsConst.tmpWebRootDir, pluginRuntimeData["server-id"])
         PsUtil.forceDelete(tmpWebRootDir)
 
         tmpDir = os.path.join(PsConst.tmpDir, pluginRuntimeData["server-id"])
         PsUtil.forceDelete(tmpDir)
+
+
+def _checkStaticDirectories(apacheCfg, webRootDir):
+    # static directories are written by PsStaticCompressor, they must be in the webroot directory of the server
+    webRootDir = os.path.realpath(webRootDir)
+    dirList = []
+    for urlPath, dirPath in apacheCfg.get("static-directories", dict()).items():
+        if not urlPath.startswith("/"):
+            raise Exception("invalid url path %s in static-directories" % (urlPath))
+        dirPath = os.path.realpath(dirPath)
+        if dirPath != webRootDir and not dirPath.startswith(webRootDir + "/"):
+            raise Exception("directory %s in static-directories is not in webroot directory" % (dirPath))
+        if PsUtil.isPathOverlap(dirPath, dirList):
+            raise Exception("directory %s in static-directories overlaps with others" % (dirPath))
+        dirList.append(dirPath)
+
+
+class PsPluginWorker:
+
+    """
+    A process which imports the plugin module and hosts one running server, see ps_plugin_worker.py.
+    Resource limits in param.pluginWorkerRlimitDict are applied to the process before the plugin is imported.
+    Output of the process is written to daemon log line by line, by a thread which exits when the output pipe is closed.
+
+    Exampe:
+        obj = PsPluginWorker(param, "foobar", "server1")
+        cfg = obj.call("start", argument, 60)
+        ...
+        obj.call("stop", None, 30)
+        obj.dispose()
+    """
+
+    _workerFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ps_plugin_worker.py")
+
+    def __init__(self, param, pluginName, serverId):
+        self.pluginName = pluginName
+        self.serverId = serverId
+        self.startTime = time.monotonic()
+
+        # updated by health check
+        self.bHealthy = True
+        self.healthLatency = None       # seconds used by the last health check
+        self.metricDict = dict()        # <metric-name,number>, returned by plugin
+
+        self._lock = threading.Lock()
+        self._framer = LineFramer()
+        self._sock, workerSock = socket.socketpair()
+        try:
+            cmd = [sys.executable, self._workerFile, pluginName, str(workerSock.fileno()), json.dumps(param.pluginWorkerRlimitDict)]
+            env = dict(os.environ)
+            env["PYTHONUNBUFFERED"] = "1"           # so that output lines are logged in time
+            self._proc = subprocess.Popen(cmd, pass_fds=[workerSock.fileno()], env=env,
+                                          stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except Exception:
+            self._sock.close()
+            raise
+        finally:
+            workerSock.close()
+        threading.Thread(target=self._logOutput, daemon=True).start()
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    @property
+    def returncode(self):
+        return self._proc.returncode
+
+    def isAlive(self):
+        return self._proc.poll() is None
+
+    def getRss(self):
+        # returns resident memory of the worker process in bytes, returns None if the process is gone
+        try:
+            with open("/proc/%d/statm" % (self._proc.pid)) as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError):
+            return None
+
+    def call(self, method, argument, timeout):
+        # timeout is for the whole call, the worker is killed if the call times out, since its response can't be matched any more
+        with self._lock:
+            deadline = time.monotonic() + timeout
+            try:
+                self._sock.settimeout(timeout)
+                self._sock.sendall(json.dumps({"method": method, "argument": argument}).encode("utf-8") + b"\n")
+                while True:
+                    frame = self._framer.popFrame()
+                    if frame is not None:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    self._sock.settimeout(remaining)
+                    if self._framer.recvFrom(self._sock) == 0:
+                        raise Exception("plugin worker of server %s exited" % (self.serverId))
+            except socket.timeout:
+                self._proc.kill()
+                raise Exception("plugin worker of server %s does not respond in %s seconds" % (self.serverId, timeout))
+
+        ret = json.loads(frame.decode("utf-8"))
+        if "error" in ret:
+            raise Exception(ret["error"])
+        return ret["result"]
+
+    def dispose(self, timeout=10):
+        # worker exits when the socket is closed
+        self._sock.close()
+        try:
+            self._proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+
+    def _logOutput(self):
+        # runs in its own thread until the output pipe is closed, processes started by plugin may keep it open after the worker exits
+        try:
+            for line in self._proc.stdout:
+                logging.info("Plugin worker of server %s: %s" % (self.serverId, line.decode("utf-8", "replace").rstrip("\n")))
+        finally:
+            self._proc.stdout.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# Plugin worker process, hosts one running server of a plugin.
+# Usage: ps_plugin_worker.py <plugin-name> <socket-fd> <rlimits-json>
+#
+# Requests and responses are json lines on the socket, one request at a time:
+#   {"method": "start", "argument": {...}}  ->  {"result": apache-config}
+#   {"method": "stop"}                      ->  {"result": null}
+#   {"method": "health"}                    ->  {"result": true-or-false}
+#   {"method": "metrics"}                   ->  {"result": {metric-name: number}}
+#   any failure                             ->  {"error": "..."}
+# Plugin object and module data never leave this process.
+# Plugin output on stdout and stderr is written to daemon log.
+# The event loop is backed by GLib mainloop as in daemon, GLib sources created by plugins are served.
+# The process exits when the socket is closed by daemon.
+
+import sys
+import json
+import socket
+import asyncio
+import resource
+import importlib
+import traceback
+import asyncio_glib
+
+
+def main():
+    pluginName = sys.argv[1]
+    sock = socket.socket(fileno=int(sys.argv[2]))
+    for name, value in json.loads(sys.argv[3]).items():
+        _setRlimit(getattr(resource, name), value)
+
+    mod = importlib.import_module("plugins.%s" % (pluginName))
+    version = getattr(mod, "plugin_api_version", 1)
+    if version == 1:
+        pluginObj = _PluginV1(mod)
+    elif version == 2:
+        pluginObj = mod.plugin_class()
+    else:
+        raise Exception("plugin %s: unsupported api version %s" % (pluginName, version))
+
+    asyncio.set_event_loop_policy(asyncio_glib.GLibEventLoopPolicy())
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_serve(sock, pluginObj))
+
+
+async def _serve(sock, pluginObj):
+    reader, writer = await asyncio.open_unix_connection(sock=sock, limit=(1024 * 1024))
+    while True:
+        line = await reader.readline()
+        if line == b'':
+            break
+        try:
+            req = json.loads(line.decode("utf-8"))
+            if req["method"] == "start":
+                result = await _call(pluginObj.start, req["argument"])
+            elif req["method"] == "stop":
+                await _call(pluginObj.stop)
+                result = None
+            elif req["method"] == "health":
+                result = bool(await _call(pluginObj.health)) if hasattr(pluginObj, "health") else True
+            elif req["method"] == "metrics":
+                result = dict(await _call(pluginObj.metrics)) if hasattr(pluginObj, "metrics") else dict()
+            else:
+                raise Exception("invalid method %s" % (req["method"]))
+            resp = {"result": result}
+        except Exception as e:
+            traceback.print_exc()
+            resp = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        writer.write(json.dumps(resp).encode("utf-8") + b"\n")
+        await writer.drain()
+
+
+async def _call(func, *args):
+    # plugin methods can be coroutines or normal functions
+    ret = func(*args)
+    if asyncio.iscoroutine(ret):
+        ret = await ret
+    return ret
+
+
+def _setRlimit(res, value):
+    # hard limit is lowered too, so that plugin can't raise it back
+    soft, hard = resource.getrlimit(res)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(res, (value, value))
+
+
+class _PluginV1:
+
+    # adapts a version 1 plugin module, which is a pair of synchronous functions
+
+    def __init__(self, mod):
+        self._mod = mod
+        self._moduleData = None
+
+    def start(self, argument):
+        apacheCfg, self._moduleData = self._mod.start(argument)
+        return apacheCfg
+
+    def stop(self):
+        self._mod.stop(self._moduleData)
+        self._moduleData = None
+
+
+if __name__ == "__main__":
+    main()
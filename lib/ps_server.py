@@ -4,8 +4,16 @@
 import os
 import glob
 import json
+import time
+import asyncio
+import logging
+import concurrent.futures
+from gi.repository import Gio
 from ps_util import PsUtil
+from ps_util import Histogram
+from ps_util import BatchScheduler
 from ps_param import PsConst
+from ps_main_httpd import PsMainHttpServer
 
 
 class PsServerManager:
@@ -13,10 +21,237 @@ class PsServerManager:
     def __init__(self, param):
         self.param = param
 
+        # server files are watched, changes are applied in batch
+        self._fileMonitor = None
+        self._changedSet = set()            # basename of changed server files
+        self._changeScheduler = BatchScheduler(0.5, 3, self._onChangeTimeout)
+        self._applyTask = None
+        self._busySet = set()               # id of servers being changed or restarted
+
+        self.startDurationHistogram = Histogram([0.1, 0.5, 1, 2, 5, 10, 30, 60])          # seconds used by successful server starts
+
     def loadServers(self):
         for fn in glob.glob(os.path.join(PsConst.etcDir, "*.server")):
             serverId = PsUtil.rreplace(os.path.basename(fn), ".server", "", 1)
-            self.param.serverDict[serverId] = PsServer(self.param, serverId, fn)
+            serverObj = PsServer(self.param, serverId, fn)
+            if self._isDomainNameUsed(serverObj.domainName, serverId):
+                raise Exception("server %s: domain name %s is already used" % (serverId, serverObj.domainName))
+            self.param.serverDict[serverId] = serverObj
+
+    def startServers(self):
+        # servers are started concurrently, a server which fails to start is removed from self.param.serverDict
+        # returns <server-id,main-httpd-config> for servers started successfully
+        for serverObj in self.param.serverDict.values():
+            self.param.pluginManager.getPlugin(serverObj.serverType)        # create plugin object in main thread
+        return self.param.mainloop.run_until_complete(self._startServers())
+
+    async def _startServers(self):
+        # servers in lazy mode are started by the activator on first request
+        ret = dict()
+        for serverObj in self.param.serverDict.values():
+            if serverObj.bLazy:
+                ret[serverObj.id] = serverObj.getPlaceholderMainHttpServerConfig()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.param.serverStartWorkers)
+        try:
+            serverObjList = [x for x in self.param.serverDict.values() if not x.bLazy]
+            cfgList = await asyncio.gather(*[self.startServer(x, executor) for x in serverObjList])
+        finally:
+            executor.shutdown(wait=False)
+
+        for serverObj, cfg in zip(serverObjList, cfgList):
+            if cfg is not None:
+                ret[serverObj.id] = cfg
+            else:
+                del self.param.serverDict[serverObj.id]
+        return ret
+
+    def stopServers(self):
+        for serverObj in self.param.serverDict.values():
+            serverObj.stop()
+
+    def startWatch(self):
+        self._fileMonitor = Gio.File.new_for_path(PsConst.etcDir).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self._fileMonitor.connect("changed", self._onFileChanged)
+
+    def stopWatch(self):
+        if self._fileMonitor is not None:
+            self._fileMonitor.cancel()
+            self._fileMonitor = None
+        self._changeScheduler.cancel()
+        if self._applyTask is not None:
+            self._applyTask.cancel()
+            self._applyTask = None
+
+    async def startServer(self, serverObj, executor=None):
+        # returns None if failed
+        startTime = time.monotonic()
+        future = self.param.mainloop.run_in_executor(executor, serverObj.startAndGetMainHttpServerConfig)
+        try:
+            cfg = await asyncio.wait_for(asyncio.shield(future), self.param.serverStartTimeout)
+            serverObj.startDuration = time.monotonic() - startTime
+            self.startDurationHistogram.observe(serverObj.startDuration)
+            logging.info("Server %s started in %.3f seconds, worker RSS %d KiB." % (serverObj.id, serverObj.startDuration, (serverObj.getWorkerRss() or 0) // 1024))
+            return cfg
+        except asyncio.TimeoutError:
+            logging.error("Server %s failed to start in %s seconds." % (serverObj.id, self.param.serverStartTimeout))
+            future.add_done_callback(lambda f: self._stopLateServer(serverObj, f))
+            return None
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda f: self._stopLateServer(serverObj, f))
+            raise
+        except Exception:
+            logging.error("Server %s failed to start." % (serverObj.id), exc_info=True)
+            return None
+
+    async def stopServer(self, serverObj):
+        # plugin worker calls block, they are done in executor threads
+        try:
+            await self.param.mainloop.run_in_executor(None, serverObj.stop)
+        except Exception:
+            logging.error("Failed to stop server %s." % (serverObj.id), exc_info=True)
+
+    def isServerBusy(self, serverId):
+        # server being changed or restarted must not be activated
+        return serverId in self._busySet
+
+    async def restartServer(self, serverId, delay=0):
+        # called when the plugin worker of a running server crashed, the server is started again after <delay> seconds
+        serverObj = self.param.serverDict.get(serverId)
+        if serverObj is None or serverObj.pluginRuntimeData is None or serverId in self._busySet:
+            return
+        self._busySet.add(serverId)
+        try:
+            if serverObj.bLazy:
+                # routed back to the activator, it would be started again by the next request
+                self.param.activator.removeServer(serverId)
+                await self.stopServer(serverObj)
+                self.param.mainServer.updateConfig(serverId, serverObj.getPlaceholderMainHttpServerConfig())
+                logging.info("Server %s hibernated." % (serverId))
+                return
+
+            await self.stopServer(serverObj)
+            await asyncio.sleep(delay)
+            if self.param.serverDict.get(serverId) is not serverObj:
+                return                                      # removed when restarting
+            cfg = await self.startServer(serverObj)
+            if cfg is None:
+                return
+            self.param.mainServer.updateConfig(serverId, cfg)
+            logging.info("Server %s restarted." % (serverId))
+        finally:
+            self._busySet.discard(serverId)
+
+    def _stopLateServer(self, serverObj, future):
+        if not future.cancelled() and future.exception() is None:
+            self.param.mainloop.create_task(self.stopServer(serverObj))
+
+    def _onFileChanged(self, monitor, fileObj, otherFileObj, eventType):
+        for f in [fileObj, otherFileObj]:
+            if f is not None and f.get_basename().endswith(".server"):
+                self._changedSet.add(f.get_basename())
+                self._changeScheduler.schedule()
+
+    def _onChangeTimeout(self, changeCount):
+        # changes are picked up by the running task
+        if self._applyTask is None:
+            self._applyTask = self.param.mainloop.create_task(self._applyChanges())
+
+    async def _applyChanges(self):
+        try:
+            while len(self._changedSet) > 0:
+                changedSet = self._changedSet
+                self._changedSet = set()
+                for basename in sorted(changedSet):
+                    await self._applyChange(basename)
+            self.param.mainServer.flushReload()             # all the changes are applied in one reload
+        except Exception:
+            logging.error("Failed to apply server file changes.", exc_info=True)
+        finally:
+            self._applyTask = None
+
+    async def _applyChange(self, basename):
+        serverId = PsUtil.rreplace(basename, ".server", "", 1)
+        self._busySet.add(serverId)
+        try:
+            await self._doApplyChange(serverId, os.path.join(PsConst.etcDir, basename))
+        finally:
+            self._busySet.discard(serverId)
+
+    async def _doApplyChange(self, serverId, fn):
+        oldObj = self.param.serverDict.get(serverId)
+        newObj = None
+        if os.path.exists(fn):
+            try:
+                if serverId.startswith("proxy-"):
+                    raise Exception("invalid server %s" % (serverId))     # "proxy-" prefix is reserved for external servers
+                newObj = PsServer(self.param, serverId, fn)
+            except Exception:
+                logging.error("Failed to load server file %s, ignored." % (fn), exc_info=True)
+                return
+        if oldObj is not None and newObj is not None and oldObj.isSameConfig(newObj):
+            return
+        if newObj is not None and self._isDomainNameUsed(newObj.domainName, serverId):
+            logging.error("Failed to load server file %s, domain name %s is already used, ignored." % (fn, newObj.domainName))
+            return
+
+        if oldObj is None:
+            # server added
+            cfg = await self._startOrGetPlaceholder(newObj)
+            if cfg is None:
+                return
+            self.param.serverDict[serverId] = newObj
+            self.param.mainServer.addConfig(serverId, cfg)
+            self.param.avahiObj.add_domain_name(newObj.domainName)
+            logging.info("Server %s added." % (serverId))
+            logging.info("URL \"http://%s\" is available for access." % (newObj.domainName))
+            return
+
+        # the old config is kept in main server until the new one is started
+        if self.param.activator is not None:
+            self.param.activator.removeServer(serverId)
+        await self.stopServer(oldObj)
+
+        if newObj is None:
+            # server removed
+            del self.param.serverDict[serverId]
+            self.param.mainServer.removeConfig(serverId)
+            self.param.avahiObj.remove_domain_name(oldObj.domainName)
+            logging.info("Server %s removed." % (serverId))
+            return
+
+        # server changed, it is restored to the old config if the new config fails to start
+        cfg = await self._startOrGetPlaceholder(newObj)
+        if cfg is None:
+            logging.error("Server %s failed to start with the changed config, the old config is restored." % (serverId))
+            newObj = oldObj
+            cfg = await self._startOrGetPlaceholder(oldObj)
+            if cfg is None:
+                del self.param.serverDict[serverId]
+                self.param.mainServer.removeConfig(serverId)
+                self.param.avahiObj.remove_domain_name(oldObj.domainName)
+                logging.info("Server %s removed." % (serverId))
+                return
+        self.param.serverDict[serverId] = newObj
+        self.param.mainServer.updateConfig(serverId, cfg)
+        if newObj.domainName != oldObj.domainName:
+            self.param.avahiObj.remove_domain_name(oldObj.domainName)
+            self.param.avahiObj.add_domain_name(newObj.domainName)
+        logging.info("Server %s changed." % (serverId))
+        logging.info("URL \"http://%s\" is available for access." % (newObj.domainName))
+
+    async def _startOrGetPlaceholder(self, serverObj):
+        # servers in lazy mode are started by the activator on first request
+        if serverObj.bLazy:
+            return serverObj.getPlaceholderMainHttpServerConfig()
+        return await self.startServer(serverObj)
+
+    def _isDomainNameUsed(self, domainName, serverId):
+        if any([x.domainName == domainName for x in self.param.serverDict.values() if x.id != serverId]):
+            return True
+        if self.param.apiServer is not None and self.param.apiServer.hasDomainName(domainName):
+            return True
+        return False
 
 
 class PsServer:
@@ -35,12 +270,36 @@ class PsServer:
         PsUtil.ensureDir(self.dataDir)
 
         # domain name
-        self.domainName = cfgDict["domain-name"]
-        if not self.domainName.endswith(".private"):
+        self.domainName = cfgDict["domain-name"].lower()                                           # domain names are case insensitive
+        if not self.domainName.endswith(".private") or not PsUtil.isValidDomainName(self.domainName):
             raise Exception("server %s: invalid domain-name %s" % (self.id, self.domainName))
         self.domainName = self.domainName.replace(".private", ".local")                             # FIXME
         del cfgDict["domain-name"]
 
+        # lazy mode, plugin is started on first request and stopped after being idle for some time
+        self.bLazy = False
+        if "lazy" in cfgDict:
+            self.bLazy = cfgDict["lazy"]
+            if not isinstance(self.bLazy, bool):
+                raise Exception("server %s: invalid lazy %s" % (self.id, self.bLazy))
+            del cfgDict["lazy"]
+        self.idleTimeout = 600
+        if "idle-timeout" in cfgDict:
+            self.idleTimeout = cfgDict["idle-timeout"]
+            if not (isinstance(self.idleTimeout, (int, float)) and not isinstance(self.idleTimeout, bool) and self.idleTimeout > 0):
+                raise Exception("server %s: invalid idle-timeout %s" % (self.id, self.idleTimeout))
+            del cfgDict["idle-timeout"]
+
+        # cache policy of main server, None if responses are not cached
+        self.cachePolicy = None
+        if "cache" in cfgDict:
+            try:
+                PsMainHttpServer.checkCachePolicy(cfgDict["cache"])
+            except Exception as e:
+                raise Exception("server %s: %s" % (self.id, e))
+            self.cachePolicy = cfgDict["cache"]
+            del cfgDict["cache"]
+
         # server type
         self.serverType = cfgDict["server-type"]
         if self.serverType not in self.param.pluginManager.getPluginNameList():
@@ -53,13 +312,57 @@ class PsServer:
         # pluginRuntimeData
         self.pluginRuntimeData = None
 
+        # seconds used by the last start and stop
+        self.startDuration = None
+        self.stopDuration = None
+
     def startAndGetMainHttpServerConfig(self):
         pluginObj = self.param.pluginManager.getPlugin(self.serverType)
         cfg, self.pluginRuntimeData = pluginObj.start(self.id, self.domainName, self.dataDir)
+        if not self.param.mainServer.isConfigSupported(cfg):
+            self.stop()
+            raise Exception("server %s: server type %s does not support http engine %s" % (self.id, self.serverType, self.param.httpEngine))
+        cfg = dict(cfg)
+        cfg["domain-name"] = self.domainName         # for https certificate
+        if self.cachePolicy is not None:
+            cfg["cache"] = self.cachePolicy
         return cfg
 
+    def getWorkerRss(self):
+        # returns None if the server is not running
+        if self.pluginRuntimeData is None:
+            return None
+        return self.pluginRuntimeData["worker"].getRss()
+
+    def isSameConfig(self, other):
+        return (self.domainName, self.serverType, self.bLazy, self.idleTimeout, self.cachePolicy, self.cfgDict) == \
+            (other.domainName, other.serverType, other.bLazy, other.idleTimeout, other.cachePolicy, other.cfgDict)
+
+    def getPlaceholderMainHttpServerConfig(self):
+        # requests are routed to the activator, host name in the backend url is used to identify the server
+        buf = ''
+        buf += 'ServerName %s\n' % (self.domainName)
+        buf += 'ProxyPass / "unix:%s|http://%s/"\n' % (PsConst.activatorFile, self.id)
+
+        return {
+            "module-dependencies": [
+                "mod_proxy.so",
+                "mod_proxy_http.so",
+            ],
+            "config-segment": buf,
+            "domain-name": self.domainName,
+            "backend": {
+                "unix": PsConst.activatorFile,
+                "host": self.id,
+            },
+        }
+
     def stop(self):
-        if self.pluginRuntimeData is not None:
+        # may be called in executor threads, a server is stopped only once
+        pluginRuntimeData, self.pluginRuntimeData = self.pluginRuntimeData, None
+        if pluginRuntimeData is not None:
+            startTime = time.monotonic()
             pluginObj = self.param.pluginManager.getPlugin(self.serverType)
-            pluginObj.stop(self.pluginRuntimeData)
-            self.pluginRuntimeData = None
+            pluginObj.stop(pluginRuntimeData)
+            self.stopDuration = time.monotonic() - startTime
+            logging.info("Server %s stopped in %.3f seconds." % (self.id, self.stopDuration))
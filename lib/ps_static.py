@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import gzip
+import logging
+import traceback
+from gi.repository import GLib
+try:
+    import brotli
+except ImportError:
+    brotli = None                   # only .gz files are generated
+
+
+class PsStaticCompressor:
+
+    """
+    Keep pre-compressed siblings (.gz and .br) of compressible files in static directories up to date,
+    so that main server sends them as is, without compressing for every request.
+    A sibling has the same mtime as its source file, it is re-generated when the mtime differs.
+    Siblings of sources which are removed or not worth compressing any more are removed.
+    Only siblings written by us are touched, they're recorded in memory and marked by an extended attribute, so that
+    those written before a restart are recognized, files of the same names provided by the plugin are served as is.
+    Directories are scanned periodically, the work is done in an executor thread.
+
+    Exampe:
+        obj = PsStaticCompressor(param, lambda: ["/tmp/pservers/web-root/server1"])
+        ...
+        obj.dispose()
+    """
+
+    siblingExtList = [".gz", ".br"]
+    siblingXattr = "user.pservers.sibling"
+    compressibleExtList = [".html", ".htm", ".css", ".js", ".mjs", ".json", ".map", ".svg", ".xml", ".txt", ".csv", ".md", ".wasm", ".ico", ".ttf", ".otf"]
+
+    def __init__(self, param, dirListFunc):
+        self.param = param
+        self.dirListFunc = dirListFunc
+        self.scanInterval = 30
+        self.minFileSize = 256                  # in bytes, smaller files gain nothing
+        self.maxFileSize = 64 * 1024 * 1024     # in bytes, bigger files are not compressed
+
+        self.compressCount = 0                  # siblings written
+        self.savedBytes = 0                     # bytes saved by the live siblings
+
+        self._siblingDict = dict()              # <sibling-file,saved-bytes>, siblings written by this object
+        self._skipDict = dict()                 # <source-file,(mtime,size)>, sources not worth compressing
+        self._bStop = False
+        self._scanTask = None
+        self._scanTimer = GLib.timeout_add_seconds(self.scanInterval, self._onScan)
+
+    def dispose(self):
+        self._bStop = True
+        GLib.source_remove(self._scanTimer)
+        if self._scanTask is not None:
+            self._scanTask.cancel()
+            self._scanTask = None
+
+    def _onScan(self):
+        # event callback, no exception is allowed
+        try:
+            if self._scanTask is None:
+                self._scanTask = self.param.mainloop.create_task(self._scan(self.dirListFunc()))
+        except Exception:
+            traceback.print_exc()
+        return True
+
+    async def _scan(self, dirList):
+        try:
+            await self.param.mainloop.run_in_executor(None, self._scanDirs, dirList)
+        except Exception:
+            logging.error("Failed to compress static files.", exc_info=True)
+        finally:
+            self._scanTask = None
+
+    def _scanDirs(self, dirList):
+        # runs in executor thread
+        sourceSet = set()
+        siblingList = []
+        for d in dirList:
+            for root, dirs, files in os.walk(d):
+                for fn in files:
+                    if self._bStop:
+                        return
+                    fullfn = os.path.join(root, fn)
+                    if fn[-3:] in self.siblingExtList and os.path.splitext(fn[:-3])[1].lower() in self.compressibleExtList:
+                        siblingList.append(fullfn)
+                    elif os.path.splitext(fn)[1].lower() in self.compressibleExtList and not os.path.islink(fullfn):
+                        sourceSet.add(fullfn)
+                        try:
+                            self._check(fullfn)
+                        except OSError as e:
+                            logging.warning("Failed to compress %s, %s." % (fullfn, e))     # the file may be removed when compressing
+
+        # siblings whose source is removed, ".gz" and ".br" are both 3 characters
+        for sibling in list(self._siblingDict):
+            if sibling[:-3] not in sourceSet:
+                self._removeSibling(sibling)
+        for sibling in siblingList:
+            if not os.path.lexists(sibling[:-3]):
+                self._removeSibling(sibling)                # written before a restart, or not written by us and kept
+        for fullfn in list(self._skipDict):
+            if fullfn not in sourceSet:
+                del self._skipDict[fullfn]
+
+    def _check(self, fullfn):
+        try:
+            st = os.stat(fullfn)
+        except FileNotFoundError:
+            return
+        if self._skipDict.get(fullfn) == (st.st_mtime_ns, st.st_size):
+            return
+        if not (self.minFileSize <= st.st_size <= self.maxFileSize):
+            # an existing sibling would be stale
+            for ext in self.siblingExtList:
+                self._removeSibling(fullfn + ext)
+            self._skipDict[fullfn] = (st.st_mtime_ns, st.st_size)
+            return
+
+        funcDict = {".gz": _gzipCompress}
+        if brotli is not None:
+            funcDict[".br"] = brotli.compress
+        todoList = []
+        for ext in self.siblingExtList:
+            sibling = fullfn + ext
+            try:
+                sibSt = os.stat(sibling)
+            except FileNotFoundError:
+                sibSt = None
+            if sibSt is not None and sibling not in self._siblingDict:
+                if not self._isMarked(sibling):
+                    continue                                # not written by us, never touched
+                self._siblingDict[sibling] = st.st_size - sibSt.st_size     # written before a restart
+                self.savedBytes += st.st_size - sibSt.st_size
+            if sibSt is not None and sibSt.st_mtime_ns == st.st_mtime_ns:
+                pass
+            elif ext in funcDict:
+                todoList.append(ext)
+            elif sibSt is not None:
+                self._removeSibling(sibling)                # stale, it can't be re-generated without brotli
+        if len(todoList) == 0:
+            return
+
+        with open(fullfn, "rb") as f:
+            buf = f.read()
+        for ext in todoList:
+            cbuf = funcDict[ext](buf)
+            if len(cbuf) > len(buf) * 0.9:
+                # not worth it, an existing sibling would be stale
+                self._removeSibling(fullfn + ext)
+                self._skipDict[fullfn] = (st.st_mtime_ns, st.st_size)
+                continue
+            tmpFn = fullfn + ext + ".tmp"
+            with open(tmpFn, "wb") as f:
+                f.write(cbuf)
+            try:
+                os.setxattr(tmpFn, self.siblingXattr, b'1')
+            except OSError:
+                pass                                        # not supported by the filesystem, only recorded in memory
+            os.utime(tmpFn, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.rename(tmpFn, fullfn + ext)
+            self.savedBytes += len(buf) - len(cbuf) - self._siblingDict.get(fullfn + ext, 0)
+            self._siblingDict[fullfn + ext] = len(buf) - len(cbuf)
+            self.compressCount += 1
+
+    def _removeSibling(self, sibling):
+        if sibling not in self._siblingDict and not self._isMarked(sibling):
+            return
+        try:
+            os.unlink(sibling)
+        except FileNotFoundError:
+            pass
+        self.savedBytes -= self._siblingDict.pop(sibling, 0)
+
+    def _isMarked(self, sibling):
+        try:
+            os.getxattr(sibling, self.siblingXattr, follow_symlinks=False)
+            return True
+        except OSError:
+            return False
+
+
+def _gzipCompress(buf):
+    return gzip.compress(buf, compresslevel=9)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
-import sys
+import re
 import time
 import dbus
 import json
@@ -10,10 +10,12 @@ import stat
 import prctl
 import ctypes
 import shutil
+import bisect
 import random
+import resource
 import socket
-import psutil
 import struct
+import asyncio
 import logging
 import traceback
 import subprocess
@@ -25,6 +27,9 @@ from dbus.mainloop.glib import DBusGMainLoop
 
 class PsUtil:
 
+    _probeMinInterval = 0.01
+    _probeMaxInterval = 0.5
+
     @staticmethod
     def getUnixDomainSocketPeerInfo(sock):
         # returns (pid, uid, gid)
@@ -50,6 +55,13 @@ class PsUtil:
         # https://stackoverflow.com/questions/9943504/right-to-left-string-replace-in-python
         return dst.join(s.rsplit(sub, count))
 
+    @staticmethod
+    def isValidDomainName(domainName):
+        # domain names are also used as file names, there must be no "/", whitespace or empty label
+        if not isinstance(domainName, str) or len(domainName) > 253:
+            return False
+        return all([re.fullmatch("[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?", x) is not None for x in domainName.split(".")])
+
     @staticmethod
     def isPathOverlap(path, pathList):
         for p in pathList:
@@ -93,6 +105,12 @@ class PsUtil:
             ret.check_returncode()
         return ret.stdout.rstrip()
 
+    @staticmethod
+    def raiseNoFileLimit():
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
     @staticmethod
     def writePidFile(filename):
         with open(filename, "w") as f:
@@ -155,26 +173,29 @@ class PsUtil:
 
         cert = crypto.X509()
         cert.get_subject().CN = cn
-        cert.set_serial_number(random.randint(0, 65535))
+        cert.set_serial_number(random.SystemRandom().getrandbits(63))
         cert.gmtime_adj_notBefore(100 * 365 * 24 * 60 * 60 * -1)
         cert.gmtime_adj_notAfter(100 * 365 * 24 * 60 * 60)
         cert.set_issuer(caCert.get_subject())
         cert.set_pubkey(k)
-        cert.sign(caKey, 'sha1')
+        cert.sign(caKey, 'sha256')
 
         return (cert, k)
 
     @staticmethod
     def dumpCertAndKey(cert, key, certFile, keyFile):
-        with open(certFile, "wb") as f:
-            buf = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-            f.write(buf)
-            os.fchmod(f.fileno(), 0o644)
+        # key is written first, an interrupted write leaves a certificate not matching its key
+        PsUtil.atomicWriteFile(keyFile, crypto.dump_privatekey(crypto.FILETYPE_PEM, key), 0o600)
+        PsUtil.atomicWriteFile(certFile, crypto.dump_certificate(crypto.FILETYPE_PEM, cert), 0o644)
 
-        with open(keyFile, "wb") as f:
-            buf = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+    @staticmethod
+    def atomicWriteFile(filename, buf, mode=0o644):
+        # buf is str or bytes, the file is replaced by rename so that readers never see partial content
+        tmpFn = filename + ".tmp"
+        with open(tmpFn, "wb" if isinstance(buf, bytes) else "w") as f:
+            os.fchmod(f.fileno(), mode)
             f.write(buf)
-            os.fchmod(f.fileno(), 0o600)
+        os.rename(tmpFn, filename)
 
     @staticmethod
     def is_int(s):
@@ -266,20 +287,84 @@ class PsUtil:
                 assert False
 
     @staticmethod
-    def waitSocketPortForProc(portType, ip, port, proc, timeout=10):
+    def isSocketPortListening(portType, ip, port):
+        # only the target listener is checked, other sockets on the machine are not enumerated
         assert portType in ["tcp", "udp"]
-        for i in range(0, timeout*10):
+        if portType == "tcp":
+            ip = PsUtil._probeAddress(ip)
+            with socket.socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.settimeout(1.0)
+                return s.connect_ex((ip, port)) == 0
+        else:
+            return PsUtil._isUdpPortBound(port)
+
+    @staticmethod
+    async def isSocketPortListeningAsync(portType, ip, port):
+        # same as isSocketPortListening(), but the mainloop is not blocked when connecting
+        assert portType in ["tcp", "udp"]
+        if portType == "tcp":
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(PsUtil._probeAddress(ip), port), 1.0)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            return True
+        else:
+            return PsUtil._isUdpPortBound(port)
+
+    @staticmethod
+    def waitSocketPortForProc(portType, ip, port, proc, timeout=10):
+        for delay in PsUtil._probeDelays(proc, timeout):
+            if PsUtil.isSocketPortListening(portType, ip, port):
+                return
+            time.sleep(delay)
+
+    @staticmethod
+    async def waitSocketPortForProcAsync(portType, ip, port, proc, timeout=10):
+        # same as waitSocketPortForProc(), but the mainloop is not blocked when waiting
+        for delay in PsUtil._probeDelays(proc, timeout):
+            if await PsUtil.isSocketPortListeningAsync(portType, ip, port):
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _probeDelays(proc, timeout):
+        # yields before every probe, the value is the delay after a failed probe
+        # the last probe is done at the deadline
+        deadline = time.monotonic() + timeout
+        interval = PsUtil._probeMinInterval
+        while True:
             if proc.poll() is not None:
                 raise Exception("process terminated")
-            time.sleep(0.1)
-            for c in psutil.net_connections(kind=portType):
-                # if c.pid == proc.pid and c.status == "LISTEN":        # FIXME: for apache, c.pid is wrong, result of netstat is right
-                if c.status == "LISTEN":
-                    if c.family == socket.AF_INET and c.laddr[0] == ip and c.laddr[1] == port:
-                        return
-                    if ip == "0.0.0.0" and c.family == socket.AF_INET6 and c.laddr[0] == "::" and c.laddr[1] == port:
-                        return
-        raise Exception("timeout")
+            remain = deadline - time.monotonic()
+            yield max(min(interval, remain), 0)
+            if remain <= 0:
+                raise Exception("timeout")
+            interval = min(interval * 2, PsUtil._probeMaxInterval)
+
+    @staticmethod
+    def _probeAddress(ip):
+        if ip == "0.0.0.0":
+            return "127.0.0.1"
+        elif ip == "::":
+            return "::1"
+        else:
+            return ip
+
+    @staticmethod
+    def _isUdpPortBound(port):
+        # there's no connect probe for udp, local address is not checked
+        portStr = ":%04X" % (port)
+        for fn in ["/proc/net/udp", "/proc/net/udp6"]:
+            if not os.path.exists(fn):
+                continue
+            with open(fn) as f:
+                next(f)
+                for line in f:
+                    tlist = line.split()
+                    if tlist[1].endswith(portStr) and tlist[3] == "07":       # TCP_CLOSE, which means bound for udp
+                        return True
+        return False
 
     @staticmethod
     def touchFile(filename):
@@ -301,20 +386,211 @@ class PsUtil:
         return syscall_number
 
 
-class StdoutRedirector:
+class BatchScheduler:
 
-    def __init__(self, filename):
-        self.terminal = sys.stdout
-        self.log = open(filename, "a")
+    """
+    Coalesce change notifications into batches, the callback is called once per batch.
+    The callback is called <window> seconds after the last change, but no later than
+    <maxLatency> seconds after the first change of the batch.
 
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
-        self.log.flush()
+    Exampe:
+        obj = BatchScheduler(0.5, 3, func)      # func(changeCount)
+        obj.schedule()
+        obj.schedule()
+        ...
+        obj.cancel()
+    """
+
+    def __init__(self, window, maxLatency, func):
+        assert 0 <= window <= maxLatency
+
+        self.window = window
+        self.maxLatency = maxLatency
+        self.func = func
+
+        self._timer = None
+        self._firstTime = None
+        self._changeCount = 0
+        self.lastDelay = None           # seconds from the first change to the callback, of the last batch
+
+    @property
+    def pending(self):
+        return self._changeCount > 0
+
+    def schedule(self):
+        now = time.monotonic()
+        if self._changeCount == 0:
+            self._firstTime = now
+        self._changeCount += 1
+
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+        delay = min(self.window, self._firstTime + self.maxLatency - now)
+        self._timer = GLib.timeout_add(max(int(delay * 1000), 0), self.__timeoutFire)
 
     def flush(self):
-        self.terminal.flush()
-        self.log.flush()
+        if self._changeCount > 0:
+            self.__fire()
+
+    def cancel(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        self._firstTime = None
+        self._changeCount = 0
+
+    def __timeoutFire(self):
+        self._timer = None
+        try:
+            self.__fire()
+        except Exception:
+            # absorb exception raised by upper layer function
+            traceback.print_exc()
+        return False
+
+    def __fire(self):
+        changeCount = self._changeCount
+        self.lastDelay = time.monotonic() - self._firstTime
+        self.cancel()
+        self.func(changeCount)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._lastTime = time.monotonic()
+
+    def consume(self, n=1):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._lastTime) * self.rate)
+        self._lastTime = now
+        if self._tokens < n:
+            return False
+        self._tokens -= n
+        return True
+
+
+class Histogram:
+
+    """
+    Histogram with fixed buckets, in prometheus style, bucket <le> counts values less than or equal to <le>.
+    Observing a value costs a binary search and no allocation.
+
+    Exampe:
+        obj = Histogram([0.01, 0.1, 1])
+        obj.observe(0.05)
+        for le, count in obj.getCumulativeCountList():
+            ...
+    """
+
+    def __init__(self, bucketList):
+        self.bucketList = sorted(bucketList)
+        self.count = 0
+        self.sum = 0
+
+        self._countList = [0] * len(self.bucketList)        # values bigger than the last bucket are only in self.count
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        i = bisect.bisect_left(self.bucketList, value)
+        if i < len(self._countList):
+            self._countList[i] += 1
+
+    def getQuantile(self, q):
+        # estimated by linear interpolation inside the bucket, returns None if there's no observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        lower = 0
+        total = 0
+        for le, count in zip(self.bucketList, self._countList):
+            if count > 0 and total + count >= rank:
+                return lower + (le - lower) * (rank - total) / count
+            total += count
+            lower = le
+        return self.bucketList[-1]                          # in the +Inf bucket
+
+    def getCumulativeCountList(self):
+        # returns [(le,count)], the last item is ("+Inf",self.count)
+        ret = []
+        total = 0
+        for le, count in zip(self.bucketList, self._countList):
+            total += count
+            ret.append((le, total))
+        ret.append(("+Inf", self.count))
+        return ret
+
+
+class LineFramer:
+
+    """
+    Split a byte stream into newline terminated frames.
+    Data is received into a reusable buffer through a memoryview, consumed frames are dropped in batch,
+    and newline search resumes where the last search stopped, so no byte is scanned twice.
+
+    Exampe:
+        obj = LineFramer()
+        while obj.recvFrom(sock) > 0:
+            while True:
+                frame = obj.popFrame()
+                if frame is None:
+                    break
+                ...
+    """
+
+    def __init__(self, maxFrameSize=(1024 * 1024), recvSize=65536):
+        self.maxFrameSize = maxFrameSize
+
+        self._buf = bytearray()
+        self._start = 0             # self._buf[:self._start] is consumed
+        self._scanPos = 0           # there's no newline in self._buf[self._start:self._scanPos]
+        self._recvSize = recvSize
+        self._recvBuf = None        # allocated by the first recvFrom(), feed() never uses it
+        self._recvView = None
+
+    @property
+    def bufferedSize(self):
+        return len(self._buf) - self._start
+
+    def feed(self, data):
+        self._buf += data
+
+    def recvFrom(self, sock):
+        # returns 0 when remote closed
+        if self._recvBuf is None:
+            self._recvBuf = bytearray(self._recvSize)
+            self._recvView = memoryview(self._recvBuf)
+        n = sock.recv_into(self._recvBuf)
+        self._buf += self._recvView[:n]
+        return n
+
+    def popFrame(self):
+        # returns None if there's no complete frame, the returned frame is a bytearray
+        i = self._buf.find(b'\n', self._scanPos)
+        if i < 0:
+            self._scanPos = len(self._buf)
+            self._compact()
+            if self.bufferedSize > self.maxFrameSize:
+                raise Exception("frame too large")
+            return None
+        if i - self._start > self.maxFrameSize:
+            raise Exception("frame too large")
+
+        ret = self._buf[self._start:i]
+        self._start = i + 1
+        self._scanPos = self._start
+        return ret
+
+    def _compact(self):
+        if self._start > 0:
+            del self._buf[:self._start]
+            self._scanPos -= self._start
+            self._start = 0
 
 
 class DynObject:
@@ -324,10 +600,14 @@ class DynObject:
 
 class UnixDomainSocketApiServer:
 
-    def __init__(self, serverFile, clientAppearFunc, clientDisappearFunc, notifyFunc):
-        # Parameter clientAppearFunc is called after client appears.
+    def __init__(self, serverFile, clientAppearFunc, clientDisappearFunc, notifyFunc, errorFunc=None, backlog=4096):
+        # Parameter clientAppearFunc is called after client appears, it raises ClientRejectedError to close the client quietly.
         # Parameter clientDisappearFunc is called after we find client disappears and before we destroy the client object.
         # Parameter clientDisappearFunc can be None.
+        # If parameter notifyFunc returns a value other than None, the value is sent back to the client as a json line.
+        # Parameter errorFunc is called as errorFunc(clientData, data, exception) when a frame is not valid json (data is None)
+        # or notifyFunc raises exception, its return value is sent back in the same way. Parameter errorFunc can be None.
+        # This object must be created before the asyncio mainloop runs.
 
         assert serverFile is not None
         assert clientAppearFunc is not None and notifyFunc is not None
@@ -335,83 +615,140 @@ class UnixDomainSocketApiServer:
         self.clientAppearFunc = clientAppearFunc
         self.clientDisappearFunc = clientDisappearFunc
         self.notifyFunc = notifyFunc
+        self.errorFunc = errorFunc
+
+        self.maxFrameSize = 1024 * 1024
+        self.maxFramesPerWakeup = 64                # so that one client can not starve the others
+        self.recvSize = 65536
 
+        # asyncio accepts at most <backlog> pending connections in one wakeup
+        self._loop = asyncio.get_event_loop()
         self.serverSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.serverSock.bind(serverFile)
-        self.serverSock.listen(5)
-        self.serverSourceId = GLib.io_add_watch(self.serverSock, GLib.IO_IN, self.onServerAccept)
+        self.serverSock.listen(backlog)
+        coro = asyncio.start_unix_server(self._onClientConnected, sock=self.serverSock, limit=self.recvSize, backlog=backlog)
+        self._server = self._loop.run_until_complete(coro)
+        self._bDisposing = False
 
         self.clientInfoDict = dict()
 
     def dispose(self):
-        for sock, obj in self.clientInfoDict.items():
-            GLib.source_remove(obj.inWatch)
-            sock.close()
-        GLib.source_remove(self.serverSourceId)
-        self.serverSock.close()
-
-    def onServerAccept(self, source, cb_condition):
+        self._bDisposing = True
+        self._server.close()
+        taskList = []
+        for obj in self.clientInfoDict.values():
+            obj.task.cancel()
+            obj.writer.close()
+            taskList.append(obj.task)
+        if len(taskList) > 0 and not self._loop.is_running():
+            self._loop.run_until_complete(asyncio.gather(*taskList, return_exceptions=True))
+        self.clientInfoDict.clear()
+
+    def _onClientConnected(self, reader, writer):
         # event callback, no exception is allowed
 
-        new_sock, addr = source.accept()
-
+        sock = writer.get_extra_info("socket")
         try:
-            data = self.clientAppearFunc(new_sock)
+            data = self.clientAppearFunc(sock)
+        except ClientRejectedError:
+            # logged by upper layer
+            writer.close()
+            return
         except Exception:
             # absorb exception raised by upper layer function
             traceback.print_exc()
-            new_sock.close()
-            return True
+            writer.close()
+            return
 
         obj = DynObject()
-        obj.inWatch = GLib.io_add_watch(new_sock, GLib.IO_IN | GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL, self.onRecv)
-        obj.recvBuf = b''
+        obj.writer = writer
+        obj.framer = LineFramer(self.maxFrameSize)
         obj.clientData = data
-        self.clientInfoDict[new_sock] = obj
-        return True
+        obj.task = self._loop.create_task(self._handleClient(sock, reader, obj))
+        self.clientInfoDict[sock] = obj
 
-    def onRecv(self, source, cb_condition):
-        bCloseSocket = False
+    async def _handleClient(self, sock, reader, obj):
         try:
-            obj = self.clientInfoDict[source]
-
-            # receive and parse
-            obj.recvBuf += source.recv(4096)
             while True:
-                i = obj.recvBuf.find(b'\n')
-                if i < 0:
+                buf = await reader.read(self.recvSize)
+                if buf == b'':
                     break
-                jsonObj = json.loads(obj.recvBuf[:i].decode("utf-8"))
-                obj.recvBuf = obj.recvBuf[i + 1:]
+                obj.framer.feed(buf)
+                await self._processFrames(obj)
+
+            # remote closed
+            if obj.framer.bufferedSize > 0:
+                raise Exception("remote close")
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if not self._bDisposing:
+                self._closeClient(sock)
+
+    async def _processFrames(self, obj):
+        # replies are sent in batch, exception for framing error is not absorbed, client would be closed
+        sendBuf = bytearray()
+        count = 0
+        while True:
+            frame = obj.framer.popFrame()
+            if frame is None:
+                break
+            try:
+                data = json.loads(frame.decode("utf-8"))
+            except ValueError as e:
+                ret = self._callErrorFunc(obj, None, e)
+            else:
                 try:
-                    self.notifyFunc(obj.clientData, jsonObj)
-                except Exception:
-                    # absorb exception raised by upper layer function, FIXME
+                    ret = self.notifyFunc(obj.clientData, data)
+                except Exception as e:
+                    # absorb exception raised by upper layer function, the bad frame is dropped
                     print("upper layer exception")
                     traceback.print_exc()
-                    raise
+                    ret = self._callErrorFunc(obj, data, e)
+            if ret is not None:
+                sendBuf += json.dumps(ret).encode("utf-8")
+                sendBuf += b'\n'
+
+            count += 1
+            if count % self.maxFramesPerWakeup == 0:
+                await self._sendReply(obj, sendBuf)
+                sendBuf = bytearray()
+                await asyncio.sleep(0)
+        await self._sendReply(obj, sendBuf)
+
+    def _callErrorFunc(self, obj, data, e):
+        if self.errorFunc is None:
+            return None
+        try:
+            return self.errorFunc(obj.clientData, data, e)
+        except Exception:
+            # absorb exception raised by upper layer function
+            traceback.print_exc()
+            return None
 
-            # remote closed
-            if (cb_condition & GLib.IO_HUP):
-                bCloseSocket = True
-                if len(obj.recvBuf) > 0:
-                    raise Exception("remote close")
+    async def _sendReply(self, obj, buf):
+        # backpressure: we stop reading from client until the reply is sent
+        if len(buf) > 0:
+            obj.writer.write(buf)
+            await obj.writer.drain()
+
+    def _closeClient(self, sock):
+        obj = self.clientInfoDict[sock]
+        try:
+            if self.clientDisappearFunc is not None:
+                self.clientDisappearFunc(obj.clientData)
         except Exception:
-            print("excp IO_IN, %d" % (cb_condition & GLib.IO_IN))               # FIXME
-            print("excp IO_PRI, %d" % (cb_condition & GLib.IO_PRI))
-            print("excp IO_ERR, %d" % (cb_condition & GLib.IO_ERR))
-            print("excp IO_HUP, %d" % (cb_condition & GLib.IO_HUP))
-            print("excp IO_NVAL, %d" % (cb_condition & GLib.IO_NVAL))
+            # absorb exception raised by upper layer function
             traceback.print_exc()
         finally:
-            if bCloseSocket:
-                if self.clientDisappearFunc is not None:
-                    self.clientDisappearFunc(self.clientInfoDict[source].clientData)
-                del self.clientInfoDict[source]
-                source.close()
-                return False
-            else:
-                return True
+            del self.clientInfoDict[sock]
+            obj.writer.close()
+
+
+class ClientRejectedError(Exception):
+    pass
 
 
 class DropPriviledge:
@@ -473,6 +810,10 @@ class DropPriviledge:
 class AvahiDomainNameRegister:
 
     """
+    Every domain name has its own entry group, so adding or removing a domain name doesn't touch the others.
+    Changes are coalesced and applied in batch.
+    All D-Bus calls are asynchronous, the mainloop is never blocked by avahi-daemon.
+
     Exampe:
         obj = AvahiDomainNameRegister()
         obj.add_domain_name(domainName1)
@@ -484,39 +825,61 @@ class AvahiDomainNameRegister:
 
     def __init__(self):
         self.retryInterval = 30
-        self.domainList = []
+        self.callTimeout = 10
+        self.domainSet = set()
+        self.callLatencyHistogram = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])     # seconds of D-Bus calls, errors included
+        self.callErrorCount = 0
 
+        self._bus = None
+        self._ownerChangeHandler = None
         self._server = None
+        self._serverStateHandler = None
+        self._serverGeneration = 0              # replies for a released server are ignored
         self._retryCreateServerTimer = None
-        self._entryGroup = None
+        self._hostnameRData = None              # cached, invalidated when server state changes
+        self._bHostnameQuerying = False
+        self._bRegistered = False
+        self._entryGroupDict = dict()           # <domain-name,entry-group-info>
+        self._dirtySet = set()                  # domain names whose entry group is not in sync with self.domainSet
+        self._syncScheduler = BatchScheduler(0.2, 1, self.__syncTimeout)
         self._retryRegisterTimer = None
-        self._ownerChangeHandler = None
+        self._collisionSet = set()
+        self._retryCollisionTimer = None
 
     def start(self):
         DBusGMainLoop(set_as_default=True)
 
-        if dbus.SystemBus().name_has_owner("org.freedesktop.Avahi"):
-            self._createServer()
-        self._ownerChangeHandler = dbus.SystemBus().add_signal_receiver(self.onNameOwnerChanged, "NameOwnerChanged", None, None)
+        self._bus = dbus.SystemBus()
+        self._ownerChangeHandler = self._bus.add_signal_receiver(self.onNameOwnerChanged, "NameOwnerChanged", "org.freedesktop.DBus",
+                                                                 arg0="org.freedesktop.Avahi")
+        generation = self._serverGeneration
+        busObj = self._bus.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus", introspect=False)
+        busObj.NameHasOwner("org.freedesktop.Avahi", dbus_interface="org.freedesktop.DBus", timeout=self.callTimeout,
+                            **self.__handlers(lambda ret: self.__onNameHasOwner(generation, ret),
+                                              lambda e: logging.error("Avahi name query failed, %s" % (e))))
 
     def stop(self):
         if self._ownerChangeHandler is not None:
-            dbus.SystemBus().remove_signal_receiver(self._ownerChangeHandler)
+            self._ownerChangeHandler.remove()
             self._ownerChangeHandler = None
         self._unregister()
         self._releaseServer()
+        self._bus = None
 
     def add_domain_name(self, domain_name):
         assert isinstance(domain_name, str)
 
-        self.domainList.append(domain_name)
-        if self._entryGroup is not None:
-            self._refreshEntryGroup()
+        self.domainSet.add(domain_name)
+        self._markDirty(domain_name)
 
     def remove_domain_name(self, domain_name):
-        self.domainList.remove(domain_name)
-        if self._entryGroup is not None:
-            self._refreshEntryGroup()
+        self.domainSet.remove(domain_name)
+        self._markDirty(domain_name)
+
+    @property
+    def recordCount(self):
+        # number of records committed to avahi-daemon
+        return len([x for x in self._entryGroupDict.values() if x.bCommitted])
 
     def onNameOwnerChanged(self, name, old, new):
         if name == "org.freedesktop.Avahi":
@@ -534,25 +897,33 @@ class AvahiDomainNameRegister:
 
     def _createServer(self):
         assert self._server is None and self._retryCreateServerTimer is None
-        assert self._entryGroup is None
-        try:
-            self._server = dbus.Interface(dbus.SystemBus().get_object("org.freedesktop.Avahi", "/"), "org.freedesktop.Avahi.Server")
-            if self._server.GetState() == 2:    # avahi.SERVER_RUNNING
-                self._register()
-            self._server.connect_to_signal("StateChanged", self.onSeverStateChanged)
-        except Exception:
-            logging.error("Avahi create server failed, retry in %d seconds" % (self.retryInterval), exc_info=True)
-            self._releaseServer()
-            self._retryCreateServer()
+        assert not self._bRegistered
+
+        generation = self._serverGeneration
+        self._server = dbus.Interface(self._bus.get_object("org.freedesktop.Avahi", "/", introspect=False), "org.freedesktop.Avahi.Server")
+        self._serverStateHandler = self._server.connect_to_signal("StateChanged", self.onSeverStateChanged)
+        self._server.GetState(timeout=self.callTimeout,
+                              **self.__handlers(lambda state: self.__onGetState(generation, state),
+                                                lambda e: self.__onCreateServerError(generation, e)))
 
     def _releaseServer(self):
-        assert self._entryGroup is None
+        assert not self._bRegistered
         if self._retryCreateServerTimer is not None:
             GLib.source_remove(self._retryCreateServerTimer)
             self._retryCreateServerTimer = None
+        if self._serverStateHandler is not None:
+            self._serverStateHandler.remove()
+            self._serverStateHandler = None
         self._server = None
+        self._serverGeneration += 1
+        self._hostnameRData = None
+        self._bHostnameQuerying = False
 
     def onSeverStateChanged(self, state, error):
+        # host name may be changed, replies of in-progress server calls are outdated
+        self._serverGeneration += 1
+        self._hostnameRData = None
+        self._bHostnameQuerying = False
         if state == 2:      # avahi.SERVER_RUNNING
             self._unregister()
             self._register()
@@ -560,60 +931,89 @@ class AvahiDomainNameRegister:
             self._unregister()
 
     def _register(self):
-        assert self._entryGroup is None and self._retryRegisterTimer is None
-        try:
-            self._entryGroup = dbus.Interface(dbus.SystemBus().get_object("org.freedesktop.Avahi", self._server.EntryGroupNew()),
-                                              "org.freedesktop.Avahi.EntryGroup")
-            self._refreshEntryGroup()
-            self._entryGroup.connect_to_signal("StateChanged", self.onEntryGroupStateChanged)
-        except Exception:
-            logging.error("Avahi register domain name failed, retry in %d seconds" % (self.retryInterval), exc_info=True)
-            self._unregister()
-            self._retryRegisterService()
+        assert not self._bRegistered and self._retryRegisterTimer is None
+        self._bRegistered = True
+        self._dirtySet = set(self.domainSet)
+        self._syncEntryGroups()
 
     def _unregister(self):
         if self._retryRegisterTimer is not None:
             GLib.source_remove(self._retryRegisterTimer)
             self._retryRegisterTimer = None
-        if self._entryGroup is not None:
-            try:
-                if self._entryGroup.GetState() != 4:        # avahi.ENTRY_GROUP_FAILURE
-                    self._entryGroup.Reset()                # why there's no commit after reset?
-                    self._entryGroup.Free()                 # why not free directly?
-                    # .Free() has mem leaks?
-                    self._entryGroup._obj._bus = None
-                    self._entryGroup._obj = None
-            except dbus.exceptions.DBusException:
-                pass                                        # add log message?
-            finally:
-                self._entryGroup = None
-
-    def _refreshEntryGroup(self):
-        hostname = self._server.GetHostNameFqdn()
-        hostnameRData = self.__encodeRDATA(hostname)
-        self._entryGroup.Reset()
-        for domainName in self.domainList:
-            self._entryGroup.AddRecord(-1,                              # interface = avahi.IF_UNSPEC
-                                       0,                               # protocol = avahi.PROTO_UNSPEC
-                                       dbus.UInt32(0),                  # flags
-                                       self.__encodeCNAME(domainName),  # name
-                                       0x01,                            # CLASS_IN
-                                       0X05,                            # TYPE_CNAME
-                                       60,                              # TTL
-                                       hostnameRData)                   # rdata
-        self._entryGroup.Commit()
-
-    def onEntryGroupStateChanged(self, state, error):
+        if self._retryCollisionTimer is not None:
+            GLib.source_remove(self._retryCollisionTimer)
+            self._retryCollisionTimer = None
+        self._syncScheduler.cancel()
+        for domainName in list(self._entryGroupDict):
+            self._removeEntryGroup(domainName)
+        self._dirtySet.clear()
+        self._collisionSet.clear()
+        self._bRegistered = False
+
+    def _markDirty(self, domainName):
+        self._dirtySet.add(domainName)
+        if self._bRegistered:
+            self._syncScheduler.schedule()
+
+    def _syncEntryGroups(self):
+        if self._hostnameRData is None:
+            # dirty domain names are synced after we get the host name
+            if not self._bHostnameQuerying:
+                generation = self._serverGeneration
+                self._bHostnameQuerying = True
+                self._server.GetHostNameFqdn(timeout=self.callTimeout,
+                                             **self.__handlers(lambda hostname: self.__onGetHostNameFqdn(generation, hostname),
+                                                               lambda e: self.__onRegisterError(generation, e)))
+            return
+
+        dirtySet = self._dirtySet
+        self._dirtySet = set()
+        for domainName in dirtySet:
+            if domainName in self.domainSet and domainName not in self._entryGroupDict:
+                self._addEntryGroup(domainName)
+            elif domainName not in self.domainSet and domainName in self._entryGroupDict:
+                self._removeEntryGroup(domainName)
+
+    def _addEntryGroup(self, domainName):
+        # entry group info is replaced or removed when the call is in progress, which is detected in reply handlers
+        info = DynObject()
+        info.entryGroup = None
+        info.signalMatch = None
+        info.bCommitted = False
+        self._entryGroupDict[domainName] = info
+
+        self._server.EntryGroupNew(timeout=self.callTimeout,
+                                   **self.__handlers(lambda path: self.__onEntryGroupNew(domainName, info, path),
+                                                     lambda e: self.__onEntryGroupError(domainName, info, e)))
+
+    def _removeEntryGroup(self, domainName):
+        info = self._entryGroupDict.pop(domainName)
+        if info.signalMatch is not None:
+            info.signalMatch.remove()
+        if info.entryGroup is not None:
+            self._freeEntryGroup(info.entryGroup)
+
+    def _freeEntryGroup(self, entryGroup):
+        entryGroup.Free(timeout=self.callTimeout,
+                        **self.__handlers(lambda: None,
+                                          lambda e: None))      # add log message?
+
+    def onEntryGroupStateChanged(self, domainName, state, error):
         if state in [0, 1, 2]:  # avahi.ENTRY_GROUP_UNCOMMITED, avahi.ENTRY_GROUP_REGISTERING, avahi.ENTRY_GROUP_ESTABLISHED
             pass
-        elif state == 3:        # avahi.ENTRY_GROUP_COLLISION
-            self._unregister()
-            self._retryRegisterService()
-        elif state == 4:        # avahi.ENTRY_GROUP_FAILURE
-            assert False
+        elif state in [3, 4]:   # avahi.ENTRY_GROUP_COLLISION, avahi.ENTRY_GROUP_FAILURE
+            logging.error("Avahi register domain name %s failed, retry in %d seconds" % (domainName, self.retryInterval))
+            self._retryEntryGroup(domainName)
         else:
             assert False
 
+    def _retryEntryGroup(self, domainName):
+        if domainName in self._entryGroupDict:
+            self._removeEntryGroup(domainName)
+        self._collisionSet.add(domainName)
+        if self._retryCollisionTimer is None:
+            self._retryCollisionTimer = GLib.timeout_add_seconds(self.retryInterval, self.__timeoutRetryCollision)
+
     def _retryCreateServer(self):
         assert self._retryCreateServerTimer is None
         self._retryCreateServerTimer = GLib.timeout_add_seconds(self.retryInterval, self.__timeoutCreateServer)
@@ -632,6 +1032,109 @@ class AvahiDomainNameRegister:
         self._register()                 # no exception in self._register()
         return False
 
+    def __timeoutRetryCollision(self):
+        self._retryCollisionTimer = None
+        for domainName in self._collisionSet:
+            self._markDirty(domainName)
+        self._collisionSet.clear()
+        return False
+
+    def __syncTimeout(self, changeCount):
+        self._syncEntryGroups()
+
+    def __onNameHasOwner(self, generation, ret):
+        if generation == self._serverGeneration and ret and self._server is None:
+            self._createServer()
+
+    def __onGetState(self, generation, state):
+        if generation != self._serverGeneration:
+            return
+        if state == 2 and not self._bRegistered:     # avahi.SERVER_RUNNING
+            self._register()
+
+    def __onCreateServerError(self, generation, e):
+        if generation != self._serverGeneration:
+            return
+        logging.error("Avahi create server failed, retry in %d seconds, %s" % (self.retryInterval, e))
+        self._unregister()
+        self._releaseServer()
+        self._retryCreateServer()
+
+    def __onGetHostNameFqdn(self, generation, hostname):
+        if generation != self._serverGeneration:
+            return
+        self._bHostnameQuerying = False
+        self._hostnameRData = self.__encodeRDATA(hostname)
+        if self._bRegistered:
+            self._syncEntryGroups()
+
+    def __onRegisterError(self, generation, e):
+        if generation != self._serverGeneration:
+            return
+        self._bHostnameQuerying = False
+        if self._bRegistered:
+            logging.error("Avahi register domain name failed, retry in %d seconds, %s" % (self.retryInterval, e))
+            self._unregister()
+            self._retryRegisterService()
+
+    def __onEntryGroupNew(self, domainName, info, path):
+        entryGroup = dbus.Interface(self._bus.get_object("org.freedesktop.Avahi", path, introspect=False), "org.freedesktop.Avahi.EntryGroup")
+        if self._entryGroupDict.get(domainName) is not info:
+            # domain name is removed before the entry group is created
+            self._freeEntryGroup(entryGroup)
+            return
+
+        info.entryGroup = entryGroup
+        info.signalMatch = entryGroup.connect_to_signal("StateChanged", lambda state, error: self.onEntryGroupStateChanged(domainName, state, error))
+        entryGroup.AddRecord(-1,                                # interface = avahi.IF_UNSPEC
+                             0,                                 # protocol = avahi.PROTO_UNSPEC
+                             dbus.UInt32(0),                    # flags
+                             self.__encodeCNAME(domainName),    # name
+                             0x01,                              # CLASS_IN
+                             0X05,                              # TYPE_CNAME
+                             60,                                # TTL
+                             self._hostnameRData,               # rdata
+                             signature="iiusqquay",             # proxy is not introspected, argument types must be given
+                             timeout=self.callTimeout,
+                             **self.__handlers(lambda: self.__onAddRecord(domainName, info),
+                                               lambda e: self.__onEntryGroupError(domainName, info, e)))
+
+    def __onAddRecord(self, domainName, info):
+        if self._entryGroupDict.get(domainName) is not info:
+            return
+        info.entryGroup.Commit(timeout=self.callTimeout,
+                               **self.__handlers(lambda: self.__onCommit(domainName, info),
+                                                 lambda e: self.__onEntryGroupError(domainName, info, e)))
+
+    def __onCommit(self, domainName, info):
+        if self._entryGroupDict.get(domainName) is not info:
+            return
+        info.bCommitted = True
+
+    def __onEntryGroupError(self, domainName, info, e):
+        if self._entryGroupDict.get(domainName) is not info:
+            return
+        logging.error("Avahi register domain name %s failed, retry in %d seconds, %s" % (domainName, self.retryInterval, e))
+        self._retryEntryGroup(domainName)
+
+    def __handlers(self, replyHandler, errorHandler):
+        # returns keyword arguments for an asynchronous D-Bus call, call latency is recorded
+        startTime = time.monotonic()
+
+        def _reply(*args):
+            self.callLatencyHistogram.observe(time.monotonic() - startTime)
+            replyHandler(*args)
+
+        def _error(e):
+            self.callLatencyHistogram.observe(time.monotonic() - startTime)
+            self.callErrorCount += 1
+            errorHandler(e)
+
+        return {
+            "reply_handler": _reply,
+            "error_handler": _error,
+        }
+
     def __encodeCNAME(self, name):
         return encodings.idna.ToASCII(name)
 
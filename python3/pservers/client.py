@@ -71,6 +71,112 @@ class SimpleClient:
         self.close()
 
 
+class RpcClient:
+
+    """
+    Client using the json-rpc 2.0 protocol, every call reports its result.
+
+    Exampe:
+        obj = RpcClient()
+        obj.register(domainName, httpPort, httpsPort)
+        errList = obj.register_many([(domainName1, httpPort1, None), (domainName2, httpPort2, None)])
+        obj.unregister(domainName)
+        ...
+        obj.close()
+    """
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(_socketFile)
+        self._rfile = self._sock.makefile("rb")
+        self._lastId = 0
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+        del self._rfile
+        del self._sock
+
+    def get_version(self):
+        return self._call("get-version", {})["api-version"]
+
+    def register(self, domain_name, http_port=None, https_port=None, backend_pool=None, capabilities=None, cache=None):
+        self._call("register", _registerParamToData(domain_name, http_port, https_port, backend_pool, capabilities, cache))
+
+    def unregister(self, domain_name):
+        self._call("unregister", {"domain-name": domain_name})
+
+    def register_many(self, item_list):
+        # item_list is a list of (domain_name, http_port, https_port), backend_pool, capabilities and cache can be appended to the tuple
+        # returns a list of RpcError or None, in the order of item_list
+        return self._batchCall([("register", _registerParamToData(*x)) for x in item_list])
+
+    def unregister_many(self, domain_name_list):
+        # returns a list of RpcError or None, in the order of domain_name_list
+        return self._batchCall([("unregister", {"domain-name": x}) for x in domain_name_list])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _call(self, method, params):
+        req = self._newRequest(method, params)
+        self._send(req)
+        ret = self._recv()
+        if ret.get("id") != req["id"]:
+            raise Exception("invalid response")
+        if "error" in ret:
+            raise RpcError(ret["error"]["code"], ret["error"]["message"])
+        return ret["result"]
+
+    def _batchCall(self, callList):
+        if len(callList) == 0:
+            return []
+
+        reqList = [self._newRequest(method, params) for method, params in callList]
+        self._send(reqList)
+        retDict = dict()
+        for ret in self._recv():
+            retDict[ret["id"]] = ret
+
+        errList = []
+        for req in reqList:
+            ret = retDict[req["id"]]
+            if "error" in ret:
+                errList.append(RpcError(ret["error"]["code"], ret["error"]["message"]))
+            else:
+                errList.append(None)
+        return errList
+
+    def _newRequest(self, method, params):
+        self._lastId += 1
+        return {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": self._lastId,
+        }
+
+    def _send(self, jsonObj):
+        self._sock.sendall(json.dumps(jsonObj).encode("utf-8") + b'\n')
+
+    def _recv(self):
+        line = self._rfile.readline()
+        if not line.endswith(b'\n'):
+            raise Exception("connection aborted")
+        return json.loads(line.decode("utf-8"))
+
+
+class RpcError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__("%s (%d)" % (message, code))
+        self.code = code
+        self.message = message
+
+
 class PersistClientGLib:
 
     """
@@ -106,8 +212,8 @@ class PersistClientGLib:
         if self._sock is not None:
             self._closeSocket()
 
-    def register(self, domain_name, http_port=None, https_port=None):
-        self._data = _registerParamToData(domain_name, http_port, https_port)
+    def register(self, domain_name, http_port=None, https_port=None, backend_pool=None, capabilities=None, cache=None):
+        self._data = _registerParamToData(domain_name, http_port, https_port, backend_pool, capabilities, cache)
         if self._sock is not None:
             self._register()
 
@@ -172,13 +278,22 @@ class PersistClientGLib:
 _socketFile = "/run/pservers/api.socket"
 
 
-def _registerParamToData(domain_name, http_port, https_port):
+def _registerParamToData(domain_name, http_port, https_port, backend_pool=None, capabilities=None, cache=None):
+    # backend is accessed by https only if http_port is None
+    # backend_pool is a dict of backend connection pool parameters, overriding the defaults of pservers:
+    #   keepalive (bool), max (int), ttl (int, in seconds), connectiontimeout (int, in seconds), flushpackets ("on", "off" or "auto")
+    # capabilities is a list of protocols supported by backend other than http/1.1: "websocket", "http2"
+    # cache is a dict of disk cache policy, responses are cached by pservers if it's not None, {} means default policy:
+    #   default-expire (int, in seconds), max-expire (int, in seconds), max-file-size (int, in bytes)
     assert isinstance(domain_name, str)
     assert http_port is not None or https_port is not None
     if http_port is not None:
         assert isinstance(http_port, int) and 0 < http_port < 65536
     if https_port is not None:
         assert isinstance(https_port, int) and 0 < https_port < 65536
+    assert backend_pool is None or isinstance(backend_pool, dict)
+    assert capabilities is None or isinstance(capabilities, list)
+    assert cache is None or isinstance(cache, dict)
 
     data = {
         "domain-name": domain_name,
@@ -187,5 +302,11 @@ def _registerParamToData(domain_name, http_port, https_port):
         data["http-port"] = http_port
     if https_port is not None:
         data["https-port"] = https_port
+    if backend_pool is not None:
+        data["backend-pool"] = backend_pool
+    if capabilities is not None:
+        data["capabilities"] = capabilities
+    if cache is not None:
+        data["cache"] = cache
 
     return data
@@ -31,9 +31,61 @@ pservers.plugin
 @contact: fpemud@sina.com
 """
 
-import sys
-import json
+import abc
 
 __author__ = "fpemud@sina.com (Fpemud)"
 __version__ = "0.0.1"
 
+API_VERSION = 2
+
+
+class Plugin(abc.ABC):
+
+    """
+    Base class of version 2 plugins, an object is created for each running server.
+    The plugin module declares the plugin class and the api version it implements by module attributes.
+    Methods can be coroutines or normal functions, they are run in the event loop of the plugin worker
+    process, the loop keeps running between calls, so tasks and servers created in start() keep working.
+    The loop is backed by GLib mainloop as in daemon, so GLib sources keep working too.
+    Output on stdout and stderr is written to daemon log.
+    start() must be implemented, a subclass without it can't be instantiated.
+
+    Version 1 plugins are modules with start(argument) returning (apache_config, module_data)
+    and stop(module_data), they're still supported.
+
+    Exampe:
+        from pservers.plugin import API_VERSION, Plugin
+
+        class MyPlugin(Plugin):
+            async def start(self, argument):
+                ...
+                return apache_config
+            async def stop(self):
+                ...
+
+        plugin_api_version = API_VERSION
+        plugin_class = MyPlugin
+    """
+
+    @abc.abstractmethod
+    async def start(self, argument):
+        # argument contains "server-id", "domain-name", "data-directory", "temp-directory" and "webroot-directory"
+        # returns config for the main http server: {"module-dependencies": [...], "config-segment": "..."}
+        # config can have "static-directories": {url-path: directory}, directories must be in "webroot-directory",
+        # they're served by main server as static files with sendfile, validators, cache headers and pre-compressed variants
+        # config must have "backend": {"address": ..., "port": ...} if main server is native ("httpEngine" in main.conf),
+        # otherwise the server fails to start
+        pass
+
+    async def stop(self):
+        # optional, the plugin worker process exits after it
+        pass
+
+    async def health(self):
+        # optional, polled by daemon periodically, returns False or raises exception when the server is unhealthy
+        return True
+
+    def metrics(self):
+        # optional, polled by daemon with health(), returns a dict of <metric-name,number>
+        return dict()
+
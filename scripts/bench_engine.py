@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+Compare request rate and latency of the two main server engines, the native engine (PsNativeHttpServer)
+and apache, proxying the same small response of a local backend.
+
+Every engine runs in its own process, the backend too. Clients use keep-alive connections, each of them
+sends requests one after another for the given duration. The backend is also measured directly, as the
+baseline without proxy.
+
+The native engine is run by the code in lib/ with the same event loop as the daemon, access log is written.
+Apache is run with a minimal config having one virtual host and the same ProxyPass parameters as pservers
+generates, access log is written with the LogFormat of pservers. Apache is measured only if --apache is given.
+
+Clients run in this process, so on a small machine the numbers are relative, not absolute.
+
+Usage:
+    python3 scripts/bench_engine.py [-c CONNECTIONS] [-d SECONDS] [--body-size BYTES] [--apache /usr/sbin/apache2] [--apache-modules DIR]
+
+Example:
+    python3 scripts/bench_engine.py -c 64 -d 10 --apache /usr/sbin/apache2 --apache-modules /usr/lib/apache2/modules
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+
+domainName = "bench.local"
+
+
+def percentile(valueList, q):
+    valueList = sorted(valueList)
+    return valueList[min(len(valueList) - 1, int(len(valueList) * q))]
+
+
+def getFreePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def waitPort(port, proc, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise Exception("server process exited with code %d" % (proc.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception("server is not listening on port %d" % (port))
+
+
+def serveBackend(port, bodySize):
+    body = b'x' * bodySize
+    resp = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n' % (len(body)) + body
+
+    async def _onClient(reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                writer.write(resp)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_server(_onClient, "127.0.0.1", port, reuse_address=True))
+    loop.run_forever()
+
+
+def serveNative(port, backendPort, tmpDir):
+    # the same event loop and parameters as the daemon
+    import asyncio_glib
+    from ps_param import PsConst
+    from ps_param import PsParam
+    from ps_native_httpd import PsNativeHttpServer
+
+    asyncio.set_event_loop_policy(asyncio_glib.GLibEventLoopPolicy())
+    PsConst.httpPort = port
+    PsConst.logDir = tmpDir
+
+    param = PsParam()
+    param.listenIp = "127.0.0.1"
+    param.mainloop = asyncio.get_event_loop()
+    server = PsNativeHttpServer(param)
+    server.addConfig("proxy-%s" % (domainName), {
+        "domain-name": domainName,
+        "backend": {
+            "address": "127.0.0.1",
+            "port": backendPort,
+            "host": "127.0.0.1:%d" % (backendPort),
+        },
+    })
+    server.start()
+    param.mainloop.run_forever()
+
+
+def startApache(apache, moduleDir, port, backendPort, tmpDir):
+    from ps_param import PsParam
+
+    pool = PsParam().backendPoolDict
+    paramStr = "".join([" %s=%s" % (k, ("On" if v else "Off") if isinstance(v, bool) else v) for k, v in sorted(pool.items())])
+    buf = ''
+    for name in ["mpm_event", "authz_core", "log_config", "proxy", "proxy_http"]:
+        buf += 'LoadModule %s_module "%s"\n' % (name, os.path.join(moduleDir, "mod_%s.so" % (name)))
+    if os.path.exists(os.path.join(moduleDir, "mod_unixd.so")):
+        buf += 'LoadModule unixd_module "%s"\n' % (os.path.join(moduleDir, "mod_unixd.so"))
+    buf += 'ServerRoot "%s"\n' % (tmpDir)
+    buf += 'PidFile "%s"\n' % (os.path.join(tmpDir, "httpd.pid"))
+    buf += 'ErrorLog "%s"\n' % (os.path.join(tmpDir, "httpd-error.log"))
+    buf += 'Listen 127.0.0.1:%d\n' % (port)
+    buf += 'KeepAlive On\n'
+    buf += 'MaxKeepAliveRequests 0\n'
+    buf += r'LogFormat "%v %>s %B %D %{X-Cache}o %h %l %u %t \"%r\" \"%{Referer}i\" \"%{User-Agent}i\"" pservers' + "\n"
+    buf += 'CustomLog "%s" pservers\n' % (os.path.join(tmpDir, "httpd-access.log"))
+    buf += '<VirtualHost *:%d>\n' % (port)
+    buf += '    ServerName %s\n' % (domainName)
+    buf += '    ProxyPass / "http://127.0.0.1:%d/"%s\n' % (backendPort, paramStr)
+    buf += '    ProxyPassReverse / "http://127.0.0.1:%d/"\n' % (backendPort)
+    buf += '</VirtualHost>\n'
+
+    cfgFn = os.path.join(tmpDir, "httpd.conf")
+    with open(cfgFn, "w") as f:
+        f.write(buf)
+    return subprocess.Popen([apache, "-X", "-f", cfgFn])
+
+
+async def runLoad(port, connections, seconds):
+    # returns (request-count, latency-list, error-list)
+    req = ("GET / HTTP/1.1\r\nHost: %s\r\n\r\n" % (domainName)).encode("iso8859-1")
+    latencyList = []
+    errorList = []
+    deadline = time.monotonic() + seconds
+
+    async def _client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            while time.monotonic() < deadline:
+                t = time.monotonic()
+                writer.write(req)
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                await reader.readexactly(length)
+                latencyList.append(time.monotonic() - t)
+        except Exception as e:
+            errorList.append(e)
+        finally:
+            writer.close()
+
+    startTime = time.monotonic()
+    await asyncio.gather(*[_client() for i in range(connections)])
+    return time.monotonic() - startTime, latencyList, errorList
+
+
+def report(name, seconds, latencyList, errorList):
+    if len(latencyList) == 0:
+        print("%-10s no response, %d errors, first: %s" % (name, len(errorList), errorList[0] if errorList else None))
+        return
+    print("%-10s %8d req %4d err %9.0f /s   p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms" % (
+        name, len(latencyList), len(errorList), len(latencyList) / seconds,
+        percentile(latencyList, 0.5) * 1000, percentile(latencyList, 0.99) * 1000, max(latencyList) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", dest="connections", type=int, default=32)
+    parser.add_argument("-d", dest="seconds", type=float, default=5)
+    parser.add_argument("--body-size", type=int, default=1024)
+    parser.add_argument("--apache", default=None)
+    parser.add_argument("--apache-modules", default="/usr/lib/apache2/modules")
+    parser.add_argument("--serve", nargs="+", help=argparse.SUPPRESS)             # used by child processes
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        signal.signal(signal.SIGTERM, lambda *a: os._exit(0))
+        if args.serve[0] == "backend":
+            serveBackend(int(args.serve[1]), args.body_size)
+        else:
+            serveNative(int(args.serve[1]), int(args.serve[2]), args.serve[3])
+        return
+
+    tmpDir = tempfile.mkdtemp(prefix="bench_engine.")
+    procList = []
+    try:
+        backendPort = getFreePort()
+        proc = subprocess.Popen([sys.executable, __file__, "--body-size", str(args.body_size), "--serve", "backend", str(backendPort)])
+        procList.append(proc)
+        waitPort(backendPort, proc)
+
+        engineList = [("backend", backendPort, None)]
+
+        port = getFreePort()
+        proc = subprocess.Popen([sys.executable, __file__, "--serve", "native", str(port), str(backendPort), tmpDir])
+        procList.append(proc)
+        engineList.append(("native", port, proc))
+
+        if args.apache is not None:
+            port = getFreePort()
+            proc = startApache(args.apache, args.apache_modules, port, backendPort, tmpDir)
+            procList.append(proc)
+            engineList.append(("apache", port, proc))
+
+        print("%d connections, %.1f seconds, %d bytes response body" % (args.connections, args.seconds, args.body_size))
+        loop = asyncio.get_event_loop()
+        for name, port, proc in engineList:
+            if proc is not None:
+                waitPort(port, proc)
+            loop.run_until_complete(runLoad(port, args.connections, min(1, args.seconds)))           # warm up backend connections
+            report(name, *loop.run_until_complete(runLoad(port, args.connections, args.seconds)))
+    finally:
+        for proc in procList:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    main()
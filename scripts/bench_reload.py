@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+Measure config regeneration and reload cost of the apache main server with N virtual hosts.
+
+"monolithic" is the behavior before per-config fragment files: every change renders all the
+virtual hosts into one file and reloads apache.
+"fragment" is the current behavior: every change renders one fragment, unchanged fragments
+are skipped by hash and do not cause a reload.
+
+If apache is installed, the time apache needs to parse the generated config is measured too,
+which is what every graceful reload pays.
+
+Usage:
+    python3 scripts/bench_reload.py [-n VHOSTS] [-c CHANGES] [--apache /usr/sbin/apache2]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ps_param import PsConst
+from ps_param import PsParam
+
+
+def makeCfg(i, rev=0):
+    return {
+        "domain-name": "vhost%d.local" % (i),
+        "module-dependencies": ["mod_proxy.so", "mod_proxy_http.so"],
+        "config-segment": "\n".join([
+            "ServerName vhost%d.local" % (i),
+            "ProxyPass / http://127.0.0.1:%d/ keepalive=On ttl=4" % (20000 + i),
+            "ProxyPassReverse / http://127.0.0.1:%d/" % (20000 + i),
+            "# revision %d" % (rev),
+        ]),
+    }
+
+
+def benchMonolithic(server, vhostCount, changeCount):
+    # render everything into one file for every change, one reload for every change
+    fn = os.path.join(PsConst.tmpDir, "httpd-monolithic.conf")
+    startTime = time.monotonic()
+    for j in range(changeCount):
+        i = j % vhostCount
+        server._cfgDict[i] = makeCfg(i, j + 1)
+        buf = server._renderCfg()
+        for cfg in server._cfgDict.values():
+            buf += server._renderFragment(cfg)
+        with open(fn, "w") as f:
+            f.write(buf)
+    return time.monotonic() - startTime, changeCount, fn
+
+
+def benchFragment(server, vhostCount, changeCount, bNoop):
+    # render and write only the changed fragment, a reload is needed only if something is written
+    reloadCount = 0
+    startTime = time.monotonic()
+    for j in range(changeCount):
+        i = j % vhostCount
+        server._cfgDict[i] = dict(server._cfgDict[i]) if bNoop else makeCfg(i, j + 1)
+        server._refresh([i])
+        if server._generateCfgFn():
+            reloadCount += 1
+    return time.monotonic() - startTime, reloadCount
+
+
+def apacheParseTime(apache, cfgFn):
+    startTime = time.monotonic()
+    subprocess.run([apache, "-t", "-f", cfgFn], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.monotonic() - startTime
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="vhosts", type=int, default=1000)
+    parser.add_argument("-c", dest="changes", type=int, default=100)
+    parser.add_argument("--apache", default=None)
+    args = parser.parse_args()
+
+    PsConst.tmpDir = tempfile.mkdtemp(prefix="bench_reload.")
+    try:
+        from ps_main_httpd import PsMainHttpServer
+
+        param = PsParam()
+        server = PsMainHttpServer(param)
+        for i in range(args.vhosts):
+            server._cfgDict[i] = makeCfg(i)
+
+        # initial generation, the same as what start() does
+        startTime = time.monotonic()
+        server._dirtyFragmentDict = {k: server._renderFragment(v) for k, v in server._cfgDict.items()}
+        os.makedirs(server._cfgFragmentDir)
+        server._generateCfgFn()
+        initTime = time.monotonic() - startTime
+
+        fragTime, fragReloads = benchFragment(server, args.vhosts, args.changes, False)
+        noopTime, noopReloads = benchFragment(server, args.vhosts, args.changes, True)
+        monoTime, monoReloads, monoFn = benchMonolithic(server, args.vhosts, args.changes)
+
+        print("vhosts: %d, changes: %d" % (args.vhosts, args.changes))
+        print("initial generation:             %8.2f ms" % (initTime * 1000))
+        print("%-30s %8s %12s %8s" % ("mode", "total ms", "ms/change", "reloads"))
+        for name, t, n in [("monolithic", monoTime, monoReloads),
+                           ("fragment", fragTime, fragReloads),
+                           ("fragment, unchanged content", noopTime, noopReloads)]:
+            print("%-30s %8.2f %12.3f %8d" % (name, t * 1000, t * 1000 / args.changes, n))
+
+        if args.apache is not None:
+            # apache re-reads every file on graceful reload, with fragments it only happens when something changed
+            t = apacheParseTime(args.apache, monoFn)
+            print("apache config parse:            %8.2f ms per reload" % (t * 1000))
+            print("apache reload time, monolithic: %8.2f ms" % (t * monoReloads * 1000))
+            print("apache reload time, fragment:   %8.2f ms" % (t * (fragReloads + noopReloads) * 1000))
+    finally:
+        shutil.rmtree(PsConst.tmpDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+Measure TLS handshake rate and latency of the main server, with and without session resumption.
+
+Every handshake is a new TCP connection. In "full" mode no session is offered, in "resumed" mode
+each worker offers the session (or TLS 1.3 ticket) it got from its first connection.
+A HEAD request is sent on every connection, so that TLS 1.3 tickets are received.
+
+Usage:
+    python3 scripts/bench_tls.py [-H HOST] [-p PORT] [-n HANDSHAKES] [-c WORKERS] [--cafile CA] [--tls12] SERVER_NAME
+
+Example, with the CA created by pservers:
+    python3 scripts/bench_tls.py --cafile /var/lib/pservers/.tls/ca.crt -n 2000 -c 8 foobar.local
+"""
+
+import ssl
+import sys
+import time
+import socket
+import argparse
+import threading
+
+
+def percentile(valueList, q):
+    valueList = sorted(valueList)
+    return valueList[min(len(valueList) - 1, int(len(valueList) * q))]
+
+
+def makeContext(args):
+    if args.cafile is not None:
+        ctx = ssl.create_default_context(cafile=args.cafile)
+    else:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    if args.tls12:
+        ctx.maximum_version = ssl.TLSVersion.TLSv1_2
+    return ctx
+
+
+def handshake(ctx, args, session):
+    # returns (seconds, session, reused)
+    sock = socket.create_connection((args.host, args.port))
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        startTime = time.monotonic()
+        ssock = ctx.wrap_socket(sock, server_hostname=args.server_name, session=session)
+        seconds = time.monotonic() - startTime
+        ssock.sendall(("HEAD / HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % (args.server_name)).encode("iso8859-1"))
+        while ssock.recv(65536) != b'':
+            pass
+        ret = (seconds, ssock.session, ssock.session_reused)
+        ssock.close()
+        return ret
+    finally:
+        sock.close()
+
+
+def runMode(args, bResume):
+    latencyList = []
+    reusedList = []
+    errorList = []
+    lock = threading.Lock()
+
+    def _worker(count):
+        ctx = makeContext(args)
+        session = None
+        for i in range(count):
+            try:
+                seconds, newSession, reused = handshake(ctx, args, session if bResume else None)
+            except (OSError, ssl.SSLError) as e:
+                with lock:
+                    errorList.append(e)
+                continue
+            if bResume and session is None:
+                session = newSession
+            with lock:
+                latencyList.append(seconds)
+                reusedList.append(reused)
+
+    threadList = []
+    for i in range(args.workers):
+        threadList.append(threading.Thread(target=_worker, args=(args.handshakes // args.workers,)))
+    startTime = time.monotonic()
+    for t in threadList:
+        t.start()
+    for t in threadList:
+        t.join()
+    seconds = time.monotonic() - startTime
+
+    name = "resumed" if bResume else "full"
+    if len(latencyList) == 0:
+        print("%-8s no successful handshake, %d errors, first: %s" % (name, len(errorList), errorList[0]))
+        return
+    print("%-8s %6d ok %4d err %8.0f /s   p50 %7.2f ms   p99 %7.2f ms   reused %5.1f%%" % (
+        name, len(latencyList), len(errorList), len(latencyList) / seconds,
+        percentile(latencyList, 0.5) * 1000, percentile(latencyList, 0.99) * 1000,
+        100 * sum(reusedList) / len(reusedList)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-H", dest="host", default="127.0.0.1")
+    parser.add_argument("-p", dest="port", type=int, default=443)
+    parser.add_argument("-n", dest="handshakes", type=int, default=1000)
+    parser.add_argument("-c", dest="workers", type=int, default=4)
+    parser.add_argument("--cafile", default=None)
+    parser.add_argument("--tls12", action="store_true")
+    parser.add_argument("server_name")
+    args = parser.parse_args()
+
+    print("%s:%d, server name %s, %d handshakes by %d workers, %s" % (
+        args.host, args.port, args.server_name, args.handshakes, args.workers, "TLS 1.2" if args.tls12 else "TLS 1.3 if offered"))
+    runMode(args, False)
+    runMode(args, True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+Load test of the api socket: N clients connect, each registers one domain name by json-rpc,
+all of them stay connected while a round of get-version requests is sent, then all disconnect.
+
+The daemon admits api clients by peer credentials, all the test clients have the same uid,
+so main.conf must allow them, for example:
+    {"apiMaxConnectionsPerUid": 10000, "apiMaxRegistrationsPerUid": 10000, "apiNotifyBurst": 100000}
+
+The open file limit of this process must be greater than N.
+
+The daemon side of disconnection is measured by polling the metrics socket until all the
+clients are gone.
+
+Usage:
+    python3 scripts/loadtest_api.py [-n CLIENTS] [-c CONCURRENCY] [-s SOCKET] [-m METRICS_SOCKET] [-p DAEMON_PID]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+
+
+def percentile(valueList, q):
+    valueList = sorted(valueList)
+    return valueList[min(len(valueList) - 1, int(len(valueList) * q))]
+
+
+def getRss(pid):
+    for line in open("/proc/%d/status" % (pid)):
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+async def getMetric(metricsFile, name):
+    reader, writer = await asyncio.open_unix_connection(metricsFile)
+    try:
+        writer.write(b'GET /metrics HTTP/1.1\r\n\r\n')
+        buf = (await reader.read()).decode("utf-8")
+    finally:
+        writer.close()
+    for line in buf.split("\n"):
+        if line.startswith(name + " "):
+            return float(line.split(" ")[1])
+    return None
+
+
+class Client:
+
+    def __init__(self, idx):
+        self.idx = idx
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, socketFile):
+        self.reader, self.writer = await asyncio.open_unix_connection(socketFile)
+
+    async def call(self, method, params):
+        req = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": self.idx,
+        }
+        self.writer.write(json.dumps(req).encode("utf-8") + b'\n')
+        line = await self.reader.readline()
+        if line == b'':
+            raise Exception("connection closed by daemon")
+        resp = json.loads(line.decode("utf-8"))
+        if "error" in resp:
+            raise Exception(resp["error"]["message"])
+        return resp["result"]
+
+    def close(self):
+        self.writer.close()
+
+
+async def runPhase(clientList, concurrency, func):
+    # returns (seconds, latency-list, error-list)
+    sem = asyncio.Semaphore(concurrency)
+    latencyList = []
+    errorList = []
+
+    async def _one(client):
+        async with sem:
+            t = time.monotonic()
+            try:
+                await func(client)
+                latencyList.append(time.monotonic() - t)
+            except Exception as e:
+                errorList.append(e)
+
+    startTime = time.monotonic()
+    await asyncio.gather(*[_one(x) for x in clientList])
+    return time.monotonic() - startTime, latencyList, errorList
+
+
+def report(name, count, seconds, latencyList, errorList):
+    if len(latencyList) > 0:
+        print("%-12s %6d ok %5d err %8.2f s %9.0f /s   p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms" % (
+            name, len(latencyList), len(errorList), seconds, count / seconds,
+            percentile(latencyList, 0.5) * 1000, percentile(latencyList, 0.99) * 1000, max(latencyList) * 1000))
+    else:
+        print("%-12s %6d ok %5d err %8.2f s" % (name, 0, len(errorList), seconds))
+    if len(errorList) > 0:
+        print("             first error: %s" % (errorList[0]))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="clients", type=int, default=10000)
+    parser.add_argument("-c", dest="concurrency", type=int, default=1000)
+    parser.add_argument("-s", dest="socket", default="/run/pservers/api.socket")
+    parser.add_argument("-m", dest="metrics", default="/run/pservers/metrics.socket")
+    parser.add_argument("-p", dest="pid", type=int, default=None)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < args.clients + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.clients + 100), hard))
+
+    if args.pid is not None:
+        rss = getRss(args.pid)
+    clientList = [Client(i) for i in range(args.clients)]
+
+    t, latencyList, errorList = await runPhase(clientList, args.concurrency, lambda x: x.connect(args.socket))
+    report("connect", args.clients, t, latencyList, errorList)
+    clientList = [x for x in clientList if x.writer is not None]
+
+    def _register(client):
+        return client.call("register", {
+            "domain-name": "loadtest-%d-%d.private" % (os.getpid(), client.idx),
+            "http-port": 20000 + client.idx % 40000,
+        })
+
+    t, latencyList, errorList = await runPhase(clientList, args.concurrency, _register)
+    report("register", len(clientList), t, latencyList, errorList)
+
+    t, latencyList, errorList = await runPhase(clientList, args.concurrency, lambda x: x.call("get-version", {}))
+    report("get-version", len(clientList), t, latencyList, errorList)
+
+    if args.pid is not None:
+        print("daemon rss:  %+.1f MiB with %d clients connected" % ((getRss(args.pid) - rss) / 1024 / 1024, len(clientList)))
+
+    startTime = time.monotonic()
+    for client in clientList:
+        client.close()
+    while await getMetric(args.metrics, "pservers_api_clients") not in [0, None]:
+        await asyncio.sleep(0.05)
+    print("disconnect   %6d    %13.2f s" % (len(clientList), time.monotonic() - startTime))
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.get_event_loop().run_until_complete(main()))
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+A fake avahi-daemon on the session bus, it owns org.freedesktop.Avahi and implements the server and
+entry group methods used by AvahiDomainNameRegister, with the same signatures as avahi-daemon.
+
+Tests control it by org.pservers.Test.Control on object "/":
+    SetState(state)                 server state changes, StateChanged is emitted
+    SetCollision(name, count)       the next <count> commits of entry groups having record <name> collide
+    GetRecords()                    names of records in established entry groups
+    GetEntryGroupNewCount()         number of entry groups created
+
+Usage:
+    python3 tests/fake_avahi.py     # prints "ready" when the bus name is acquired
+"""
+
+import sys
+import dbus
+import dbus.service
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
+
+
+SERVER_RUNNING = 2
+SERVER_COLLISION = 3
+
+ENTRY_GROUP_UNCOMMITED = 0
+ENTRY_GROUP_REGISTERING = 1
+ENTRY_GROUP_ESTABLISHED = 2
+ENTRY_GROUP_COLLISION = 3
+
+
+class FakeEntryGroup(dbus.service.Object):
+
+    def __init__(self, server, path):
+        super().__init__(server.connection, path)
+        self.server = server
+        self.state = ENTRY_GROUP_UNCOMMITED
+        self.nameList = []
+
+    @dbus.service.method("org.freedesktop.Avahi.EntryGroup", in_signature="iiusqquay", out_signature="", message_keyword="msg")
+    def AddRecord(self, interface, protocol, flags, name, clazz, rtype, ttl, rdata, msg=None):
+        # avahi-daemon rejects arguments of wrong types
+        if msg.get_signature() != "iiusqquay":
+            raise dbus.exceptions.DBusException("Invalid arguments", name="org.freedesktop.Avahi.InvalidArgumentsError")
+        self.nameList.append(str(name))
+
+    @dbus.service.method("org.freedesktop.Avahi.EntryGroup", in_signature="", out_signature="")
+    def Commit(self):
+        self._setState(ENTRY_GROUP_REGISTERING)
+        for name in self.nameList:
+            if self.server.collisionDict.get(name, 0) > 0:
+                self.server.collisionDict[name] -= 1
+                GLib.idle_add(self._setState, ENTRY_GROUP_COLLISION)
+                return
+        GLib.idle_add(self._setState, ENTRY_GROUP_ESTABLISHED)
+
+    @dbus.service.method("org.freedesktop.Avahi.EntryGroup", in_signature="", out_signature="")
+    def Free(self):
+        self.server.entryGroupSet.discard(self)
+        self.remove_from_connection()
+
+    @dbus.service.signal("org.freedesktop.Avahi.EntryGroup", signature="is")
+    def StateChanged(self, state, error):
+        pass
+
+    def _setState(self, state):
+        if self in self.server.entryGroupSet:
+            self.state = state
+            self.StateChanged(state, "")
+        return False
+
+
+class FakeServer(dbus.service.Object):
+
+    def __init__(self, bus):
+        super().__init__(bus, "/")
+        self.state = SERVER_RUNNING
+        self.collisionDict = dict()         # <name,count>
+        self.entryGroupSet = set()
+        self.entryGroupNewCount = 0
+
+    @dbus.service.method("org.freedesktop.Avahi.Server", in_signature="", out_signature="i")
+    def GetState(self):
+        return self.state
+
+    @dbus.service.method("org.freedesktop.Avahi.Server", in_signature="", out_signature="s")
+    def GetHostNameFqdn(self):
+        return "testhost.local"
+
+    @dbus.service.method("org.freedesktop.Avahi.Server", in_signature="", out_signature="o")
+    def EntryGroupNew(self):
+        self.entryGroupNewCount += 1
+        path = "/Client1/EntryGroup%d" % (self.entryGroupNewCount)
+        self.entryGroupSet.add(FakeEntryGroup(self, path))
+        return path
+
+    @dbus.service.signal("org.freedesktop.Avahi.Server", signature="is")
+    def StateChanged(self, state, error):
+        pass
+
+    @dbus.service.method("org.pservers.Test.Control", in_signature="i", out_signature="")
+    def SetState(self, state):
+        # avahi-daemon resets all the entry groups when the server leaves running state
+        self.state = state
+        if state != SERVER_RUNNING:
+            for entryGroup in self.entryGroupSet:
+                entryGroup.state = ENTRY_GROUP_UNCOMMITED
+        self.StateChanged(state, "")
+
+    @dbus.service.method("org.pservers.Test.Control", in_signature="si", out_signature="")
+    def SetCollision(self, name, count):
+        self.collisionDict[name] = count
+
+    @dbus.service.method("org.pservers.Test.Control", in_signature="", out_signature="as")
+    def GetRecords(self):
+        ret = []
+        for entryGroup in self.entryGroupSet:
+            if entryGroup.state == ENTRY_GROUP_ESTABLISHED:
+                ret += entryGroup.nameList
+        return sorted(ret)
+
+    @dbus.service.method("org.pservers.Test.Control", in_signature="", out_signature="i")
+    def GetEntryGroupNewCount(self):
+        return self.entryGroupNewCount
+
+
+def main():
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    server = FakeServer(bus)
+    busName = dbus.service.BusName("org.freedesktop.Avahi", bus, do_not_queue=True)
+    print("ready", flush=True)
+    GLib.MainLoop().run()
+    del server, busName
+
+
+if __name__ == "__main__":
+    sys.exit(main())
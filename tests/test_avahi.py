@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""
+Tests of AvahiDomainNameRegister against a fake avahi-daemon (fake_avahi.py) on a private session bus.
+
+Usage:
+    dbus-run-session -- python3 -m unittest discover -s tests -v
+"""
+
+import os
+import sys
+import time
+import dbus
+import unittest
+import subprocess
+import unittest.mock
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ps_util import AvahiDomainNameRegister
+
+
+def setUpModule():
+    if "DBUS_SESSION_BUS_ADDRESS" not in os.environ:
+        raise Exception("no private session bus, run the tests with dbus-run-session")
+    DBusGMainLoop(set_as_default=True)          # the shared bus connection is created by tests before AvahiDomainNameRegister.start()
+
+
+class TestAvahiDomainNameRegister(unittest.TestCase):
+
+    def setUp(self):
+        # AvahiDomainNameRegister uses the system bus, it's replaced by the private session bus
+        self._busPatcher = unittest.mock.patch("dbus.SystemBus", dbus.SessionBus)
+        self._busPatcher.start()
+        self.bus = dbus.SessionBus()
+        self.proc = None
+        self.obj = AvahiDomainNameRegister()
+        self.obj.retryInterval = 1
+
+    def tearDown(self):
+        # signals in flight are drained, so that they're not dispatched to the object of the next test
+        self.obj.stop()
+        self._stopFakeAvahi()
+        self._iterate(0.2)
+        self._busPatcher.stop()
+
+    def test_register_and_remove(self):
+        self._startFakeAvahi()
+        self.obj.add_domain_name("foo.local")
+        self.obj.add_domain_name("bar.local")
+        self.obj.start()
+        self._waitRecords(["bar.local", "foo.local"])
+
+        self.obj.remove_domain_name("foo.local")
+        self.obj.add_domain_name("baz.local")
+        self._waitRecords(["bar.local", "baz.local"])
+        self.assertEqual(self._control().GetEntryGroupNewCount(), 3)        # bar.local is not touched
+        self.assertEqual(self.obj.callErrorCount, 0)
+
+    def test_name_owner_lost(self):
+        # avahi-daemon appears after start, disappears and appears again
+        self.obj.add_domain_name("foo.local")
+        self.obj.start()
+        self._iterate(0.5)
+        self.assertEqual(self.obj.recordCount, 0)
+
+        self._startFakeAvahi()
+        self._waitRecords(["foo.local"])
+
+        self._stopFakeAvahi()
+        self._waitFor(lambda: self.obj._server is None and self.obj.recordCount == 0)
+        self.assertEqual(self.obj._entryGroupDict, dict())
+
+        self.obj.add_domain_name("bar.local")
+        self._startFakeAvahi()
+        self._waitRecords(["bar.local", "foo.local"])
+
+    def test_server_collision(self):
+        # entry groups are released when server state leaves running, and registered again when it comes back
+        self._startFakeAvahi()
+        self.obj.add_domain_name("foo.local")
+        self.obj.start()
+        self._waitRecords(["foo.local"])
+
+        self._control().SetState(3)                 # avahi.SERVER_COLLISION
+        self._waitFor(lambda: self.obj.recordCount == 0 and len(self.obj._entryGroupDict) == 0)
+        self.obj.add_domain_name("bar.local")       # applied when server is running again
+        self._iterate(0.5)
+        self.assertEqual(self._control().GetRecords(), [])
+
+        self._control().SetState(2)                 # avahi.SERVER_RUNNING
+        self._waitRecords(["bar.local", "foo.local"])
+
+    def test_entry_group_collision(self):
+        # only the colliding domain name is retried, after retryInterval
+        self._startFakeAvahi()
+        self._control().SetCollision("bar.local", 1)
+        self.obj.add_domain_name("foo.local")
+        self.obj.add_domain_name("bar.local")
+        self.obj.start()
+        self._waitRecords(["foo.local"])
+        self.assertEqual(self._control().GetEntryGroupNewCount(), 2)
+
+        startTime = time.monotonic()
+        self._waitRecords(["bar.local", "foo.local"])
+        self.assertGreaterEqual(time.monotonic() - startTime, self.obj.retryInterval * 0.5)
+        self.assertEqual(self._control().GetEntryGroupNewCount(), 3)
+
+    def _startFakeAvahi(self):
+        self.proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_avahi.py")],
+                                     stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(self.proc.stdout.readline().strip(), "ready")
+
+    def _stopFakeAvahi(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.proc = None
+
+    def _control(self):
+        return dbus.Interface(self.bus.get_object("org.freedesktop.Avahi", "/"), "org.pservers.Test.Control")
+
+    def _waitRecords(self, nameList):
+        # records are established in avahi-daemon and committed in our side
+        self._waitFor(lambda: list(self._control().GetRecords()) == nameList and sorted(self.obj._entryGroupDict) == nameList)
+        self._waitFor(lambda: self.obj.recordCount == len(nameList))
+
+    def _waitFor(self, func, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not func():
+            if time.monotonic() > deadline:
+                self.fail("timeout")
+            self._iterate(0.01)
+
+    def _iterate(self, seconds):
+        deadline = time.monotonic() + seconds
+        ctx = GLib.MainContext.default()
+        while time.monotonic() < deadline:
+            if not ctx.iteration(False):
+                time.sleep(0.005)
+
+
+if __name__ == "__main__":
+    unittest.main()